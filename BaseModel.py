@@ -1,7 +1,152 @@
+import ctypes
+
+from glState import gl_state
 from mesh import Mesh
+from spatialIndex import transform_boxes
 
 from shaders import *
 
+# projected radius (as a fraction of the viewport height) below which the first level of detail is used
+LOD_SCREEN_SIZE = 0.5
+
+# the shader attributes of the vertex buffers, and the mesh arrays they hold
+VERTEX_ATTRIBUTES = [('position', 'vertices'), ('normal', 'normals'), ('color', 'colors'),
+                     ('texCoord', 'textureCoords'), ('tangent', 'tangents'), ('binormal', 'binormals')]
+
+# number of floats per instance in the instance buffer: the model matrix and the inverse-transpose of its 3x3 part
+INSTANCE_SIZE = 16 + 9
+
+
+def initialise_vbo(vbos, attributes, name, data):
+    print('Initialising VBO for attribute {}'.format(name))
+
+    if data is None:
+        print('(W) Warning in initialise_vbo(): Data array for attribute {} is None!'.format(name))
+        return
+
+    # bind the location of the attribute in the GLSL program to the next index
+    # the name of the location must correspond to an 'in' variable in the GLSL vertex shader code
+    attributes[name] = len(vbos)
+
+    # create a buffer object
+    vbos[name] = glGenBuffers(1)
+    # and bind it
+    glBindBuffer(GL_ARRAY_BUFFER, vbos[name])
+
+    # enable the attribute
+    glEnableVertexAttribArray(attributes[name])
+
+    # Associate the bound buffer to the corresponding input location in the shader
+    # Each instance of the vertex shader will get one row of the array for parallel processing
+    glVertexAttribPointer(index=attributes[name], size=data.shape[1], type=GL_FLOAT, normalized=False,
+                          stride=0, pointer=None)
+
+    # set the data in the buffer as the vertex array
+    glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+
+
+def create_vertex_array(mesh):
+    """
+    Stores the vertex data of a mesh in Vertex Buffer Objects (VBO) packed in a Vertex Array Object (VAO), that can
+    be uploaded to the GPU at render time.
+    :return: the (vao, vbos, attributes, index_buffer) tuple, where vbos and attributes are dictionaries indexed by
+    the attribute names.
+    """
+    vbos = {}
+    attributes = {}
+    index_buffer = None
+
+    # create the Vertex Array Object to retrieve all buffers and rendering context
+    vao = glGenVertexArrays(1)
+    gl_state.bind_vertex_array(vao)
+
+    if mesh.vertices is None:
+        print('(W) Warning in create_vertex_array(): No vertex array!')
+
+    # initialise vertex position VBO and link to shader program attribute
+    for name, array in VERTEX_ATTRIBUTES:
+        initialise_vbo(vbos, attributes, name, getattr(mesh, array))
+
+    # if indices are provided, put them in a buffer too
+    if mesh.faces is not None:
+        index_buffer = glGenBuffers(1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index_buffer)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, mesh.faces, GL_STATIC_DRAW)
+
+    # finally we unbind the VAO and VBO when we're done to avoid side effects
+    gl_state.bind_vertex_array(0)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    return vao, vbos, attributes, index_buffer
+
+
+def create_instanced_vertex_array(mesh, vertex_array):
+    """
+    Creates a Vertex Array Object reading the (shared) vertex buffers of a mesh, plus a buffer of per-instance
+    model matrices that advances once per instance rather than once per vertex.
+    :param vertex_array: the (vao, vbos, attributes, index_buffer) tuple of the mesh
+    :return: the (vao, attributes, instance_buffer) tuple, the attributes include instance_M and instance_MiT
+    """
+    _, vbos, attributes, index_buffer = vertex_array
+    attributes = dict(attributes)
+
+    vao = glGenVertexArrays(1)
+    gl_state.bind_vertex_array(vao)
+
+    # point the new VAO to the existing vertex buffers, at the same locations
+    for name, array in VERTEX_ATTRIBUTES:
+        if name in attributes:
+            glBindBuffer(GL_ARRAY_BUFFER, vbos[name])
+            glEnableVertexAttribArray(attributes[name])
+            glVertexAttribPointer(index=attributes[name], size=getattr(mesh, array).shape[1], type=GL_FLOAT,
+                                  normalized=False, stride=0, pointer=None)
+
+    if index_buffer is not None:
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index_buffer)
+
+    # matrix attributes take one location per column
+    instance_buffer = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, instance_buffer)
+    attributes['instance_M'] = len(vbos)
+    attributes['instance_MiT'] = len(vbos) + 4
+    columns = [(attributes['instance_M'] + i, 4, 4 * i) for i in range(4)] + \
+              [(attributes['instance_MiT'] + i, 3, 16 + 3 * i) for i in range(3)]
+    for location, size, offset in columns:
+        glEnableVertexAttribArray(location)
+        glVertexAttribPointer(index=location, size=size, type=GL_FLOAT, normalized=False,
+                              stride=4 * INSTANCE_SIZE, pointer=ctypes.c_void_p(4 * offset))
+        glVertexAttribDivisor(location, 1)
+
+    gl_state.bind_vertex_array(0)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    return vao, attributes, instance_buffer
+
+
+def instance_data(matrices):
+    """
+    Packs a list of model matrices in the layout of the instance buffer: each row holds the matrix and the
+    inverse-transpose of its 3x3 part, both in column-major order as GLSL expects.
+    """
+    M = np.array(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    data = np.empty((M.shape[0], INSTANCE_SIZE), 'f')
+    data[:, :16] = M.transpose(0, 2, 1).reshape(-1, 16)
+    # the columns of the inverse-transpose are the rows of the inverse
+    data[:, 16:] = np.linalg.inv(M[:, :3, :3]).reshape(-1, 9)
+    return data
+
+
+def shared_vertex_array(assets, mesh):
+    """
+    Returns the (vao, vbos, attributes, index_buffer) tuple of a mesh from the asset registry, creating and
+    registering it if the mesh is not on the GPU yet.
+    """
+    vertex_array = assets.get_vertex_array(mesh)
+    if vertex_array is None:
+        vertex_array = create_vertex_array(mesh)
+        assets.add_vertex_array(mesh, vertex_array)
+    return vertex_array
+
 
 class BaseModel:
     """
@@ -19,6 +164,26 @@ class BaseModel:
         # if flag set to False, model is not rendered
         self.visible = visible
 
+        # if flag set to True, the render queue draws the model in the order given rather than sorting it
+        self.ordered = False
+
+        # if flag set to False, the model is not drawn in the shadow map
+        self.casts_shadows = True
+
+        # if flag set to False, the model moves often: it is drawn over the cached shadows of the static models at
+        # each frame, rather than making them render again when it moves
+        self.static = True
+
+        # increased when what the model draws changes other than through its model matrix (eg the copies of an
+        # InstancedDrawModel), so that the cached shadow map and environment maps are rendered again
+        self.content_version = 0
+
+        # position-only shader for the depth passes, created when first needed
+        self.depth_shader = None
+
+        # LAYERED permutation of the shader for the layered cube map passes, created when first needed
+        self.layered_shader = None
+
         # store the scene reference
         self.scene = scene
 
@@ -45,39 +210,14 @@ class BaseModel:
         # store the position of the model in the scene
         self.M = M
 
-        # Vertex Array Object to pack all buffers for rendering in the GPU
-        self.vao = glGenVertexArrays(1)
+        # Vertex Array Object to pack all buffers for rendering in the GPU, created (or shared) when binding
+        self.vao = None
 
         # buffer to store indices using shared vertex representation
         self.index_buffer = None
 
-    def initialise_vbo(self, name, data):
-        print('Initialising VBO for attribute {}'.format(name))
-
-        if data is None:
-            print('(W) Warning in {}.bind_attribute(): Data array for attribute {} is None!'.format(
-                self.__class__.__name__, name))
-            return
-
-        # bind the location of the attribute in the GLSL program to the next index
-        # the name of the location must correspond to an 'in' variable in the GLSL vertex shader code
-        self.attributes[name] = len(self.vbos)
-
-        # create a buffer object
-        self.vbos[name] = glGenBuffers(1)
-        # and bind it
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
-
-        # enable the attribute
-        glEnableVertexAttribArray(self.attributes[name])
-
-        # Associate the bound buffer to the corresponding input location in the shader
-        # Each instance of the vertex shader will get one row of the array for parallel processing
-        glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=GL_FLOAT, normalized=False,
-                              stride=0, pointer=None)
-
-        # set the data in the buffer as the vertex array
-        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+        # Vertex Array Object of each level of detail of the mesh, from the most to the least detailed
+        self.lod_vaos = []
 
     def bind_shader(self, shader):
         """
@@ -88,77 +228,119 @@ class BaseModel:
                 self.shader = PhongShader(shader)
             else:
                 self.shader = shader
+            self.layered_shader = None
 
-            # bind all attributes and compile the shader
+            # select the permutation of the shader matching this model, then bind all attributes and compile it
+            self.shader.define(*self.shader_flags())
             self.shader.compile(self.attributes)
 
+    def shader_flags(self):
+        """
+        Returns the shader flags (see SHADER_FLAGS) needed to draw the mesh of this model.
+        """
+        return ['TEXTURED'] if len(self.mesh.textures) > 0 else []
+
     def bind(self):
         """
         This method stores the vertex data in a Vertex Buffer Object (VBO) that can be uploaded
-        to the GPU at render time.
+        to the GPU at render time. If the mesh was already bound by another model, its buffers are shared.
         """
 
-        # bind the Vertex Array Object to retrieve all buffers and rendering context
-        glBindVertexArray(self.vao)
+        # reuse the buffers if this mesh is already on the GPU, otherwise upload it and share its buffers
+        self.vao, self.vbos, self.attributes, self.index_buffer = shared_vertex_array(self.scene.assets, self.mesh)
 
-        if self.mesh.vertices is None:
-            print('(W) Warning in {}.bind(): No vertex array!'.format(self.__class__.__name__))
+        # the levels of detail have the same attributes, only their VAO is needed
+        self.lod_vaos = [shared_vertex_array(self.scene.assets, lod)[0] for lod in self.mesh.lods]
 
-        # initialise vertex position VBO and link to shader program attribute
-        self.initialise_vbo('position', self.mesh.vertices)
-        self.initialise_vbo('normal', self.mesh.normals)
-        self.initialise_vbo('color', self.mesh.colors)
-        self.initialise_vbo('texCoord', self.mesh.textureCoords)
-        self.initialise_vbo('tangent', self.mesh.tangents)
-        self.initialise_vbo('binormal', self.mesh.binormals)
+    def bounds(self):
+        """
+        Returns the minimum and maximum corners of the bounding box of the model, in model coordinates.
+        """
+        return self.mesh.bounds_min, self.mesh.bounds_max
 
-        # if indices are provided, put them in a buffer too
-        if self.mesh.faces is not None:
-            self.index_buffer = glGenBuffers(1)
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.mesh.faces, GL_STATIC_DRAW)
+    def lod_level(self, center, radius):
+        """
+        Chooses the level of detail to draw, by default the full resolution mesh.
+        :param center: the centre of the bounding sphere of the mesh, in world coordinates
+        :param radius: the radius of the bounding sphere, in world coordinates
+        :return: the level, 0 for the full resolution mesh and i for mesh.lods[i - 1]
+        """
+        return 0
 
-        # finally we unbind the VAO and VBO when we're done to avoid side effects
-        glBindVertexArray(0)
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+    def select_geometry(self, center, radius):
+        """
+        Chooses the mesh to draw, by default the full resolution mesh.
+        :param center: the centre of the bounding sphere of the mesh, in world coordinates
+        :param radius: the radius of the bounding sphere, in world coordinates
+        :return: the (vao, mesh) pair to draw
+        """
+        return self.vao, self.mesh
+
+    def draw_depth(self):
+        """
+        Draws the model in a depth-only pass (shadow map), with a position-only program and without textures.
+        """
+        if self.depth_shader is None:
+            self.depth_shader = DepthShader()
+            self.depth_shader.define(*[flag for flag in self.shader_flags() if flag == 'INSTANCED'])
+            self.depth_shader.compile(self.attributes)
+        self.draw(shader=self.depth_shader)
+
+    def draw_layered(self):
+        """
+        Draws the model in the six faces of a layered cube map pass, with the LAYERED permutation of its shader.
+        """
+        if self.layered_shader is None:
+            self.layered_shader = self.shader.permutation('LAYERED')
+            self.layered_shader.compile(self.attributes)
+        self.draw(shader=self.layered_shader, textures=True)
 
-    def draw(self, Mp=poseMatrix()):
+    def draw(self, Mp=None, shader=None, textures=None):
         """
         Draws the model using OpenGL functions.
         :param Mp: The model matrix of the parent object, for composite objects.
-        :param shaders: the shader program to use for drawing
+        :param shader: [optional] the shader program to use instead of the model's
+        :param textures: [optional] whether to bind the textures of the mesh, by default only with the model's shader
         """
+        if textures is None:
+            textures = shader is None
 
         if self.visible:
 
             if self.mesh.vertices is None:
                 print('(W) Warning in {}.draw(): No vertex array!'.format(self.__class__.__name__))
 
+            # the transforms of the models in the scene are computed for all of them at the start of the frame
+            M, MiT, center, radius = self.scene.transforms.get(self, Mp)
+            vao, mesh = self.select_geometry(center, radius)
+
             # bind the Vertex Array Object so that all buffers are bound correctly and following operations affect them
-            glBindVertexArray(self.vao)
+            gl_state.bind_vertex_array(vao)
 
             # setup the shader program and provide it the Model, View and Projection matrices to use
             # for rendering this model
-            self.shader.bind(
+            (shader or self.shader).bind(
                 model=self,
-                M=np.matmul(Mp, self.M)
+                M=M,
+                MiT=MiT
             )
 
             # bind all textures, shader needs to handle each one with a sampler object.
-            for unit, tex in enumerate(self.mesh.textures):
-                glActiveTexture(GL_TEXTURE0 + unit)
+            for unit, tex in enumerate(self.mesh.textures if textures else []):
+                gl_state.active_texture(GL_TEXTURE0 + unit)
                 tex.bind()
 
             # check whether the data is stored as vertex array or index array
-            if self.mesh.faces is not None:
+            if mesh.faces is not None:
                 # draw the data in the buffer using the index array
-                glDrawElements(self.primitive, self.mesh.faces.flatten().shape[0], GL_UNSIGNED_INT, None)
+                glDrawElements(self.primitive, mesh.faces.size, GL_UNSIGNED_INT, None)
+                self.scene.stats['triangles'] += mesh.faces.shape[0]
+                self.scene.stats['triangles saved by LOD'] += self.mesh.faces.shape[0] - mesh.faces.shape[0]
             else:
                 # draw the data in the buffer using the vertex array ordering only.
-                glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
+                glDrawArrays(self.primitive, 0, mesh.vertices.shape[0])
 
-            # unbind the shader to avoid side effects
-            glBindVertexArray(0)
+            # the VAO stays bound, all VAO changes go through gl_state so that the next model only rebinds if needed
 
     def vbo__del__(self):
         """
@@ -202,3 +384,182 @@ class DrawModelFromMesh(BaseModel):
 
         if shader is not None:
             self.bind_shader(shader)
+
+    def lod_level(self, center, radius):
+        """
+        Chooses the level of detail from the size of the mesh bounding sphere on screen: each level is used once the
+        projected radius falls below half the size at which the previous level is used. The size is measured in the
+        main view of the frame (scene.lod_view), so that the shadow pass draws the casters with the levels of the main
+        pass, and the receivers are shadowed by their own geometry. The environment map passes measure it from the
+        distance to the probe (scene.lod_probe), the same for all the faces whether they are rendered in one layered
+        pass or one by one.
+        :param center: the centre of the bounding sphere of the mesh, in world coordinates
+        :param radius: the radius of the bounding sphere, in world coordinates
+        :return: the level, 0 for the full resolution mesh and i for mesh.lods[i - 1]
+        """
+        if len(self.lod_vaos) == 0:
+            return 0
+
+        # projected radius of the bounding sphere, as a fraction of the viewport height
+        if self.scene.lod_probe is not None:
+            position, scale = self.scene.lod_probe
+            size = radius * scale / max(np.linalg.norm(center - position), 1e-3)
+        else:
+            P, V = self.scene.lod_view or (self.scene.P, self.scene.camera.V)
+            depth = -np.dot(V[2, :3], center) - V[2, 3]
+            size = radius * abs(P[1, 1]) / max(depth, 1e-3)
+
+        level = 0
+        threshold = LOD_SCREEN_SIZE / self.scene.lod_bias
+        while level < len(self.lod_vaos) and size < threshold:
+            level += 1
+            threshold /= 2
+        return level
+
+    def select_geometry(self, center, radius):
+        """
+        Chooses the mesh to draw at the level of detail given by lod_level().
+        :param center: the centre of the bounding sphere of the mesh, in world coordinates
+        :param radius: the radius of the bounding sphere, in world coordinates
+        :return: the (vao, mesh) pair to draw
+        """
+        level = self.lod_level(center, radius)
+        if level == 0:
+            return self.vao, self.mesh
+        return self.lod_vaos[level - 1], self.mesh.lods[level - 1]
+
+
+class InstancedDrawModel(BaseModel):
+    """
+    Draws many copies of a mesh with a single draw call. The model matrix of each copy is stored in a per-instance
+    buffer, M is the parent matrix applied to all copies. The shader is compiled with the INSTANCED flag, so that its
+    vertex shader reads the matrix of each copy.
+    """
+
+    def __init__(self, scene, mesh, instances=[], M=poseMatrix(), name=None, shader=None, visible=True):
+        """
+        Initialises the model data
+        :param instances: the model matrices of the initial copies
+        """
+
+        BaseModel.__init__(self, scene=scene, M=M, mesh=mesh, visible=visible)
+
+        if name is not None:
+            self.name = name
+
+        # model matrix of each copy, indexed by the handles returned by add_instance()
+        self.instances = {}
+        self.next_handle = 0
+
+        # the instance buffer is uploaded again before drawing when instances changed
+        self.instance_buffer = None
+        self.instances_changed = True
+
+        # bounding box of all the copies, computed again when instances changed
+        self.instance_bounds = None
+
+        for matrix in instances:
+            self.add_instance(matrix)
+
+        self.bind()
+
+        if shader is not None:
+            self.bind_shader(shader)
+
+    def shader_flags(self):
+        return BaseModel.shader_flags(self) + ['INSTANCED']
+
+    def bind(self):
+        """
+        Shares the vertex buffers of the mesh, and creates the VAO reading them along with the instance buffer.
+        """
+        vertex_array = shared_vertex_array(self.scene.assets, self.mesh)
+        _, self.vbos, _, self.index_buffer = vertex_array
+        self.vao, self.attributes, self.instance_buffer = create_instanced_vertex_array(self.mesh, vertex_array)
+
+    def add_instance(self, M):
+        """
+        Adds a copy of the mesh with the given model matrix.
+        :return: the handle of the copy, for set_instance() and remove_instance()
+        """
+        handle = self.next_handle
+        self.next_handle += 1
+        self.instances[handle] = M
+        self.instances_changed = True
+        self.instance_bounds = None
+        self.content_version += 1
+        return handle
+
+    def set_instance(self, handle, M):
+        """
+        Moves a copy of the mesh.
+        """
+        self.instances[handle] = M
+        self.instances_changed = True
+        self.instance_bounds = None
+        self.content_version += 1
+
+    def remove_instance(self, handle):
+        """
+        Removes a copy of the mesh.
+        """
+        if self.instances.pop(handle, None) is None:
+            print('(W) Warning in {}.remove_instance(): no instance {}'.format(self.__class__.__name__, handle))
+        self.instances_changed = True
+        self.instance_bounds = None
+        self.content_version += 1
+
+    def bounds(self):
+        """
+        Returns the bounding box of all the copies, in the coordinates of the parent matrix M.
+        """
+        if len(self.instances) == 0:
+            return BaseModel.bounds(self)
+
+        if self.instance_bounds is None:
+            matrices = np.array(list(self.instances.values()), 'f')
+            count = matrices.shape[0]
+            mins, maxs = transform_boxes(matrices, np.tile(self.mesh.bounds_min, (count, 1)),
+                                         np.tile(self.mesh.bounds_max, (count, 1)))
+            self.instance_bounds = mins.min(axis=0), maxs.max(axis=0)
+        return self.instance_bounds
+
+    def update_instances(self):
+        """
+        Uploads the model matrices of the copies to the instance buffer.
+        """
+        if len(self.instances) > 0:
+            glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+            glBufferData(GL_ARRAY_BUFFER, instance_data(list(self.instances.values())), GL_DYNAMIC_DRAW)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.instances_changed = False
+
+    def draw(self, Mp=None, shader=None, textures=None):
+        """
+        Draws all the copies of the mesh with one call.
+        :param Mp: The model matrix of the parent object, for composite objects.
+        :param shader: [optional] the shader program to use instead of the model's
+        :param textures: [optional] whether to bind the textures of the mesh, by default only with the model's shader
+        """
+        if textures is None:
+            textures = shader is None
+
+        if not self.visible or len(self.instances) == 0:
+            return
+
+        if self.instances_changed:
+            self.update_instances()
+
+        gl_state.bind_vertex_array(self.vao)
+
+        # the shader uniforms hold the parent matrix, the vertex shader applies the matrix of each copy
+        M, MiT, _, _ = self.scene.transforms.get(self, Mp)
+        (shader or self.shader).bind(model=self, M=M, MiT=MiT)
+
+        for unit, tex in enumerate(self.mesh.textures if textures else []):
+            gl_state.active_texture(GL_TEXTURE0 + unit)
+            tex.bind()
+
+        glDrawElementsInstanced(self.primitive, self.mesh.faces.size, GL_UNSIGNED_INT, None, len(self.instances))
+        self.scene.stats['triangles'] += self.mesh.faces.shape[0] * len(self.instances)
+        self.scene.stats['instances'] += len(self.instances)
@@ -6,6 +6,8 @@ from BaseModel import DrawModelFromMesh
 from shaders import BaseShaderProgram, PhongShader
 from texture import Texture
 from framebuffer import Framebuffer
+from frameUniforms import frame_uniforms
+from glState import gl_state
 
 
 def normalize(v):
@@ -43,28 +45,30 @@ class ShowTextureShader(BaseShaderProgram):
 
 
 class ShadowMappingShader(PhongShader):
-    def __init__(self, shadow_map=None):
-        PhongShader.__init__(self, name='shadow_mapping')
+    def __init__(self, shadow_map=None, name='shadow_mapping', vertex_shader=None, fragment_shader=None):
+        PhongShader.__init__(self, name=name, vertex_shader=vertex_shader, fragment_shader=fragment_shader)
         self.add_uniform('shadow_map')
-        self.add_uniform('shadow_map_matrix')
         self.shadow_map = shadow_map
 
-    def bind(self, model, M):
-        PhongShader.bind(self, model, M)
+        # without a shadow map, the permutation without the shadow lookup is used
+        if shadow_map is not None:
+            self.define('SHADOWED')
+
+    def bind(self, model, M, MiT=None):
+        PhongShader.bind(self, model, M, MiT)
+        if self.shadow_map is None:
+            return
+
         self.uniforms['shadow_map'].bind(1)
 
-        glActiveTexture(GL_TEXTURE1)
+        gl_state.active_texture(GL_TEXTURE1)
         self.shadow_map.bind()
 
-        glActiveTexture(GL_TEXTURE0)
+        gl_state.active_texture(GL_TEXTURE0)
 
-        # setup the shadow map matrix
-        VsT = np.linalg.inv(model.scene.camera.V)
-        self.SM = np.matmul(self.shadow_map.V, VsT)
-        self.SM = np.matmul(self.shadow_map.P, self.SM)
-        self.SM = np.matmul(translationMatrix([1, 1, 1]), self.SM)
-        self.SM = np.matmul(scaleMatrix(0.5), self.SM)
-        self.uniforms['shadow_map_matrix'].bind(self.SM)
+    def bind_frame_uniforms(self, model):
+        # the shadow map matrix is part of the per-frame data
+        frame_uniforms.update(model.scene, shadow_map=self.shadow_map)
 
 
 class ShowTexture(DrawModelFromMesh):
@@ -111,12 +115,33 @@ class ShowTexture(DrawModelFromMesh):
         DrawModelFromMesh.__init__(self, scene=scene, M=poseMatrix(position=[0, 0, 1]), mesh=mesh,
                                    shader=ShowTextureShader(), visible=False)
 
+        # the debug quad is drawn on top of the scene, in the order given
+        self.ordered = True
+
 
 class ShadowMap(Texture):
-    def __init__(self, light=None, width=1000, height=1000):
+    """
+    Depth texture rendered from the light. It is only rendered again when something it depends on changed: the light,
+    the projection, the casters in the scene, or their transforms. The depth of the static casters is kept in a
+    separate layer, copied into the shadow map before drawing the casters that are not static over it, so that moving
+    models do not make the static ones render again.
+    """
+
+    def __init__(self, light=None, width=1000, height=1000, cull_front_faces=False, polygon_offset=None,
+                 static_layer=True):
+        """
+        :param cull_front_faces: whether to draw only the back faces of the casters, which moves the depth away from
+        the lit surfaces (for closed meshes only)
+        :param polygon_offset: [optional] the (factor, units) depth offset of the casters, against shadow acne
+        :param static_layer: whether to create the layer caching the depth of the static casters
+        """
         # save the light source
         self.light = light
 
+        # rasterisation settings of the depth pass
+        self.cull_front_faces = cull_front_faces
+        self.polygon_offset = polygon_offset
+
         # copy and modify the code here
         self.name = 'shadow'
         self.format = GL_DEPTH_COMPONENT
@@ -145,24 +170,93 @@ class ShadowMap(Texture):
 
         self.V = None
 
-    def render(self, scene, target=[0, 0, 0]):
-        # backup the view matrix and replace with the new one
+        # depth of the static casters, and what the layer and the shadow map were last rendered with
+        self.static_layer = ShadowMap(width=width, height=height, static_layer=False) if static_layer else None
+        self.static_state = None
+        self.state = None
 
-        if self.light is not None:
-            self.P = frustumMatrix(-1.0, +1.0, -1.0, +1.0, 1.0, 20.0)
-            self.V = lookAt(np.array(self.light.position), np.array(target))
-            scene.camera.V = self.V
+    def caster_state(self, scene, casters):
+        """
+        Returns what the depth of the casters depends on, to compare with the last rendering: their transforms, their
+        content (the copies of instanced models) and the levels of detail the main view selects for them.
+        """
+        versions = scene.transforms.versions
+        return tuple((id(model), versions.get(id(model)), model.content_version,
+                      model.lod_level(*scene.transforms.get(model)[2:])) for model in casters)
+
+    def draw_casters(self, scene, casters, clear):
+        """
+        Draws casters in the depth buffer of this map, from the light.
+        :param clear: whether to clear the depth buffer first
+        """
+        self.fbo.bind()
+        if clear:
+            glClear(GL_DEPTH_BUFFER_BIT)
+        scene.draw_shadow_map(casters)
+        self.fbo.unbind()
 
-            # update the viewport for the image size
-            glViewport(0, 0, self.width, self.height)
+    def render(self, scene, target=[0, 0, 0]):
+        """
+        Renders the shadow map, if the light, the projection or the casters changed since the last call.
+        """
+        if self.light is None:
+            return
 
-            self.fbo.bind()
-            scene.draw_shadow_map()
-            self.fbo.unbind()
+        casters = [model for model in scene.models if model.casts_shadows and model.visible]
+        static = [model for model in casters if model.static]
+        dynamic = [model for model in casters if not model.static]
 
-            # reset the viewport to the windows size
-            glViewport(0, 0, scene.window_size[0], scene.window_size[1])
+        static_state = (self.light.version, tuple(target), scene.P.tobytes(), self.caster_state(scene, static))
+        state = (static_state, self.caster_state(scene, dynamic))
+        if state == self.state:
+            scene.stats['shadow map reused'] += 1
+            return
+        self.state = state
 
-            # restore the view matrix
-            scene.camera.V = None
-            scene.camera.update()
+        # backup the view matrix and replace with the new one
+        self.P = frustumMatrix(-1.0, +1.0, -1.0, +1.0, 1.0, 20.0)
+        self.V = lookAt(np.array(self.light.position), np.array(target))
+        scene.camera.V = self.V
+
+        # update the viewport for the image size
+        glViewport(0, 0, self.width, self.height)
+
+        # the shadow map only stores depth
+        glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        if self.cull_front_faces:
+            glEnable(GL_CULL_FACE)
+            glCullFace(GL_FRONT)
+        if self.polygon_offset is not None:
+            glEnable(GL_POLYGON_OFFSET_FILL)
+            glPolygonOffset(*self.polygon_offset)
+
+        if self.static_layer is None:
+            self.draw_casters(scene, casters, clear=True)
+        else:
+            if static_state != self.static_state:
+                self.static_layer.draw_casters(scene, static, clear=True)
+                self.static_state = static_state
+                scene.stats['shadow static layer rendered'] += 1
+
+            # start from the depth of the static casters, and draw the others over it
+            glBindFramebuffer(GL_READ_FRAMEBUFFER, self.static_layer.fbo.fbo)
+            glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.fbo.fbo)
+            glBlitFramebuffer(0, 0, self.width, self.height, 0, 0, self.width, self.height, GL_DEPTH_BUFFER_BIT,
+                              GL_NEAREST)
+            glBindFramebuffer(GL_FRAMEBUFFER, 0)
+            self.draw_casters(scene, dynamic, clear=False)
+        scene.stats['shadow map rendered'] += 1
+
+        if self.polygon_offset is not None:
+            glDisable(GL_POLYGON_OFFSET_FILL)
+        if self.cull_front_faces:
+            glCullFace(GL_BACK)
+            glDisable(GL_CULL_FACE)
+        glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+
+        # reset the viewport to the windows size
+        glViewport(0, 0, scene.window_size[0], scene.window_size[1])
+
+        # restore the view matrix
+        scene.camera.V = None
+        scene.camera.update()
@@ -0,0 +1,178 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from BaseModel import create_vertex_array
+from blender import load_mesh_arrays, load_obj_file
+from mesh import Mesh
+from meshCache import CACHE_DIR
+from texture import DecodedImage
+from textureManager import texture_path
+
+
+def mesh_bytes(mesh):
+    """
+    Returns the size in bytes of the vertex data of a mesh, which is also the size of its GPU buffers.
+    """
+    arrays = [mesh.vertices, mesh.faces, mesh.normals, mesh.colors, mesh.textureCoords, mesh.tangents,
+              mesh.binormals]
+    return sum(array.nbytes for array in arrays if array is not None)
+
+
+def compile_asset(file_name, cache_dir=CACHE_DIR):
+    """
+    Reads an OBJ file. This does not use OpenGL, so that it can run in a worker process. The textures of the materials
+    are not decoded here, as files often share images: AssetRegistry.preload() decodes each image once.
+    :return: the list of mesh dictionaries (with plain numpy arrays)
+    """
+    meshes = load_mesh_arrays(file_name, cache_dir)
+
+    # convert memory-mapped arrays so that they can be sent back to the main process
+    for mesh in meshes:
+        for arrays in [mesh] + mesh['lods']:
+            for name, value in arrays.items():
+                if isinstance(value, np.ndarray):
+                    arrays[name] = np.array(value)
+
+    return meshes
+
+
+class AssetRegistry:
+    """
+    Class for sharing assets between the models of a scene: meshes are loaded once per file, and the vertex buffers
+    and Vertex Array Object of a mesh are created once, so that placing another copy of a model only costs a new
+    model matrix.
+    """
+
+    def __init__(self):
+        # meshes loaded from each file, and the number of times they were handed out
+        self.meshes = {}
+        self.mesh_users = {}
+
+        # GPU buffers for each mesh, indexed by the mesh id (the mesh is kept to ensure the id stays valid),
+        # and the number of models using them
+        self.vertex_arrays = {}
+        self.vertex_array_users = {}
+
+        # statistics
+        self.mesh_hits = 0
+        self.mesh_misses = 0
+        self.buffer_hits = 0
+        self.buffer_misses = 0
+        self.bytes_saved = 0
+        self.gpu_bytes_saved = 0
+
+    def load_obj_file(self, file_name):
+        """
+        Returns the meshes in a Blender3D object file, loading it only the first time it is requested.
+        """
+        key = os.path.normpath(file_name)
+
+        if key not in self.meshes:
+            self.mesh_misses += 1
+            self.meshes[key] = load_obj_file(file_name)
+            self.mesh_users[key] = 0
+
+        if self.mesh_users[key] > 0:
+            self.mesh_hits += 1
+            self.bytes_saved += sum(mesh_bytes(mesh) for mesh in self.meshes[key])
+            print('Reusing mesh(es) from {}'.format(file_name))
+
+        self.mesh_users[key] += 1
+        return self.meshes[key]
+
+    def preload(self, file_names, workers=None, cache_dir=CACHE_DIR):
+        """
+        Loads OBJ files in a pool of worker processes. The workers parse the files, then decode the textures they use,
+        each image once however many files use it; as results arrive, the main thread (which owns the OpenGL context)
+        only creates the meshes and uploads their textures and vertex buffers. Later calls to load_obj_file() for these
+        files return the preloaded meshes.
+        :param file_names: the OBJ files to load
+        :param workers: the number of worker processes, by default the number of CPUs
+        :param cache_dir: the directory of the compiled mesh cache, or None to always parse the files
+        """
+        keys = {os.path.normpath(file_name): file_name for file_name in file_names}
+        keys = {key: file_name for key, file_name in keys.items() if key not in self.meshes}
+        if len(keys) == 0:
+            return
+
+        start = time.perf_counter()
+
+        # decoding of the images by resolved path, and the mesh arrays of each file waiting for their images
+        images = {}
+        waiting = {}
+
+        # use fresh interpreters rather than forking the process holding the OpenGL context
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = {pool.submit(compile_asset, file_name, cache_dir): key for key, file_name in keys.items()}
+
+            while len(futures) > 0:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = futures.pop(future)
+                    if key not in keys:
+                        # a decoded image, the meshes are created below
+                        continue
+
+                    waiting[key] = future.result()
+                    for mesh in waiting[key]:
+                        texture = mesh['material'].texture
+                        if texture is not None and texture_path(texture) not in images:
+                            images[texture_path(texture)] = pool.submit(DecodedImage, texture)
+                            futures[images[texture_path(texture)]] = texture_path(texture)
+
+                # create the meshes of the files whose images are all decoded
+                for key in list(waiting.keys()):
+                    textures = [mesh['material'].texture for mesh in waiting[key]]
+                    if not all(images[texture_path(texture)].done() for texture in textures if texture is not None):
+                        continue
+
+                    arrays = waiting.pop(key)
+                    meshes = [Mesh(**mesh, textureImage=images[texture_path(mesh['material'].texture)].result()
+                                   if mesh['material'].texture is not None else None) for mesh in arrays]
+                    for mesh in [lod for mesh in meshes for lod in [mesh] + mesh.lods]:
+                        self.vertex_arrays[id(mesh)] = (mesh, create_vertex_array(mesh))
+                        self.vertex_array_users[id(mesh)] = 0
+                        self.buffer_misses += 1
+
+                    self.mesh_misses += 1
+                    self.meshes[key] = meshes
+                    self.mesh_users[key] = 0
+                    print('Preloaded {} mesh(es) from {}'.format(len(meshes), keys[key]))
+
+        print('Preloaded {} file(s) and decoded {} image(s) in {:.2f}s'.format(
+            len(keys), len(images), time.perf_counter() - start))
+
+    def get_vertex_array(self, mesh):
+        """
+        Returns the (vao, vbos, attributes, index_buffer) tuple created for this mesh, or None if it was not bound yet.
+        """
+        if id(mesh) not in self.vertex_arrays:
+            self.buffer_misses += 1
+            return None
+
+        if self.vertex_array_users[id(mesh)] > 0:
+            self.buffer_hits += 1
+            self.gpu_bytes_saved += mesh_bytes(mesh)
+
+        self.vertex_array_users[id(mesh)] += 1
+        return self.vertex_arrays[id(mesh)][1]
+
+    def add_vertex_array(self, mesh, vertex_array):
+        """
+        Stores the (vao, vbos, attributes, index_buffer) tuple created for this mesh, to be shared by other models.
+        """
+        self.vertex_arrays[id(mesh)] = (mesh, vertex_array)
+        self.vertex_array_users[id(mesh)] = 1
+
+    def report(self):
+        """
+        Prints the number of reused assets and the memory saved.
+        """
+        print('Assets: meshes {} hit(s) / {} miss(es), vertex arrays {} hit(s) / {} miss(es)'.format(
+            self.mesh_hits, self.mesh_misses, self.buffer_hits, self.buffer_misses))
+        print('Assets: saved {:.1f} MB of mesh data and {:.1f} MB of GPU buffers'.format(
+            self.bytes_saved / 2 ** 20, self.gpu_bytes_saved / 2 ** 20))
@@ -0,0 +1,235 @@
+import argparse
+import contextlib
+import glob
+import io
+import time
+
+import numpy as np
+
+'''
+Benchmarks for the loading and rendering code, run with:
+python benchmark.py <benchmark> [options]
+'''
+
+
+def timed(function, *args, repeat=3):
+    """
+    Runs the function several times with its output silenced.
+    :return: the result of the last call and the best time in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function(*args)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def compare_mesh_arrays(meshes_a, meshes_b):
+    """
+    Compares two lists of mesh dictionaries (as returned by the OBJ readers) corner by corner, since the readers
+    may index vertices differently.
+    :return: whether the faces have the same positions and materials, and the number of face corners with different
+    texture coordinates.
+    """
+    if len(meshes_a) != len(meshes_b):
+        return False, 0
+    different_uvs = 0
+    for a, b in zip(meshes_a, meshes_b):
+        if a['material'].name != b['material'].name or a['faces'].shape != b['faces'].shape:
+            return False, 0
+        if not np.array_equal(a['vertices'][a['faces']], b['vertices'][b['faces']]):
+            return False, 0
+        if (a['textureCoords'] is None) != (b['textureCoords'] is None):
+            return False, 0
+        if a['textureCoords'] is not None:
+            uv_a = a['textureCoords'][a['faces']]
+            uv_b = b['textureCoords'][b['faces']]
+            different_uvs += np.sum(np.any(uv_a != uv_b, axis=2))
+    return True, different_uvs
+
+
+def benchmark_obj_parser(files, repeat=3):
+    """
+    Compares the line-by-line OBJ reader with the vectorised one on the given files. The last column counts the
+    face corners whose texture coordinates were wrong in the line-by-line reader (shared vertices along seams).
+    """
+    from blender import read_obj_file, read_obj_file_by_line
+
+    print('{:<28} {:>8} {:>10} {:>10} {:>8} {:>6} {:>8}'.format(
+        'file', 'meshes', 'by line', 'bulk', 'speedup', 'same', 'seams'))
+    total_line = total_bulk = 0.
+    for file_name in files:
+        reference, t_line = timed(read_obj_file_by_line, file_name, repeat=repeat)
+        meshes, t_bulk = timed(read_obj_file, file_name, repeat=repeat)
+        total_line += t_line
+        total_bulk += t_bulk
+        same, seams = compare_mesh_arrays(reference, meshes)
+        print('{:<28} {:>8} {:>9.1f}ms {:>9.1f}ms {:>7.1f}x {:>6} {:>8}'.format(
+            file_name, len(meshes), 1000 * t_line, 1000 * t_bulk, t_line / t_bulk, 'yes' if same else 'NO', seams))
+    print('{:<28} {:>8} {:>9.1f}ms {:>9.1f}ms {:>7.1f}x'.format(
+        'total', '', 1000 * total_line, 1000 * total_bulk, total_line / total_bulk))
+
+
+def benchmark_normals(files, repeat=3):
+    """
+    Compares the face by face normal and tangent computation with the vectorised one on the meshes of the given
+    files.
+    """
+    from blender import read_obj_file
+    from mesh import calculate_normals, calculate_normals_by_face
+
+    # the last column counts the normals that differ, which only happens for degenerate sums that the float32
+    # accumulation of the face by face version does not cancel exactly. The tangents and binormals are not compared:
+    # the face by face version is the original code, whose wrong second UV edge calculate_normals() fixes
+    print('{:<28} {:>8} {:>10} {:>10} {:>8} {:>6}'.format('file', 'faces', 'by face', 'bulk', 'speedup', 'diff'))
+    total_face = total_bulk = 0.
+    for file_name in files:
+        meshes, _ = timed(read_obj_file, file_name, repeat=1)
+        nfaces = sum(mesh['faces'].shape[0] for mesh in meshes)
+        t_face = t_bulk = 0.
+        different = 0
+        for mesh in meshes:
+            arguments = (mesh['vertices'], mesh['faces'], mesh['textureCoords'])
+            # the original code divides the sums of length zero, giving NaNs
+            with np.errstate(divide='ignore', invalid='ignore'):
+                reference, t = timed(calculate_normals_by_face, *arguments, repeat=repeat)
+                t_face += t
+                result, t = timed(calculate_normals, *arguments, repeat=repeat)
+                t_bulk += t
+                different += np.sum(np.abs(reference[0] - result[0]).max(axis=1) > 1e-4)
+        total_face += t_face
+        total_bulk += t_bulk
+        print('{:<28} {:>8} {:>9.1f}ms {:>9.1f}ms {:>7.1f}x {:>6}'.format(
+            file_name, nfaces, 1000 * t_face, 1000 * t_bulk, t_face / t_bulk, different))
+    print('{:<28} {:>8} {:>9.1f}ms {:>9.1f}ms {:>7.1f}x'.format(
+        'total', '', 1000 * total_face, 1000 * total_bulk, total_face / total_bulk))
+
+
+def benchmark_vertex_cache(files, cache_size=16):
+    """
+    Reports the vertex cache efficiency of the meshes of the given files before and after optimisation: ACMR
+    (average cache miss ratio, transformed vertices per triangle) and ATVR (transformed vertices per vertex).
+    """
+    from blender import read_obj_file
+    from meshOptimizer import optimize_mesh_arrays, vertex_cache_misses
+
+    def cache_ratios(meshes):
+        nfaces = sum(mesh['faces'].shape[0] for mesh in meshes)
+        nvertices = sum(np.unique(mesh['faces']).shape[0] for mesh in meshes)
+        misses = sum(vertex_cache_misses(mesh['faces'], cache_size)[0] * mesh['faces'].shape[0] for mesh in meshes)
+        return misses / nfaces, misses / nvertices
+
+    print('{:<28} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10}'.format(
+        'file', 'faces', 'ACMR', 'ACMR opt', 'ATVR', 'ATVR opt', 'time'))
+    for file_name in files:
+        meshes, _ = timed(read_obj_file, file_name, repeat=1)
+        acmr, atvr = cache_ratios(meshes)
+        _, t = timed(lambda: [optimize_mesh_arrays(mesh, cache_size) for mesh in meshes], repeat=1)
+        acmr_opt, atvr_opt = cache_ratios(meshes)
+        print('{:<28} {:>8} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.1f}ms'.format(
+            file_name, sum(mesh['faces'].shape[0] for mesh in meshes), acmr, acmr_opt, atvr, atvr_opt, 1000 * t))
+
+
+def benchmark_transforms(counts, repeat=100):
+    """
+    Compares computing the model transforms one model at a time (PVM, VM and the inverse-transpose of VM, as the
+    shaders used to) with the batched TransformStage, for scenes with the given numbers of models.
+    """
+    from types import SimpleNamespace
+
+    from matutils import frustumMatrix, poseMatrix
+    from transformStage import TransformStage
+
+    P = frustumMatrix(-1.0, 1.0, -1.0, 1.0, 1.0, 20.0)
+    V = poseMatrix(position=[0, -3, -5])
+    rng = np.random.default_rng(0)
+
+    def per_model(models):
+        for model in models:
+            np.matmul(P, np.matmul(V, model.M))
+            np.matmul(V, model.M)
+            np.linalg.inv(np.matmul(V, model.M))[:3, :3].transpose()
+
+    print('{:>8} {:>12} {:>12} {:>8}'.format('models', 'per model', 'batched', 'speedup'))
+    for count in counts:
+        models = [SimpleNamespace(M=poseMatrix(position=rng.normal(size=3), scale=rng.uniform(0.1, 2)),
+                                  mesh=SimpleNamespace(center=np.zeros(3, 'f'), radius=1.))
+                  for _ in range(count)]
+        stage = TransformStage()
+        _, t_model = timed(lambda: [per_model(models) for _ in range(repeat)], repeat=3)
+        _, t_stage = timed(lambda: [stage.update(models) for _ in range(repeat)], repeat=3)
+        print('{:>8} {:>10.1f}us {:>10.1f}us {:>7.1f}x'.format(
+            count, 1e6 * t_model / repeat, 1e6 * t_stage / repeat, t_model / t_stage))
+
+
+def benchmark_environment(policies, frames=200):
+    """
+    Measures the frame time of the street scene with each update policy of the environment map, after a first frame
+    rendering the six faces. This opens the OpenGL window of the scene, so it needs a display.
+    """
+    from OpenGL.GL import glFinish
+
+    from main import Street
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        scene = Street(baked_probes=False)
+
+    print('{:>12} {:>10} {:>8} {:>8}'.format('policy', 'frame', 'faces', 'speedup'))
+    reference = None
+    for policy in policies:
+        scene.environment.set_policy(policy)
+        scene.draw()
+        glFinish()
+
+        scene.stats.clear()
+        start = time.perf_counter()
+        for _ in range(frames):
+            scene.draw()
+        glFinish()
+        elapsed = (time.perf_counter() - start) / frames
+
+        reference = reference or elapsed
+        print('{:>12} {:>8.2f}ms {:>8.2f} {:>7.1f}x'.format(
+            policy, 1000 * elapsed, scene.stats['environment faces rendered'] / frames, reference / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the street scene.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    obj_parser = subparsers.add_parser('obj', help='compare the line-by-line and vectorised OBJ readers')
+    obj_parser.add_argument('files', nargs='*', default=sorted(glob.glob('models/*.obj')))
+    obj_parser.add_argument('--repeat', type=int, default=3)
+
+    normals_parser = subparsers.add_parser('normals', help='compare the face by face and vectorised normals')
+    normals_parser.add_argument('files', nargs='*', default=sorted(glob.glob('models/*.obj')))
+    normals_parser.add_argument('--repeat', type=int, default=3)
+
+    vcache_parser = subparsers.add_parser('vcache', help='vertex cache efficiency before and after optimisation')
+    vcache_parser.add_argument('files', nargs='*', default=sorted(glob.glob('models/*.obj')))
+    vcache_parser.add_argument('--cache-size', type=int, default=16)
+
+    transforms_parser = subparsers.add_parser('transforms', help='compare per-model and batched transforms')
+    transforms_parser.add_argument('counts', nargs='*', type=int, default=[10, 50, 100, 500])
+    transforms_parser.add_argument('--repeat', type=int, default=100)
+
+    environment_parser = subparsers.add_parser('environment', help='frame time of the environment map policies')
+    environment_parser.add_argument('policies', nargs='*', default=['every-frame', 'static', 'on-change',
+                                                                    'round-robin'])
+    environment_parser.add_argument('--frames', type=int, default=200)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'obj':
+        benchmark_obj_parser(args.files, repeat=args.repeat)
+    elif args.benchmark == 'normals':
+        benchmark_normals(args.files, repeat=args.repeat)
+    elif args.benchmark == 'vcache':
+        benchmark_vertex_cache(args.files, cache_size=args.cache_size)
+    elif args.benchmark == 'transforms':
+        benchmark_transforms(args.counts, repeat=args.repeat)
+    elif args.benchmark == 'environment':
+        benchmark_environment(args.policies, frames=args.frames)
@@ -1,7 +1,10 @@
 import numpy as np
 
 from material import Material, MaterialLibrary
-from mesh import Mesh
+from mesh import Mesh, calculate_normals
+from meshCache import CACHE_DIR, load_cached
+from meshOptimizer import optimize_mesh_arrays
+from meshSimplifier import build_lods
 
 '''
 Functions for reading models from blender. 
@@ -124,9 +127,210 @@ def load_material_library(file_name):
     return library
 
 
-def load_obj_file(file_name):
+def load_obj_file(file_name, cache_dir=CACHE_DIR, optimize=True, lods=True):
     """
     Function for loading a Blender3D object file.
+    :param file_name: the name of the obj file
+    :param cache_dir: the directory of the compiled mesh cache (see meshCache.py), or None to always parse the file
+    :param optimize: whether to reorder the meshes for the GPU vertex caches (see meshOptimizer.py)
+    :param lods: whether to build simplified levels of detail of the meshes (see meshSimplifier.py)
+    """
+    return [Mesh(**arrays) for arrays in load_mesh_arrays(file_name, cache_dir, optimize, lods)]
+
+
+def load_mesh_arrays(file_name, cache_dir=CACHE_DIR, optimize=True, lods=True):
+    """
+    Returns the compiled mesh dictionaries of a Blender3D object file, from the cache if possible.
+    See load_obj_file() for the parameters.
+    """
+    if cache_dir is None:
+        return compile_obj_file(file_name, optimize, lods)
+
+    return load_cached(file_name, lambda name: compile_obj_file(name, optimize, lods), cache_dir,
+                       compile_options(optimize, lods))
+
+
+def compile_options(optimize=True, lods=True):
+    """
+    Returns the string describing the compile_obj_file() options, used to key the mesh cache.
+    """
+    return ' '.join(name for name, enabled in [('optimize', optimize), ('lods', lods)] if enabled)
+
+
+def compile_obj_file(file_name, optimize=True, lods=True):
+    """
+    Reads a Blender3D object file and computes the normals, tangents and binormals of each mesh, so that the
+    resulting arrays are final and can be stored in the mesh cache.
+    :param optimize: whether to reorder the triangles and vertices for the GPU vertex caches
+    :param lods: whether to build simplified levels of detail, stored in the 'lods' list of each mesh
+    :return: a list of dictionaries holding the Mesh arguments for each mesh in the file.
+    """
+    meshes = read_obj_file(file_name)
+    for mesh in meshes:
+        # normals provided in the file are kept, in which case the calculation is only needed for the tangents
+        if mesh['normals'] is None or mesh['textureCoords'] is not None:
+            normals, mesh['tangents'], mesh['binormals'] = calculate_normals(
+                mesh['vertices'], mesh['faces'], mesh['textureCoords'])
+            if mesh['normals'] is None:
+                mesh['normals'] = normals
+
+        mesh['lods'] = build_lods(mesh) if lods else []
+
+        if optimize:
+            for arrays in [mesh] + mesh['lods']:
+                optimize_mesh_arrays(arrays)
+
+    return meshes
+
+
+def read_obj_file(file_name):
+    """
+    Reads a Blender3D object file in bulk: the file is read once, records are grouped by their keyword and each
+    group is converted to arrays with vectorised NumPy calls. Unlike read_obj_file_by_line(), vertices are split
+    where faces use them with different texture coordinates or normals (see create_mesh_arrays()).
+    :param file_name: the name of the obj file
+    :return: a list of dictionaries holding the Mesh arguments for each mesh in the file.
+    """
+    print('Loading mesh(es) from Blender file: {}'.format(file_name))
+
+    with open(file_name) as objfile:
+        records = [line.split(None, 1) for line in objfile.read().splitlines()]
+
+    # keyword of each line (empty lines get an empty keyword)
+    keywords = np.array([record[0] if record else '' for record in records])
+
+    # each material indicates a new mesh in the file, so the mesh id of a line is the number of materials before it
+    mesh_ids = np.cumsum(keywords == 'usemtl')
+
+    # material libraries and materials are few, handle them in order
+    library = None
+    materials = {}
+    for line_nb in np.flatnonzero((keywords == 'mtllib') | (keywords == 'usemtl')):
+        fields = records[line_nb][1].split() if len(records[line_nb]) > 1 else []
+        if len(fields) != 1:
+            print('(E) Error, material file name missing')
+        elif keywords[line_nb] == 'mtllib':
+            library = load_material_library('models/{}'.format(fields[0]))
+        else:
+            materials[mesh_ids[line_nb]] = library.names[fields[0]]
+            print('[l.{}] Loading mesh with material: {}'.format(line_nb + 1, fields[0]))
+
+    varray = read_float_records(records, np.flatnonzero(keywords == 'v'), 3, 'vertex').astype('f')
+    tarray = read_float_records(records, np.flatnonzero(keywords == 'vt'), 2, 'vertex texture').astype('f')
+    narray = read_float_records(records, np.flatnonzero(keywords == 'vn'), 3, 'vertex normal').astype('f')
+
+    face_lines = np.flatnonzero(keywords == 'f')
+    farray, ncomponents, face_lines = read_face_records(records, face_lines)
+    face_mesh_ids = mesh_ids[face_lines]
+
+    print('File read. Found {} vertices and {} faces.'.format(varray.shape[0], farray.shape[0]))
+
+    # a new mesh starts wherever the mesh id changes between consecutive faces
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(face_mesh_ids)) + 1, [farray.shape[0]]))
+
+    meshes = []
+    for fstart, fend in zip(bounds[:-1], bounds[1:]):
+        k = np.unique(ncomponents[fstart:fend])
+        if k.shape[0] != 1:
+            raise ValueError('(E) Error, inconsistent face indexing in mesh starting at line {}'.format(
+                face_lines[fstart] + 1))
+        material = materials.get(face_mesh_ids[fstart])
+        print('Creating new mesh, faces %i-%i, line %i, with material %s' % (
+            fstart, fend, face_lines[fstart] + 1, material))
+        meshes.append(create_mesh_arrays(varray, tarray, narray, farray[fstart:fend, :, :k[0]], library, material))
+
+    print('--- Created {} mesh(es) from Blender file.'.format(len(meshes)))
+    return meshes
+
+
+def read_float_records(records, lines, size, label):
+    """
+    Converts the records at the given lines into a (n, size) array of floats. Records with the wrong number of
+    entries are skipped, as process_line() does.
+    """
+    fields = [records[line][1].split() if len(records[line]) > 1 else [] for line in lines]
+    valid = np.array([len(f) == size for f in fields], dtype=bool)
+    if not valid.all():
+        print('(E) Error, {} entries expected for {}, skipping {} line(s)'.format(size, label, np.sum(~valid)))
+        fields = [f for f, ok in zip(fields, valid) if ok]
+
+    return np.array([token for f in fields for token in f], dtype=np.float64).reshape(-1, size)
+
+
+def read_face_records(records, lines):
+    """
+    Converts face records into an array of triangles, splitting quads into pairs of triangles.
+    Faces with other than 3 or 4 vertices are skipped, as process_line() does.
+    :return: the (n, 3, k) uint32 array of v/vt/vn indices padded with zeros, the number of indices k used by each
+    triangle and the file line of each triangle.
+    """
+    fields = [records[line][1].split() if len(records[line]) > 1 else [] for line in lines]
+    nverts = np.array([len(f) for f in fields], dtype=np.intp)
+    valid = (nverts == 3) | (nverts == 4)
+    if not valid.all():
+        print('(E) Error, 3 or 4 entries expected for faces, skipping {} line(s)'.format(np.sum(~valid)))
+        fields = [f for f, ok in zip(fields, valid) if ok]
+        lines = lines[valid]
+        nverts = nverts[valid]
+
+    # number of indices (v, v/vt or v/vt/vn) of each face
+    ncomponents = np.array([f[0].count('/') + 1 for f in fields], dtype=np.intp)
+    kmax = ncomponents.max(initial=1)
+
+    # fill a (faces, 4, kmax) array, row by row, with the indices of each face
+    polygons = np.zeros((len(fields), 4, kmax), dtype=np.uint32)
+    for k in np.unique(ncomponents):
+        selected = np.flatnonzero(ncomponents == k)
+        # a missing texture index (v//vn) is stored as 0
+        tokens = ' '.join(' '.join(fields[i]) for i in selected).replace('//', '/0/').replace('/', ' ').split()
+        mask = np.arange(4)[np.newaxis, :] < nverts[selected, np.newaxis]
+        block = np.zeros((selected.shape[0], 4, k), dtype=np.uint32)
+        block[mask] = np.array(tokens, dtype=np.uint32).reshape(-1, k)
+        polygons[selected, :, :k] = block
+
+    # converts quads into pairs of triangles (0,1,2) and (0,2,3), keeping the file order
+    triangles = np.stack((polygons[:, [0, 1, 2]], polygons[:, [0, 2, 3]]), axis=1).reshape(-1, 3, kmax)
+    keep = np.stack((np.ones(nverts.shape[0], dtype=bool), nverts == 4), axis=1).ravel()
+
+    return triangles[keep], np.repeat(ncomponents, nverts - 2), np.repeat(lines, nverts - 2)
+
+
+def create_mesh_arrays(varray, tarray, narray, farray, library, material):
+    """
+    Builds the OpenGL vertex arrays for one mesh of the file. OpenGL uses a single index per vertex, so each
+    distinct (v, vt, vn) triple used by the faces becomes one vertex: vertices shared by faces with different texture
+    coordinates or normals (eg along texture seams) are split.
+    :param farray: the (n, 3, k) array of 1-based v/vt/vn indices for the faces of this mesh, 0 where missing.
+    """
+    corners = farray.reshape(-1, farray.shape[2]).astype(np.int64)
+
+    # only use texture coordinates and normals if all corners of the mesh have them
+    has_textures = corners.shape[1] > 1 and np.all(corners[:, 1] > 0)
+    has_normals = corners.shape[1] > 2 and np.all(corners[:, 2] > 0)
+    if not has_textures:
+        print('(W) No texture indices provided, setting texture coordinate array as None!')
+
+    # pack the triples in a single key, and find the distinct ones
+    keys = np.ravel_multi_index(
+        (corners[:, 0], corners[:, 1] if has_textures else 0, corners[:, 2] if has_normals else 0),
+        (varray.shape[0] + 1, tarray.shape[0] + 1, narray.shape[0] + 1))
+    keys, inverse = np.unique(keys, return_inverse=True)
+    v, vt, vn = np.unravel_index(keys, (varray.shape[0] + 1, tarray.shape[0] + 1, narray.shape[0] + 1))
+
+    return {
+        'vertices': varray[v - 1, :],
+        'faces': inverse.reshape(-1, 3).astype(np.uint32),
+        'material': library.materials[material],
+        'textureCoords': tarray[vt - 1, :] if has_textures else None,
+        'normals': narray[vn - 1, :] if has_normals else None
+    }
+
+
+def read_obj_file_by_line(file_name):
+    """
+    Function for reading a Blender3D object file line by line through process_line(). This is the original
+    reader, kept as a reference for read_obj_file() (see benchmark.py).
+    :return: a list of dictionaries holding the Mesh arguments for each mesh in the file.
     """
     print('Loading mesh(es) from Blender file: {}'.format(file_name))
 
@@ -254,12 +458,12 @@ def create_mesh(varray, tarray, flist, fstart, f, library, material):
     if textures is not None:
         textures = textures[vmin:vmax, :]
 
-    return Mesh(
-        vertices=varray[vmin:vmax, :],
-        faces=farray[:, :, 0] - vmin - 1,
-        material=library.materials[material],
-        textureCoords=textures
-    )
+    return {
+        'vertices': varray[vmin:vmax, :],
+        'faces': farray[:, :, 0] - vmin - 1,
+        'material': library.materials[material],
+        'textureCoords': textures
+    }
 
 
 def fix_blender_textures(textures, faces, vertices):
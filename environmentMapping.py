@@ -1,50 +1,109 @@
 from cubeMap import CubeMap
 from framebuffer import Framebuffer
+from frameUniforms import frame_uniforms
+from transformStage import normal_matrices
+from glState import gl_state
+from layeredRendering import CUBE_FACE_ROTATIONS, LAYERED_P, cube_projection, layered_rendering_supported
 from shaders import *
 
 
+def roughness_lod_bias(Ns, levels):
+    """
+    Returns the bias added to the mip level sampled for a material, so that rough materials reflect the blurrier
+    levels of mipmapped maps. The roughness matching the Phong specular exponent Ns is sqrt(2 / (Ns + 2)), from 1 for
+    a matte material to 0 for a mirror, and it selects a level between the sharpest and the blurriest.
+    :param levels: the number of mip levels of the map
+    """
+    return np.sqrt(2. / (max(Ns, 0.) + 2.)) * (levels - 1)
+
+
 class EnvironmentShader(BaseShaderProgram):
-    def __init__(self, name='environment', map=None):
+    def __init__(self, name='environment', map=None, lod_bias=None):
+        """
+        :param map: the cube map reflected, an EnvironmentMappingTexture or a baked ReflectionProbe
+        :param lod_bias: the bias added to the mip level sampled, by default from the specular exponent of the
+        material of each model (see roughness_lod_bias()); it only matters for the mipmapped maps of the baked probes
+        (see reflectionProbes.py)
+        """
         BaseShaderProgram.__init__(self, name=name)
-        self.add_uniform('sampler_cube')
-        self.add_uniform('VM')
-        self.add_uniform('VMiT')
-        self.add_uniform('VT')
+
+        # the camera matrices are in the FrameData block (see frameUniforms.py)
+        self.uniforms = {
+            'M': Uniform('M'),  # model matrix
+            'MiT': Uniform('MiT'),  # inverse-transpose of the model matrix (for normal transformation)
+            'sampler_cube': Uniform('sampler_cube'),
+            'lod_bias': Uniform('lod_bias', 0.),
+        }
 
         self.map = map
+        self.lod_bias = lod_bias
 
-    def bind(self, model, M):
-        glUseProgram(self.program)
+    def bind(self, model, M, MiT=None):
+        gl_state.use_program(self.program)
         if self.map is not None:
             unit = len(model.mesh.textures)
-            glActiveTexture(GL_TEXTURE0)
+            gl_state.active_texture(GL_TEXTURE0)
             self.map.bind()
             self.uniforms['sampler_cube'].bind(0)
 
-        P = model.scene.P  # get projection matrix from the scene
-        V = model.scene.camera.V  # get view matrix from the camera
+        lod_bias = self.lod_bias
+        if lod_bias is None:
+            lod_bias = roughness_lod_bias(model.mesh.material.Ns, self.map.levels if self.map is not None else 1)
+        self.uniforms['lod_bias'].bind_float(lod_bias)
 
-        # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
+        # upload the camera data if it changed since the last model
+        frame_uniforms.update(model.scene)
 
-        # set the PVM matrix uniform
-        self.uniforms['VM'].bind(np.matmul(V, M))
+        # set the model matrix uniforms
+        self.uniforms['M'].bind(M)
+        self.uniforms['MiT'].bind(MiT if MiT is not None else normal_matrices(M[np.newaxis])[0])
 
-        # set the PVM matrix uniform
-        self.uniforms['VMiT'].bind(np.linalg.inv(np.matmul(V, M))[:3, :3].transpose())
 
-        self.uniforms['VT'].bind(V.transpose()[:3, :3])
+# update policies of the environment maps
+UPDATE_EVERY_FRAME = 'every-frame'  # the six faces at each frame
+UPDATE_STATIC = 'static'  # the six faces once
+UPDATE_ON_CHANGE = 'on-change'  # the six faces when the probe, the light or a model near the probe changed
+UPDATE_ROUND_ROBIN = 'round-robin'  # one face per frame, after the six faces the first time
+UPDATE_POLICIES = [UPDATE_EVERY_FRAME, UPDATE_STATIC, UPDATE_ON_CHANGE, UPDATE_ROUND_ROBIN]
 
 
 class EnvironmentMappingTexture(CubeMap):
-    def __init__(self, width=200, height=200):
+    """
+    Cube map rendered from a probe position in the scene, for the reflections of the models drawn with an
+    EnvironmentShader using it. The models reflecting the map are not drawn in it. When the six faces are rendered, they
+    are rendered in one layered pass if the driver supports it (see layeredRendering.py), drawing the models within the
+    far plane of the faces; otherwise each face is rendered in turn, drawing the models in its frustum.
+    """
+
+    def __init__(self, width=200, height=200, position=[0, 0, 0], policy=UPDATE_ON_CHANGE, update_radius=20.0,
+                 layered=True):
+        """
+        :param position: the position of the probe, from which the faces are rendered
+        :param policy: when to render the faces, one of UPDATE_POLICIES
+        :param update_radius: with UPDATE_ON_CHANGE, only the models closer to the probe than this trigger an update
+        (by default the far plane of the faces, beyond which models are not seen)
+        :param layered: whether to render the six faces in one layered pass when the driver supports it
+        """
         CubeMap.__init__(self)
 
+        # with UPDATE_STATIC, set once the faces are rendered
         self.done = False
 
         self.width = width
         self.height = height
 
+        # the faces are rendered without mip levels
+        self.levels = 1
+
+        self.policy = policy
+        self.update_radius = update_radius
+
+        # what the faces were last rendered with, for UPDATE_ON_CHANGE
+        self.state = None
+
+        # the next face to render with UPDATE_ROUND_ROBIN, None until the six faces were rendered
+        self.next_face = None
+
         self.fbos = {
             GL_TEXTURE_CUBE_MAP_NEGATIVE_X: Framebuffer(),
             GL_TEXTURE_CUBE_MAP_POSITIVE_X: Framebuffer(),
@@ -54,15 +113,10 @@ class EnvironmentMappingTexture(CubeMap):
             GL_TEXTURE_CUBE_MAP_POSITIVE_Z: Framebuffer()
         }
 
-        t = 0.0
-        self.views = {
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_X: np.matmul(translationMatrix([0, 0, t]), rotationMatrixY(-np.pi/2.0)),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_X: np.matmul(translationMatrix([0, 0, t]), rotationMatrixY(+np.pi/2.0)),
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: np.matmul(translationMatrix([0, 0, t]), rotationMatrixX(+np.pi/2.0)),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_Y: np.matmul(translationMatrix([0, 0, t]), rotationMatrixX(-np.pi/2.0)),
-            GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: np.matmul(translationMatrix([0, 0, t]), rotationMatrixY(-np.pi)),
-            GL_TEXTURE_CUBE_MAP_POSITIVE_Z: translationMatrix([0, 0, t]),
-        }
+        self.set_position(position)
+
+        # the projection of the faces, kept so that the per-frame data is only uploaded when the faces change
+        self.P = cube_projection()
 
         self.bind()
         for (face, fbo) in self.fbos.items():
@@ -70,30 +124,121 @@ class EnvironmentMappingTexture(CubeMap):
             fbo.prepare(self, face)
         self.unbind()
 
+        # framebuffer with the whole cube map attached, None if the faces are rendered one by one
+        self.layered_fbo = None
+        if layered and layered_rendering_supported():
+            self.layered_fbo = Framebuffer()
+            self.layered_fbo.prepare_layered(self)
+
+    def set_position(self, position):
+        """
+        Moves the probe, the faces are rendered again at the next update (except with UPDATE_STATIC).
+        """
+        self.position = np.array(position, 'f')
+        T = translationMatrix(-self.position)
+        self.views = {face: np.matmul(R, T) for face, R in CUBE_FACE_ROTATIONS.items()}
+
+    def set_policy(self, policy):
+        """
+        Changes the update policy, the six faces are rendered at the next update.
+        """
+        self.policy = policy
+        self.done = False
+        self.state = None
+        self.next_face = None
+
+    def reflects(self, model):
+        """
+        Returns whether the model is drawn with this map, in which case it is not drawn in it.
+        """
+        return isinstance(model.shader, EnvironmentShader) and model.shader.map is self
+
+    def scene_state(self, scene, models):
+        """
+        Returns what the faces depend on: the probe position, the light, and the transforms and content (the copies of
+        instanced models) of the models near the probe.
+        """
+        transforms = scene.transforms
+        nearby = []
+        for model in models:
+            # distance from the probe to the world bounding box, which covers all the copies of instanced models
+            row = transforms.index.get(id(model))
+            if row is None or np.linalg.norm(np.maximum(np.maximum(transforms.box_min[row] - self.position, 0.),
+                                                        self.position - transforms.box_max[row])) <= self.update_radius:
+                nearby.append((id(model), transforms.versions.get(id(model)), model.content_version))
+        return tuple(self.position), scene.light.version, tuple(nearby)
+
     def update(self, scene):
+        """
+        Renders the faces of the cube map according to the update policy.
+        """
         if self.done:
             return
 
+        models = [model for model in scene.models if not self.reflects(model)]
+        faces = list(self.fbos.keys())
+
+        if self.policy == UPDATE_ON_CHANGE:
+            state = self.scene_state(scene, models)
+            if state == self.state:
+                scene.stats['environment map reused'] += 1
+                return
+            self.state = state
+
+        elif self.policy == UPDATE_ROUND_ROBIN:
+            if self.next_face is not None:
+                faces = [faces[self.next_face]]
+                self.next_face = (self.next_face + 1) % len(self.fbos)
+            else:
+                self.next_face = 0
+
+        self.render_faces(scene, models, faces)
+
+        if self.policy == UPDATE_STATIC:
+            self.done = True
+
+    def render_faces(self, scene, models, faces):
+        """
+        Renders the models in some faces of the cube map, the six faces in one layered pass if possible.
+        """
         self.bind()
 
         Pscene = scene.P
 
-        scene.P = frustumMatrix(-1.0, +1.0, -1.0, +1.0, 1.0, 20.0)
+        # the levels of detail are chosen from the distance to the probe, with the projection of the faces
+        scene.lod_probe = (self.position, abs(self.P[1, 1]))
 
         glViewport(0, 0, self.width, self.height)
 
-        for (face, fbo) in self.fbos.items():
-            fbo.bind()
-            scene.camera.V = self.views[face]
+        if self.layered_fbo is not None and len(faces) == len(self.fbos):
+            # the models are drawn once in the coordinates of the probe, the geometry shader projects them on the faces
+            scene.P = LAYERED_P
+            self.layered_fbo.bind()
+            scene.camera.V = translationMatrix(-self.position)
 
-            scene.draw_reflections()
+            scene.draw_reflections(models, layered=True)
 
             scene.camera.update()
-            fbo.unbind()
+            self.layered_fbo.unbind()
+            scene.stats['environment layered passes'] += 1
+
+        else:
+            scene.P = self.P
+            for face in faces:
+                self.fbos[face].bind()
+                scene.camera.V = self.views[face]
+
+                scene.draw_reflections(models)
+
+                scene.camera.update()
+                self.fbos[face].unbind()
+
+        scene.stats['environment faces rendered'] += len(faces)
 
         # reset the viewport
         glViewport(0, 0, scene.window_size[0], scene.window_size[1])
 
         scene.P = Pscene
+        scene.lod_probe = None
 
         self.unbind()
@@ -0,0 +1,116 @@
+import numpy as np
+from OpenGL.GL import *
+
+from glState import gl_state
+from matutils import *
+from transformStage import affine_inverse
+
+'''
+Per-frame data shared by all the programs, in a std140 uniform block:
+
+layout(std140) uniform FrameData {
+    mat4 P;                     // projection matrix
+    mat4 V;                     // view matrix
+    mat4 shadow_map_matrix;     // from view coordinates to shadow map coordinates
+    vec4 light;                 // light position in view coordinates
+    vec4 Ia;                    // ambient light intensity
+    vec4 Id;                    // diffuse light intensity
+    vec4 Is;                    // specular light intensity
+    int mode;                   // the rendering mode
+};
+
+The block is uploaded when the camera, projection, light or shadow map changed since the last upload, which happens
+once per rendering pass (main view, shadow map, environment map faces) rather than once per model.
+'''
+
+# uniform buffer binding point of the block
+FRAME_DATA_BINDING = 0
+
+# size of the block in floats, following the std140 layout above
+FRAME_DATA_SIZE = 3 * 16 + 4 * 4 + 4
+
+
+def bind_frame_block(program):
+    """
+    Connects the FrameData block of a program, if it uses it, to the buffer binding point.
+    """
+    index = glGetUniformBlockIndex(program, 'FrameData')
+    if index != GL_INVALID_INDEX:
+        glUniformBlockBinding(program, index, FRAME_DATA_BINDING)
+
+
+def shadow_map_matrix(shadow_map, V):
+    """
+    Returns the matrix from view coordinates to the shadow map texture coordinates and depth.
+    """
+    SM = np.matmul(shadow_map.V, affine_inverse(V))
+    SM = np.matmul(shadow_map.P, SM)
+    SM = np.matmul(translationMatrix([1, 1, 1]), SM)
+    return np.matmul(scaleMatrix(0.5), SM)
+
+
+class FrameUniforms:
+    """
+    Holds the uniform buffer of the FrameData block, and the values it was last filled with.
+    """
+
+    def __init__(self):
+        self.buffer = None
+        self.data = np.zeros(FRAME_DATA_SIZE, 'f')
+
+        # the matrices are replaced rather than modified when they change, so they are compared by identity
+        self.P = None
+        self.V = None
+        self.shadow_map = None
+        self.shadow_V = None
+        self.light = None
+        self.mode = None
+
+    def update(self, scene, shadow_map=None):
+        """
+        Uploads the per-frame data if it changed since the last call.
+        :param scene: the scene, for the projection, camera, light and rendering mode
+        :param shadow_map: [optional] the shadow map used to compute the shadow map matrix, the last one given is used
+        otherwise
+        """
+        if shadow_map is not None:
+            self.shadow_map = shadow_map
+        shadow_V = self.shadow_map.V if self.shadow_map is not None else None
+
+        light = np.array([scene.light.position, scene.light.Ia, scene.light.Id, scene.light.Is], 'f')
+
+        changed = scene.P is not self.P or scene.camera.V is not self.V or shadow_V is not self.shadow_V or \
+            scene.mode != self.mode or not np.array_equal(light, self.light)
+        if not gl_state.count('FrameData upload', changed):
+            return
+
+        self.P = scene.P
+        self.V = scene.camera.V
+        self.shadow_V = shadow_V
+        self.light = light
+        self.mode = scene.mode
+
+        # matrices are stored column by column
+        self.data[0:16] = self.P.T.ravel()
+        self.data[16:32] = self.V.T.ravel()
+        if shadow_V is not None:
+            self.data[32:48] = shadow_map_matrix(self.shadow_map, self.V).T.ravel()
+        self.data[48:51] = unhomog(np.dot(self.V, homog(light[0])))
+        self.data[52:55] = light[1]
+        self.data[56:59] = light[2]
+        self.data[60:63] = light[3]
+        self.data[64:].view(np.int32)[0] = self.mode
+
+        if self.buffer is None:
+            self.buffer = glGenBuffers(1)
+            glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+            glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+            glBindBufferBase(GL_UNIFORM_BUFFER, FRAME_DATA_BINDING, self.buffer)
+
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+
+# the per-frame data of the application
+frame_uniforms = FrameUniforms()
@@ -42,3 +42,15 @@ class Framebuffer:
             glReadBuffer(GL_NONE)
 
         self.unbind()
+
+    def prepare_layered(self, texture, level=0):
+        """
+        Prepare the Framebuffer by linking its output to all the layers of a texture (the six faces of a cube map), the
+        geometry shader selects the layer of each primitive with gl_Layer
+        :param texture: The texture object to render to
+        :param level: The mipmap level
+        :return:
+        """
+        self.bind()
+        glFramebufferTexture(GL_FRAMEBUFFER, self.attachment, texture.textureid, level)
+        self.unbind()
@@ -0,0 +1,99 @@
+from collections import Counter
+
+import numpy as np
+from OpenGL.GL import *
+
+'''
+Tracking of the OpenGL state set while drawing: the current program, the texture bound to each unit, the bound
+Vertex Array Object and the last value of each uniform. Calls that would not change the state are skipped, which
+avoids most of the GL calls when consecutive models share a shader, textures or materials.
+All the code changing this state must go through the gl_state object below, otherwise the tracked state would be
+out of date.
+'''
+
+
+class GLState:
+    """
+    Remembers the OpenGL state and only issues the calls that change it.
+    """
+
+    def __init__(self):
+        self.program = None
+        self.vao = None
+        self.active_unit = None
+
+        # texture bound to each (unit, target)
+        self.textures = {}
+
+        # last value set for each (program, uniform location)
+        self.uniforms = {}
+
+        # numbers of issued and skipped calls since the last call to take_stats()
+        self.stats = Counter()
+
+    def count(self, call, issued):
+        self.stats['{} {}'.format(call, 'issued' if issued else 'skipped')] += 1
+        return issued
+
+    def use_program(self, program):
+        if self.count('glUseProgram', program != self.program):
+            glUseProgram(program)
+            self.program = program
+
+    def bind_vertex_array(self, vao):
+        if self.count('glBindVertexArray', vao != self.vao):
+            glBindVertexArray(vao)
+            self.vao = vao
+
+    def active_texture(self, unit):
+        """
+        :param unit: the texture unit, GL_TEXTURE0 + index
+        """
+        if self.count('glActiveTexture', unit != self.active_unit):
+            glActiveTexture(unit)
+            self.active_unit = unit
+
+    def bind_texture(self, target, texture):
+        """
+        Binds the texture to the active unit.
+        """
+        key = (self.active_unit, target)
+        if self.count('glBindTexture', self.textures.get(key) != texture):
+            glBindTexture(target, texture)
+            self.textures[key] = texture
+
+    def uniform_changed(self, location, value):
+        """
+        Records the value of a uniform of the current program.
+        :return: whether the value differs from the last one set, in which case it must be uploaded
+        """
+        key = (self.program, location)
+        last = self.uniforms.get(key)
+        if isinstance(value, np.ndarray):
+            changed = not isinstance(last, np.ndarray) or last.shape != value.shape or not np.array_equal(last, value)
+            value = value.copy()
+        else:
+            changed = last is None or last != value
+        if self.count('glUniform', changed):
+            self.uniforms[key] = value
+        return changed
+
+    def forget_program(self, program):
+        """
+        Forgets the uniform values of a program, to call when a program is created since its id may be reused.
+        """
+        self.uniforms = {key: value for key, value in self.uniforms.items() if key[0] != program}
+        if self.program == program:
+            self.program = None
+
+    def take_stats(self):
+        """
+        Returns the call counters and resets them, call this once per frame.
+        """
+        stats = self.stats
+        self.stats = Counter()
+        return stats
+
+
+# the state of the OpenGL context of the application
+gl_state = GLState()
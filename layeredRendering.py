@@ -0,0 +1,97 @@
+import re
+
+import numpy as np
+from OpenGL.GL import *
+
+from matutils import *
+
+'''
+Single pass rendering of the six faces of a cube map. The whole cube map is attached to one layered framebuffer, and
+the programs are compiled with the LAYERED flag (see SHADER_FLAGS in shaders.py), which adds a geometry shader
+sending each triangle to the six layers of the framebuffer. The models are then drawn once for the six faces, rather
+than once per face.
+
+The scene is drawn with the view matrix translating the probe to the origin, and a projection scaling the cube of
+half side CUBE_FAR around it into clip coordinates, so that the frustum culling of the pass keeps the models within
+reach of the faces. The lighting is computed in these probe coordinates: it only depends on dot products and
+distances, which the rotation of each face does not change, so it is the same as when drawing each face separately.
+The geometry shader only applies the rotation and projection of each face to the positions.
+
+The geometry shader is generated from the outputs of the vertex shader, which are renamed with #define lines so that
+the geometry shader can pass them on with their original names to the fragment shader.
+'''
+
+# the projection of each face of the cube maps
+CUBE_NEAR = 1.0
+CUBE_FAR = 20.0
+
+# rotation of the camera for each face of the cube maps
+CUBE_FACE_ROTATIONS = {
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_X: rotationMatrixY(-np.pi / 2.0),
+    GL_TEXTURE_CUBE_MAP_POSITIVE_X: rotationMatrixY(+np.pi / 2.0),
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: rotationMatrixX(+np.pi / 2.0),
+    GL_TEXTURE_CUBE_MAP_POSITIVE_Y: rotationMatrixX(-np.pi / 2.0),
+    GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: rotationMatrixY(-np.pi),
+    GL_TEXTURE_CUBE_MAP_POSITIVE_Z: np.identity(4),
+}
+
+# projection of the layered pass, from probe coordinates to the clip coordinates read by the geometry shader
+LAYERED_P = scaleMatrix(1 / CUBE_FAR)
+
+# outputs of a vertex shader, as (type, name)
+OUTPUT_PATTERN = re.compile(r'^\s*out\s+(\w+)\s+(\w+)\s*;', re.MULTILINE)
+
+
+def cube_projection():
+    return frustumMatrix(-1.0, +1.0, -1.0, +1.0, CUBE_NEAR, CUBE_FAR)
+
+
+def face_matrices():
+    """
+    Returns the matrices applied by the geometry shader, from the clip coordinates of LAYERED_P to the clip
+    coordinates of each face, in layer order (the order of the GL_TEXTURE_CUBE_MAP_* targets).
+    """
+    P = np.matmul(cube_projection(), np.linalg.inv(LAYERED_P))
+    return [np.matmul(P, CUBE_FACE_ROTATIONS[face]) for face in sorted(CUBE_FACE_ROTATIONS.keys())]
+
+
+def renamed_outputs(vertex_source):
+    """
+    Returns the #define lines renaming the outputs of the vertex shader, in the format of the flags of add_defines().
+    """
+    return ['{0} {0}_vertex'.format(name) for _, name in OUTPUT_PATTERN.findall(vertex_source)]
+
+
+def layered_geometry_shader(vertex_source):
+    """
+    Generates the geometry shader emitting each triangle to the six layers, passing on the outputs of the vertex
+    shader.
+    """
+    outputs = OUTPUT_PATTERN.findall(vertex_source)
+    matrices = ',\n    '.join('mat4({})'.format(', '.join('{:.9g}'.format(value) for value in M.T.ravel()))
+                               for M in face_matrices())
+
+    lines = ['#version 150', '', '// generated by layeredRendering.py', '',
+             'layout(triangles) in;', 'layout(triangle_strip, max_vertices = 18) out;', '']
+    for type, name in outputs:
+        lines += ['in {} {}_vertex[];'.format(type, name), 'out {} {};'.format(type, name)]
+    lines += ['', 'const mat4 face_matrices[6] = mat4[6](', '    ' + matrices, ');', '',
+              'void main() {',
+              '    for (int face = 0; face < 6; face++) {',
+              '        for (int i = 0; i < 3; i++) {',
+              '            gl_Layer = face;',
+              '            gl_Position = face_matrices[face]*gl_in[i].gl_Position;']
+    lines += ['            {0} = {0}_vertex[i];'.format(name) for _, name in outputs]
+    lines += ['            EmitVertex();',
+              '        }',
+              '        EndPrimitive();',
+              '    }',
+              '}', '']
+    return '\n'.join(lines)
+
+
+def layered_rendering_supported():
+    """
+    Returns whether the driver can attach a whole cube map to a framebuffer (OpenGL 3.2).
+    """
+    return bool(glFramebufferTexture)
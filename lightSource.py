@@ -22,6 +22,9 @@ class LightSource:
         self.Id = Id
         self.Is = Is
 
+        # number of changes of the light, call update() after modifying it (see ShadowMap.render())
+        self.version = 0
+
     def update(self, position=None):
         """
         update the position of the light source.
@@ -29,3 +32,4 @@ class LightSource:
         """
         if position is not None:
             self.position = position
+        self.version += 1
@@ -10,6 +10,9 @@ class Material:
         self.texture = texture
         self.alpha = 1.0
 
+        # index in the material table, set when the material is first used (see materialTable.py)
+        self.index = None
+
 
 class MaterialLibrary:
     def __init__(self):
@@ -0,0 +1,108 @@
+import numpy as np
+from OpenGL.GL import *
+
+from glState import gl_state
+
+'''
+Table of all the materials in a std140 uniform block, so that drawing a model only sets the index of its material:
+
+struct MaterialData {
+    vec4 Ka;                    // ambient reflection
+    vec4 Kd;                    // diffuse reflection
+    vec4 Ks;                    // specular reflection
+    vec4 parameters;            // specular exponent, alpha
+};
+
+layout(std140) uniform MaterialTable {
+    MaterialData materials[256];
+};
+
+Materials are packed once when they are added, and the buffer is uploaded before drawing when materials were added
+since the last upload.
+'''
+
+# uniform buffer binding point of the block
+MATERIAL_TABLE_BINDING = 1
+
+# number of materials in the block, this must match the array size in the shaders. 256 materials use 16kB, the
+# smallest maximum size of a uniform block.
+MAX_MATERIALS = 256
+
+# size of a material in floats, following the std140 layout above
+MATERIAL_SIZE = 16
+
+
+def bind_material_block(program):
+    """
+    Connects the MaterialTable block of a program, if it uses it, to the buffer binding point.
+    """
+    index = glGetUniformBlockIndex(program, 'MaterialTable')
+    if index != GL_INVALID_INDEX:
+        glUniformBlockBinding(program, index, MATERIAL_TABLE_BINDING)
+
+
+class MaterialTable:
+    """
+    Packs materials in a float32 array and gives each one a stable index, stored in material.index.
+    """
+
+    def __init__(self):
+        self.buffer = None
+        self.data = np.zeros((MAX_MATERIALS, MATERIAL_SIZE), 'f')
+        self.count = 0
+
+        # range of rows changed since the last upload
+        self.changed = None
+
+    def index(self, material):
+        """
+        Returns the index of a material in the table, adding it the first time.
+        """
+        if material.index is None:
+            if self.count == MAX_MATERIALS:
+                print('(E) Error in MaterialTable.index(): more than {} materials, using material 0 for {}'.format(
+                    MAX_MATERIALS, material.name))
+                return 0
+            material.index = self.count
+            self.count += 1
+            self.update_material(material)
+        return material.index
+
+    def update_material(self, material):
+        """
+        Packs the material again, call this after changing the attributes of a material already in the table.
+        """
+        row = self.data[material.index]
+        row[0:3] = material.Ka
+        row[4:7] = material.Kd
+        row[8:11] = material.Ks
+        row[12] = material.Ns
+        row[13] = material.alpha
+
+        start, end = self.changed or (material.index, material.index + 1)
+        self.changed = (min(start, material.index), max(end, material.index + 1))
+
+    def upload(self):
+        """
+        Uploads the materials changed since the last call, call this before drawing.
+        """
+        if not gl_state.count('MaterialTable upload', self.changed is not None):
+            return
+
+        if self.buffer is None:
+            self.buffer = glGenBuffers(1)
+            glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+            glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, self.data, GL_DYNAMIC_DRAW)
+            glBindBufferBase(GL_UNIFORM_BUFFER, MATERIAL_TABLE_BINDING, self.buffer)
+        else:
+            start, end = self.changed
+            glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+            glBufferSubData(GL_UNIFORM_BUFFER, start * self.data.itemsize * MATERIAL_SIZE,
+                            (end - start) * self.data.itemsize * MATERIAL_SIZE, self.data[start:end])
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+        self.changed = None
+
+
+# the materials of the application
+material_table = MaterialTable()
@@ -1,7 +1,114 @@
 from material import Material
 import numpy as np
 
-from texture import Texture
+from materialTable import material_table
+from textureManager import texture_manager
+
+
+def normalize_rows(vectors):
+    """
+    Normalises each row of the array, rows of length zero (eg vertices not used by any face) are left to zero.
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0).astype('f')
+
+
+def scatter_rows(indices, values, n):
+    """
+    Sums the rows of values into an (n, 3) array, at the given row indices.
+    """
+    return np.stack([np.bincount(indices, weights=values[:, k], minlength=n) for k in range(3)], axis=1)
+
+
+def calculate_normals(vertices, faces, textureCoords=None, weighting='area'):
+    """
+    Calculates vertex normals from the mesh faces, and tangents and binormals if texture coordinates are provided.
+    first, calculate normal for all faces using cross product
+    then, set each vertex normal as the weighted average of the normals over all faces it belongs to.
+    :param weighting: 'area' to weight the face normals by the face area, 'angle' to weight them by the angle of the
+    face at the vertex
+    :return: the normals, tangents and binormals arrays (the latter two are None without texture coordinates)
+    """
+    n = vertices.shape[0]
+    indices = faces.ravel()
+    tangents = None
+    binormals = None
+
+    # calculate the face normals using the cross product of the triangles' sides
+    corners = vertices[faces].astype(np.float64)
+    a = corners[:, 1] - corners[:, 0]
+    b = corners[:, 2] - corners[:, 0]
+    face_normals = np.cross(a, b)
+
+    if weighting == 'area':
+        # the length of the cross product is twice the area of the face
+        corner_normals = np.repeat(face_normals, 3, axis=0)
+    elif weighting == 'angle':
+        # angle of each face corner, between the two sides starting from it
+        sides1 = np.roll(corners, -1, axis=1) - corners
+        sides2 = np.roll(corners, -2, axis=1) - corners
+        angles = np.arctan2(np.linalg.norm(np.cross(sides1, sides2), axis=2), np.sum(sides1 * sides2, axis=2))
+        corner_normals = (normalize_rows(face_normals)[:, np.newaxis, :] * angles[:, :, np.newaxis]).reshape(-1, 3)
+    else:
+        raise ValueError('(E) Error in calculate_normals(): unknown weighting {}'.format(weighting))
+
+    # blend normals on all vertices
+    normals = normalize_rows(scatter_rows(indices, corner_normals, n))
+
+    # tangents
+    if textureCoords is not None:
+        uv = textureCoords[faces].astype(np.float64)
+        txa = uv[:, 1] - uv[:, 0]
+        txb = uv[:, 2] - uv[:, 0]
+        face_tangents = txb[:, 0:1] * a - txa[:, 0:1] * b
+        face_binormals = -txb[:, 1:2] * a + txa[:, 1:2] * b
+        tangents = normalize_rows(scatter_rows(indices, np.repeat(face_tangents, 3, axis=0), n))
+        binormals = normalize_rows(scatter_rows(indices, np.repeat(face_binormals, 3, axis=0), n))
+
+    return normals, tangents, binormals
+
+
+def calculate_normals_by_face(vertices, faces, textureCoords=None):
+    """
+    Face by face version of calculate_normals() with area weighting, kept verbatim as the reference of benchmark.py.
+    Its tangents and binormals use the wrong second UV edge (the third corner minus itself), which calculate_normals()
+    fixes, and the sums of length zero give NaNs.
+    """
+
+    tangents = None
+    binormals = None
+    normals = np.zeros((vertices.shape[0], 3), dtype='f')
+    if textureCoords is not None:
+        tangents = np.zeros((vertices.shape[0], 3), dtype='f')
+        binormals = np.zeros((vertices.shape[0], 3), dtype='f')
+
+    for f in range(faces.shape[0]):
+        # calculate the face normal using the cross product of the triangle's sides
+        a = vertices[faces[f, 1]] - vertices[faces[f, 0]]
+        b = vertices[faces[f, 2]] - vertices[faces[f, 0]]
+        face_normal = np.cross(a, b)
+
+        # tangent
+        if textureCoords is not None:
+            txa = textureCoords[faces[f, 1], :] - textureCoords[faces[f, 0], :]
+            txb = textureCoords[faces[f, 2], :] - textureCoords[faces[f, 2], :]
+            face_tangent = txb[0] * a - txa[0] * b
+            face_binormal = -txb[1] * a + txa[1] * b
+
+        # blend normal on all 3 vertices
+        for j in range(3):
+            normals[faces[f, j], :] += face_normal
+            if textureCoords is not None:
+                tangents[faces[f, j], :] += face_tangent
+                binormals[faces[f, j], :] += face_binormal
+
+    # normalize the vectors
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    if textureCoords is not None:
+        tangents /= np.linalg.norm(tangents, axis=1, keepdims=True)
+        binormals /= np.linalg.norm(binormals, axis=1, keepdims=True)
+
+    return normals, tangents, binormals
 
 
 class Mesh:
@@ -10,13 +117,19 @@ class Mesh:
     and normals.
     """
 
-    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=Material()):
+    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=Material(),
+                 tangents=None, binormals=None, textureImage=None, lods=None):
         """
         Initialises a mesh object.
         :param vertices: A numpy array containing all vertices
         :param faces: [optional] An int array containing the vertex indices for all faces.
         :param normals: [optional] An array of normal vectors, calculated from the faces if not provided.
         :param material: [optional] An object containing the material information for this object
+        :param tangents: [optional] An array of tangent vectors, only used if normals are provided.
+        :param binormals: [optional] An array of binormal vectors, only used if normals are provided.
+        :param textureImage: [optional] The already decoded image of the material texture (see DecodedImage)
+        :param lods: [optional] A list of dictionaries holding the arguments of the simplified levels of detail,
+        from the most to the least detailed (see meshSimplifier.py)
         """
         self.name = 'Unknown'
         self.vertices = vertices
@@ -25,8 +138,8 @@ class Mesh:
         self.colors = None
         self.textureCoords = textureCoords
         self.textures = []
-        self.tangents = None
-        self.binormals = None
+        self.tangents = tangents
+        self.binormals = binormals
 
         if vertices is not None:
             print('Creating mesh')
@@ -44,46 +157,43 @@ class Mesh:
         else:
             self.normals = normals
 
+        # the texture is shared with the other meshes using the same image
         if material.texture is not None:
-            self.textures.append(Texture(material.texture))
-
-    def calculate_normals(self):
+            self.textures.append(texture_manager.get(material.texture, img=textureImage))
+
+        # pack the material in the material table once, drawing only sets its index
+        material_table.index(material)
+
+        # bounding box and sphere in model coordinates, used for frustum culling and to estimate the size of the
+        # mesh on screen
+        self.bounds_min = np.zeros(3, 'f')
+        self.bounds_max = np.zeros(3, 'f')
+        self.center = np.zeros(3, 'f')
+        self.radius = 0.
+        if vertices is not None and vertices.shape[0] > 0:
+            self.bounds_min = vertices.min(axis=0)
+            self.bounds_max = vertices.max(axis=0)
+            self.center = (self.bounds_min + self.bounds_max) / 2
+            self.radius = float(np.linalg.norm(vertices - self.center, axis=1).max())
+
+        # simplified versions of the mesh, sharing its material and textures
+        self.lods = []
+        for arrays in lods or []:
+            lod = Mesh(**arrays)
+            lod.material = self.material
+            lod.textures = self.textures
+            self.lods.append(lod)
+
+    def calculate_normals(self, weighting='area'):
         """
         method to calculate normals from the mesh faces.
         first, calculate normal for each face using cross product
-        then, set each vertex normal as the average of the normals over all faces it belongs to.
+        then, set each vertex normal as the weighted average of the normals over all faces it belongs to.
+        :param weighting: 'area' or 'angle', see calculate_normals()
         """
 
-        self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-        if self.textureCoords is not None:
-            self.tangents = np.zeros((self.vertices.shape[0], 3), dtype='f')
-            self.binormals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-
-        for f in range(self.faces.shape[0]):
-            # calculate the face normal using the cross product of the triangle's sides
-            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
-            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
-            face_normal = np.cross(a, b)
-
-            # tangent
-            if self.textureCoords is not None:
-                txa = self.textureCoords[self.faces[f, 1], :] - self.textureCoords[self.faces[f, 0], :]
-                txb = self.textureCoords[self.faces[f, 2], :] - self.textureCoords[self.faces[f, 2], :]
-                face_tangent = txb[0] * a - txa[0] * b
-                face_binormal = -txb[1] * a + txa[1] * b
-
-            # blend normal on all 3 vertices
-            for j in range(3):
-                self.normals[self.faces[f, j], :] += face_normal
-                if self.textureCoords is not None:
-                    self.tangents[self.faces[f, j], :] += face_tangent
-                    self.binormals[self.faces[f, j], :] += face_binormal
-
-        # normalize the vectors
-        self.normals /= np.linalg.norm(self.normals, axis=1, keepdims=True)
-        if self.textureCoords is not None:
-            self.tangents /= np.linalg.norm(self.tangents, axis=1, keepdims=True)
-            self.binormals /= np.linalg.norm(self.binormals, axis=1, keepdims=True)
+        self.normals, self.tangents, self.binormals = calculate_normals(self.vertices, self.faces,
+                                                                        self.textureCoords, weighting)
 
 
 class CubeMesh(Mesh):
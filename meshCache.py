@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+from material import Material
+
+'''
+On-disk cache for compiled meshes. The final per-mesh arrays of an OBJ file (vertices, faces, normals,
+texture coordinates, tangents and binormals, and the same for each level of detail) are stored as .npy files, with
+the material parameters in a small JSON file, in a directory named after the hash of the OBJ and MTL sources.
+Loading an entry memory-maps the arrays, so that no parsing is needed. Pre-warm the cache for all models with:
+python meshCache.py models/*.obj
+'''
+
+# default directory where the compiled meshes are stored
+CACHE_DIR = 'cache'
+
+# increase this when the content of the compiled arrays changes, to invalidate existing entries
+CACHE_VERSION = 4
+
+# the arrays stored for each mesh, they match the Mesh() constructor arguments
+MESH_ARRAYS = ['vertices', 'faces', 'normals', 'textureCoords', 'tangents', 'binormals']
+
+# the material attributes stored with each mesh
+MATERIAL_ATTRIBUTES = ['name', 'Ka', 'Kd', 'Ks', 'Ns', 'd', 'illumination', 'texture', 'alpha']
+
+
+def source_files(file_name):
+    """
+    Returns the OBJ file and the material libraries it references, which together determine the compiled meshes.
+    """
+    with open(file_name, 'rb') as objfile:
+        libraries = re.findall(rb'^mtllib\s+(\S+)', objfile.read(), re.MULTILINE)
+    return [file_name] + ['models/{}'.format(library.decode()) for library in libraries]
+
+
+def source_hash(files, options=''):
+    """
+    Hashes the content of the source files, the compilation options and the cache version.
+    """
+    digest = hashlib.sha1('v{} {}'.format(CACHE_VERSION, options).encode())
+    for file_name in files:
+        with open(file_name, 'rb') as source:
+            digest.update(source.read())
+    return digest.hexdigest()[:16]
+
+
+def options_tag(options):
+    """
+    Returns a short name for the compilation options, which can be part of a directory name.
+    """
+    return hashlib.sha1(options.encode()).hexdigest()[:8]
+
+
+def cache_path(file_name, cache_dir=CACHE_DIR, options=''):
+    """
+    Returns the cache directory holding the compiled meshes for the current content of this OBJ file, named
+    <model>.<options tag>.<content hash>.
+    :param options: a string describing the compilation options, entries compiled with other options are separate
+    """
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    key = source_hash(source_files(file_name), options)
+    return os.path.join(cache_dir, '{}.{}.{}'.format(name, options_tag(options), key))
+
+
+def prune_entries(path):
+    """
+    Removes the stale entries of the model of this entry compiled with the same options, left by older contents of
+    its sources or older cache versions, and the entries named without the options tag by earlier versions. The entries
+    compiled with other options are kept.
+    """
+    cache_dir, entry = os.path.split(path)
+    name, tag, _ = entry.rsplit('.', 2)
+    stale = re.compile(r'{0}\.{1}\.[0-9a-f]{{16}}|{0}\.[0-9a-f]{{16}}'.format(re.escape(name), tag))
+    for other in os.listdir(cache_dir):
+        if other != entry and stale.fullmatch(other):
+            shutil.rmtree(os.path.join(cache_dir, other), ignore_errors=True)
+
+
+def to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+def save_arrays(path, prefix, mesh):
+    """
+    Saves the arrays of a mesh dictionary in .npy files named after the prefix.
+    :return: the list of saved arrays
+    """
+    arrays = [name for name in MESH_ARRAYS if mesh.get(name) is not None]
+    for name in arrays:
+        np.save(os.path.join(path, '{}_{}.npy'.format(prefix, name)), mesh[name])
+    return arrays
+
+
+def load_arrays(path, prefix, arrays):
+    """
+    Memory-maps the arrays of a mesh dictionary saved by save_arrays().
+    """
+    mesh = {name: None for name in MESH_ARRAYS}
+    for name in arrays:
+        mesh[name] = np.load(os.path.join(path, '{}_{}.npy'.format(prefix, name)), mmap_mode='r')
+    return mesh
+
+
+def save_meshes(path, meshes):
+    """
+    Writes a list of mesh dictionaries to the cache directory. The entry is written to a temporary directory first,
+    so that an interrupted write never leaves a partial entry.
+    """
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+
+    # materials are shared between meshes, store each one once
+    materials = []
+    index = {}
+    for mesh in meshes:
+        if id(mesh['material']) not in index:
+            index[id(mesh['material'])] = len(materials)
+            materials.append({
+                attribute: to_json(getattr(mesh['material'], attribute))
+                for attribute in MATERIAL_ATTRIBUTES if hasattr(mesh['material'], attribute)
+            })
+
+    description = {'materials': materials, 'meshes': []}
+    for i, mesh in enumerate(meshes):
+        description['meshes'].append({
+            'material': index[id(mesh['material'])],
+            'arrays': save_arrays(tmp_path, str(i), mesh),
+            'lods': [save_arrays(tmp_path, '{}_lod{}'.format(i, j), lod) for j, lod in enumerate(mesh.get('lods', []))],
+        })
+
+    with open(os.path.join(tmp_path, 'meshes.json'), 'w') as file:
+        json.dump(description, file)
+
+    # replace any older entry for the same content, and remove the stale entries for this model and options
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    prune_entries(path)
+
+
+def load_meshes(path):
+    """
+    Reads a list of mesh dictionaries from the cache directory, memory-mapping the arrays.
+    """
+    with open(os.path.join(path, 'meshes.json')) as file:
+        description = json.load(file)
+
+    materials = []
+    for attributes in description['materials']:
+        material = Material()
+        for attribute, value in attributes.items():
+            if attribute in ['Ka', 'Kd', 'Ks']:
+                value = np.array(value, 'f')
+            setattr(material, attribute, value)
+        materials.append(material)
+
+    meshes = []
+    for i, mesh in enumerate(description['meshes']):
+        arrays = load_arrays(path, str(i), mesh['arrays'])
+        arrays['lods'] = [load_arrays(path, '{}_lod{}'.format(i, j), lod) for j, lod in enumerate(mesh['lods'])]
+        arrays['material'] = materials[mesh['material']]
+        meshes.append(arrays)
+
+    return meshes
+
+
+def load_cached(file_name, compile_file, cache_dir=CACHE_DIR, options=''):
+    """
+    Returns the compiled meshes for an OBJ file, from the cache if the sources did not change since the entry was
+    written, otherwise by compiling the file and storing the result.
+    :param file_name: the name of the OBJ file
+    :param compile_file: the function compiling the OBJ file to a list of mesh dictionaries
+    :param cache_dir: the cache directory
+    :param options: a string describing the options used by compile_file
+    """
+    path = cache_path(file_name, cache_dir, options)
+
+    if os.path.isfile(os.path.join(path, 'meshes.json')):
+        print('Loading mesh(es) from cache: {}'.format(path))
+        return load_meshes(path)
+
+    print('(W) No cache entry for {}, compiling it'.format(file_name))
+    meshes = compile_file(file_name)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_meshes(path, meshes)
+    except OSError as error:
+        print('(W) Could not write the mesh cache entry {}: {}'.format(path, error))
+        return meshes
+
+    # return the memory-mapped arrays, so that the first and later runs use the same data
+    return load_meshes(path)
+
+
+if __name__ == '__main__':
+    import argparse
+    import glob
+
+    from blender import compile_options, load_mesh_arrays
+
+    parser = argparse.ArgumentParser(description='Pre-warm the compiled mesh cache.')
+    parser.add_argument('files', nargs='*', default=sorted(glob.glob('models/*.obj')))
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--force', action='store_true', help='recompile entries even if they are up to date')
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                        help='do not reorder the meshes for the vertex caches')
+    parser.add_argument('--no-lods', dest='lods', action='store_false', help='do not build levels of detail')
+    args = parser.parse_args()
+
+    for obj_file in args.files:
+        entry = cache_path(obj_file, args.cache_dir, compile_options(args.optimize, args.lods))
+        if args.force:
+            shutil.rmtree(entry, ignore_errors=True)
+        load_mesh_arrays(obj_file, args.cache_dir, args.optimize, args.lods)
+        print('{} -> {}'.format(obj_file, entry))
@@ -0,0 +1,132 @@
+import numpy as np
+
+'''
+Load-time optimisations of the mesh index and vertex arrays for the GPU vertex caches:
+- triangles are reordered with the Tipsify algorithm so that the post-transform vertex cache is reused,
+- vertices are then reordered by first use so that vertex fetches are mostly sequential.
+Source:
+Sander, Nehab and Barczak, Fast Triangle Reordering for Vertex Locality and Reduced Overdraw, SIGGRAPH 2007.
+'''
+
+# size of the simulated post-transform vertex cache, in vertices
+CACHE_SIZE = 16
+
+# per-vertex arrays of the mesh dictionaries that must follow the vertex order
+VERTEX_ARRAYS = ['vertices', 'normals', 'textureCoords', 'tangents', 'binormals']
+
+
+def vertex_cache_misses(faces, cache_size=CACHE_SIZE):
+    """
+    Simulates a FIFO post-transform vertex cache while drawing the faces in order.
+    :return: the ACMR (average cache miss ratio, misses per triangle) and ATVR (average transform to vertex ratio,
+    misses per used vertex); both are 0 for an empty mesh.
+    """
+    indices = faces.ravel().tolist()
+    if len(indices) == 0:
+        return 0., 0.
+
+    # time at which each vertex entered the cache, a vertex is in the cache if fewer than cache_size vertices
+    # entered it since.
+    entered = {}
+    misses = 0
+    for v in indices:
+        if misses - entered.get(v, -cache_size) >= cache_size:
+            misses += 1
+            entered[v] = misses
+
+    return misses / faces.shape[0], misses / len(entered)
+
+
+def tipsify(faces, nvertices, cache_size=CACHE_SIZE):
+    """
+    Reorders the triangles to improve the post-transform vertex cache hit rate.
+    :param faces: the (n, 3) array of vertex indices
+    :param nvertices: the number of vertices of the mesh
+    :return: the reordered faces array
+    """
+    nfaces = faces.shape[0]
+
+    # vertex-triangle adjacency, in compressed rows
+    flat = faces.ravel()
+    adjacency = (np.argsort(flat, kind='stable') // 3).tolist()
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(flat, minlength=nvertices)))).tolist()
+
+    triangles = faces.tolist()
+    live = np.bincount(flat, minlength=nvertices).tolist()  # number of triangles not emitted yet for each vertex
+    stamps = [0] * nvertices  # time stamp of each vertex in the cache
+    emitted = [False] * nfaces
+    dead_ends = []
+    order = []
+
+    fanning = 0  # vertex whose triangles are emitted next
+    time = cache_size + 1
+    cursor = 0  # next vertex to try when no candidate is left
+
+    while fanning >= 0:
+        candidates = []
+
+        # emit all the remaining triangles around the fanning vertex
+        for t in adjacency[offsets[fanning]:offsets[fanning + 1]]:
+            if emitted[t]:
+                continue
+            for v in triangles[t]:
+                dead_ends.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - stamps[v] > cache_size:
+                    stamps[v] = time
+                    time += 1
+            emitted[t] = True
+            order.append(t)
+
+        # choose the next fanning vertex among the candidates still in the cache, with live triangles
+        fanning = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - stamps[v] + 2 * live[v] <= cache_size:
+                    priority = time - stamps[v]
+                if priority > best:
+                    best = priority
+                    fanning = v
+
+        # otherwise, go back to recently used vertices, then to the next vertex in the input order
+        while fanning < 0 and dead_ends:
+            v = dead_ends.pop()
+            if live[v] > 0:
+                fanning = v
+        while fanning < 0 and cursor < nvertices:
+            if live[cursor] > 0:
+                fanning = cursor
+            cursor += 1
+
+    return faces[np.array(order, dtype=np.intp)]
+
+
+def vertex_order_by_first_use(faces, nvertices):
+    """
+    Returns the order of the vertices by first use in the faces, followed by unused vertices.
+    """
+    used, first = np.unique(faces.ravel(), return_index=True)
+    unused = np.setdiff1d(np.arange(nvertices), used)
+    return np.concatenate((used[np.argsort(first)], unused))
+
+
+def optimize_mesh_arrays(mesh, cache_size=CACHE_SIZE):
+    """
+    Reorders the triangles and vertices of a mesh dictionary (as returned by the OBJ readers) in place.
+    """
+    nvertices = mesh['vertices'].shape[0]
+    faces = tipsify(mesh['faces'], nvertices, cache_size)
+
+    order = vertex_order_by_first_use(faces, nvertices)
+    remap = np.empty(nvertices, dtype=np.uint32)
+    remap[order] = np.arange(nvertices, dtype=np.uint32)
+
+    mesh['faces'] = remap[faces]
+    for name in VERTEX_ARRAYS:
+        if mesh.get(name) is not None:
+            mesh[name] = mesh[name][order]
+
+    return mesh
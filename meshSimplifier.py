@@ -0,0 +1,176 @@
+import numpy as np
+
+from mesh import calculate_normals, normalize_rows
+
+'''
+Mesh simplification for levels of detail (LOD), using quadric error metrics on a grid of vertex clusters: all
+vertices in a cell of the grid are collapsed to the position minimising the sum of the squared distances to the
+planes of their faces. This is vectorised, unlike edge collapses which need a priority queue.
+Open boundary vertices (eg where two materials meet) are kept in place, and texture charts are kept separate so that
+texture coordinates are not averaged across seams.
+Sources:
+Garland and Heckbert, Surface Simplification Using Quadric Error Metrics, SIGGRAPH 1997.
+Lindstrom, Out-of-Core Simplification of Large Polygonal Models, SIGGRAPH 2000.
+'''
+
+# number of grid cells along the largest side of the mesh bounding box, for each level of detail
+LOD_RESOLUTIONS = [48, 24, 12]
+
+# meshes with fewer faces are not simplified
+LOD_MIN_FACES = 500
+
+# a level is only kept if it has at most this fraction of the faces of the previous level
+LOD_MIN_REDUCTION = 0.75
+
+
+def face_quadrics(vertices, faces):
+    """
+    Returns the area-weighted plane quadric of each face, as the 10 coefficients
+    (a2, ab, ac, b2, bc, c2, ad, bd, cd, d2) of the plane (a, b, c, d).
+    """
+    corners = vertices[faces].astype(np.float64)
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1) / 2
+    normals = normalize_rows(normals).astype(np.float64)
+    d = -np.sum(normals * corners[:, 0], axis=1)
+    a, b, c = normals.T
+    return areas[:, np.newaxis] * np.stack([a * a, a * b, a * c, b * b, b * c, c * c, a * d, b * d, c * d, d * d],
+                                           axis=1)
+
+
+def sum_rows(indices, values, n):
+    """
+    Sums the rows of values into an (n, values.shape[1]) array, at the given row indices.
+    """
+    return np.stack([np.bincount(indices, weights=values[:, k], minlength=n) for k in range(values.shape[1])],
+                    axis=1)
+
+
+def connected_components(faces, n):
+    """
+    Labels the vertices of a mesh by connected component, the label being the smallest vertex index in the component.
+    Since vertices are split along texture seams, components are the texture charts of the mesh.
+    """
+    labels = np.arange(n)
+    flat = faces.ravel()
+    order = np.argsort(flat, kind='stable')
+    used, starts = np.unique(flat[order], return_index=True)
+
+    while True:
+        # propagate the smallest label of each face to its vertices, then jump to the label of the label
+        face_labels = np.repeat(labels[faces].min(axis=1), 3)
+        new_labels = labels.copy()
+        new_labels[used] = np.minimum(labels[used], np.minimum.reduceat(face_labels[order], starts))
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def boundary_vertices(vertices, faces):
+    """
+    Returns a mask of the vertices on open boundaries of the mesh. Edges are matched by vertex position, so that
+    edges along texture seams (where vertices are split) are not boundaries.
+    """
+    _, positions = np.unique(vertices, axis=0, return_inverse=True)
+    positions = positions.ravel()
+    edges = positions[faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)]
+    edges = np.sort(edges, axis=1)
+    edges, counts = np.unique(edges, axis=0, return_counts=True)
+    on_boundary = np.zeros(positions.max(initial=-1) + 1, dtype=bool)
+    on_boundary[edges[counts == 1].ravel()] = True
+    return on_boundary[positions], positions
+
+
+def simplify(mesh, resolution):
+    """
+    Simplifies a mesh dictionary (as returned by the OBJ readers) by clustering its vertices on a grid.
+    :param mesh: the mesh dictionary, with vertices, faces, normals and optionally textureCoords
+    :param resolution: the number of grid cells along the largest side of the bounding box
+    :return: a dictionary with the vertices, faces, normals, textureCoords, tangents and binormals of the simplified
+    mesh
+    """
+    vertices = np.asarray(mesh['vertices'])
+    faces = np.asarray(mesh['faces']).astype(np.intp)
+    n = vertices.shape[0]
+
+    # grid cell of each vertex, vertices on open boundaries get their own cell
+    lower = vertices.min(axis=0)
+    size = max((vertices.max(axis=0) - lower).max() / resolution, 1e-12)
+    cells = np.minimum(np.floor((vertices - lower) / size).astype(np.intp), resolution - 1)
+    cells = np.ravel_multi_index(cells.T, (resolution,) * 3)
+    locked, positions = boundary_vertices(vertices, faces)
+    cells[locked] = resolution ** 3 + positions[locked]
+    cells, cell_index = np.unique(cells, return_inverse=True)
+    cell_index = cell_index.ravel()
+    ncells = cells.shape[0]
+
+    # sum the quadrics of the faces around each cell
+    quadrics = sum_rows(cell_index[faces].ravel(), np.repeat(face_quadrics(vertices, faces), 3, axis=0), ncells)
+    A = quadrics[:, [0, 1, 2, 1, 3, 4, 2, 4, 5]].reshape(-1, 3, 3)
+    b = quadrics[:, 6:9]
+
+    # the position of each cell minimises its quadric error, if this is well defined and inside the cell,
+    # otherwise the mean of its vertices is used.
+    counts = np.bincount(cell_index, minlength=ncells)[:, np.newaxis]
+    mean = sum_rows(cell_index, vertices.astype(np.float64), ncells) / counts
+    position = mean.copy()
+    solvable = np.abs(np.linalg.det(A)) > 1e-9 * np.maximum(np.trace(A, axis1=1, axis2=2), 1e-30) ** 3
+    solvable &= cells < resolution ** 3
+    if np.any(solvable):
+        optimal = np.linalg.solve(A[solvable], -b[solvable][:, :, np.newaxis])[:, :, 0]
+        inside = np.all(np.abs(optimal - mean[solvable]) <= size, axis=1)
+        position[np.flatnonzero(solvable)[inside]] = optimal[inside]
+    position[cells >= resolution ** 3] = mean[cells >= resolution ** 3]
+
+    # new vertices are the distinct (cell, texture chart) pairs, so that texture coordinates are not averaged
+    # across seams while both sides of a seam move to the same position.
+    charts = connected_components(faces, n)
+    clusters, cluster_index = np.unique(cell_index * n + charts, return_inverse=True)
+    cluster_index = cluster_index.ravel()
+    nclusters = clusters.shape[0]
+    cluster_counts = np.bincount(cluster_index, minlength=nclusters)[:, np.newaxis]
+
+    simplified = {
+        'vertices': position[clusters // n].astype('f'),
+        'normals': normalize_rows(sum_rows(cluster_index, np.asarray(mesh['normals'], np.float64), nclusters)),
+        'textureCoords': None,
+        'tangents': None,
+        'binormals': None,
+    }
+
+    # remove the faces that collapsed
+    new_faces = cluster_index[faces]
+    collapsed = (new_faces[:, 0] == new_faces[:, 1]) | (new_faces[:, 1] == new_faces[:, 2]) | \
+                (new_faces[:, 2] == new_faces[:, 0])
+    simplified['faces'] = new_faces[~collapsed].astype(np.uint32)
+
+    if mesh.get('textureCoords') is not None:
+        uv = sum_rows(cluster_index, np.asarray(mesh['textureCoords'], np.float64), nclusters) / cluster_counts
+        simplified['textureCoords'] = uv.astype('f')
+        _, simplified['tangents'], simplified['binormals'] = calculate_normals(
+            simplified['vertices'], simplified['faces'], simplified['textureCoords'])
+
+    return simplified
+
+
+def build_lods(mesh, resolutions=LOD_RESOLUTIONS):
+    """
+    Builds the chain of simplified meshes of a mesh dictionary, from the most to the least detailed. Levels that do
+    not reduce the number of faces enough are skipped.
+    :return: a list of mesh dictionaries, empty for small meshes
+    """
+    lods = []
+    nfaces = mesh['faces'].shape[0]
+    if nfaces < LOD_MIN_FACES:
+        return lods
+
+    for resolution in resolutions:
+        lod = simplify(mesh, resolution)
+        if lod['faces'].shape[0] == 0:
+            break
+        if lod['faces'].shape[0] <= LOD_MIN_REDUCTION * nfaces:
+            lods.append(lod)
+            nfaces = lod['faces'].shape[0]
+
+    return lods
@@ -0,0 +1,159 @@
+import numpy as np
+from OpenGL.GL import *
+
+from BaseModel import create_vertex_array
+from glState import gl_state
+from mesh import Mesh
+from shaders import BaseShaderProgram
+from transformStage import affine_inverse
+
+'''
+Occlusion culling of the main view with hardware occlusion queries. The spatial groups are the leaves of the bounding
+volume hierarchy of the scene (see spatialIndex.py). After the models are drawn, the bounding box of each group in the
+frustum is drawn with colour and depth writes off inside a GL_ANY_SAMPLES_PASSED query, which tells whether any of its
+pixels passed the depth test. The results are read at the next frame, only if they are available, so the CPU never
+waits for the GPU: the groups whose box was hidden are not drawn, and the others (including the groups without a
+result yet) are. A group hidden at the last frame that becomes visible is drawn with a frame of delay, which is the
+price of not waiting.
+'''
+
+# the boxes are slightly enlarged, so that their faces do not lie on the surfaces of the models they contain and fail
+# the depth test against them
+BOX_SCALE = 1.01
+BOX_MARGIN = 0.01
+
+
+def unit_cube():
+    """
+    Returns the mesh of the cube from -1 to 1, drawn for the bounding boxes.
+    """
+    vertices = np.array([[x, y, z] for x in [-1, 1] for y in [-1, 1] for z in [-1, 1]], 'f')
+    faces = np.array([
+        [0, 1, 3], [0, 3, 2],  # -x
+        [4, 6, 7], [4, 7, 5],  # +x
+        [0, 4, 5], [0, 5, 1],  # -y
+        [2, 3, 7], [2, 7, 6],  # +y
+        [0, 2, 6], [0, 6, 4],  # -z
+        [1, 5, 7], [1, 7, 3],  # +z
+    ], np.uint32)
+    return Mesh(vertices=vertices, faces=faces)
+
+
+class OcclusionCulling:
+    """
+    Keeps one occlusion query per spatial group, and which groups were hidden at the last frame.
+    """
+
+    def __init__(self, scene):
+        self.scene = scene
+
+        # off by default, toggled with the x key
+        self.enabled = False
+
+        # the hierarchy the groups belong to, the queries are reset when it is rebuilt
+        self.bvh = None
+
+        # query of each group, whether the query waits for its result, and the groups hidden at the last result
+        self.queries = {}
+        self.pending = set()
+        self.occluded = set()
+
+        # groups in the frustum of the current frame, which get a new query after drawing
+        self.groups = []
+
+        # created when first used, as they need the OpenGL context
+        self.shader = None
+        self.cube = None
+
+    def reset(self, bvh):
+        """
+        Forgets the results when the groups changed.
+        """
+        self.bvh = bvh
+        self.pending.clear()
+        self.occluded.clear()
+
+    def read_results(self):
+        """
+        Reads the results of the queries that are available, without waiting for the others.
+        """
+        for group in list(self.pending):
+            query = self.queries[group]
+            if not glGetQueryObjectuiv(query, GL_QUERY_RESULT_AVAILABLE):
+                self.scene.stats['occlusion queries not ready'] += 1
+                continue
+
+            self.pending.discard(group)
+            if glGetQueryObjectuiv(query, GL_QUERY_RESULT):
+                self.occluded.discard(group)
+            else:
+                self.occluded.add(group)
+
+    def cull(self, models):
+        """
+        Removes the models of the groups hidden at the last frame. The models must be in the frustum.
+        """
+        transforms = self.scene.transforms
+        if transforms.bvh is not self.bvh:
+            self.reset(transforms.bvh)
+        self.read_results()
+
+        rows = [transforms.index.get(id(model)) for model in models]
+        groups = [None if row is None else int(self.bvh.leaf_of[row]) for row in rows]
+
+        # a group is drawn while the camera is inside its box or close to it, since the near plane clips its faces
+        P = self.scene.P
+        near = abs(P[2, 3] / (P[2, 2] - 1))
+        camera = affine_inverse(self.scene.camera.V)[:3, 3]
+        self.groups = [group for group in set(groups) if group is not None]
+
+        # the results of the groups that left the frustum are out of date when they come back
+        self.occluded.intersection_update(self.groups)
+        for group in self.groups:
+            if np.all(camera >= self.bvh.node_min[group] - near) and np.all(camera <= self.bvh.node_max[group] + near):
+                self.occluded.discard(group)
+
+        kept = [model for model, group in zip(models, groups) if group not in self.occluded]
+        self.scene.stats['occlusion culled'] += len(models) - len(kept)
+        self.scene.stats['occlusion groups hidden'] += len(self.occluded.intersection(self.groups))
+        return kept
+
+    def issue_queries(self):
+        """
+        Draws the box of each group in the frustum in an occlusion query, call this after drawing the models.
+        """
+        if self.shader is None:
+            self.cube = create_vertex_array(unit_cube())[0]
+            self.shader = BaseShaderProgram()
+            self.shader.name = 'occlusion_box'
+            self.shader.compile({'position': 0})
+
+        glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        glDepthMask(GL_FALSE)
+        gl_state.use_program(self.shader.program)
+        gl_state.bind_vertex_array(self.cube)
+
+        PV = np.matmul(self.scene.P, self.scene.camera.V)
+        for group in self.groups:
+            # the last query of this group is still running, it is not issued again until it is read
+            if group in self.pending:
+                continue
+
+            if group not in self.queries:
+                self.queries[group] = glGenQueries(1)
+
+            center = (self.bvh.node_min[group] + self.bvh.node_max[group]) / 2
+            extent = (self.bvh.node_max[group] - self.bvh.node_min[group]) / 2 * BOX_SCALE + BOX_MARGIN
+            M = np.diag(np.append(extent, 1.))
+            M[:3, 3] = center
+            self.shader.uniforms['PVM'].bind(np.matmul(PV, M))
+
+            glBeginQuery(GL_ANY_SAMPLES_PASSED, self.queries[group])
+            glDrawElements(GL_TRIANGLES, 36, GL_UNSIGNED_INT, None)
+            glEndQuery(GL_ANY_SAMPLES_PASSED)
+
+            self.pending.add(group)
+            self.scene.stats['occlusion queries issued'] += 1
+
+        glDepthMask(GL_TRUE)
+        glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
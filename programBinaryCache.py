@@ -0,0 +1,107 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+from OpenGL.GL import *
+
+from meshCache import CACHE_DIR
+
+'''
+On-disk cache for linked GLSL programs. After a program is linked from source, its driver-specific binary is read
+back with glGetProgramBinary and stored in a file named after the hash of the GLSL sources, the attribute bindings and
+the driver vendor, renderer and version. Later runs load it with glProgramBinary, and compile from source again if
+the driver rejects it (eg after a driver update that keeps the same version string).
+'''
+
+# default directory where the program binaries are stored
+PROGRAM_CACHE_DIR = os.path.join(CACHE_DIR, 'programs')
+
+# increase this when the way programs are built changes, to invalidate existing entries
+PROGRAM_CACHE_VERSION = 1
+
+# each file starts with the binary format of the program, as an unsigned 32 bits integer
+HEADER = struct.Struct('<I')
+
+
+def program_binaries_supported():
+    """
+    Returns whether the driver can save and load program binaries (OpenGL 4.1 or ARB_get_program_binary).
+    """
+    if not bool(glGetProgramBinary) or not bool(glProgramBinary):
+        return False
+    return glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+
+
+def program_binary_key(vertex_source, fragment_source, attributes, geometry_source=None):
+    """
+    Hashes what determines a program binary: the GLSL sources, the attribute locations and the driver.
+    :param attributes: the dictionary of attribute locations
+    :param geometry_source: [optional] the source of the geometry shader, if the program has one
+    """
+    digest = hashlib.sha1('v{}'.format(PROGRAM_CACHE_VERSION).encode())
+    for name in [GL_VENDOR, GL_RENDERER, GL_VERSION]:
+        digest.update(glGetString(name) or b'')
+    digest.update(vertex_source.encode())
+    digest.update(fragment_source.encode())
+    if geometry_source is not None:
+        digest.update(geometry_source.encode())
+    digest.update(repr(sorted(attributes.items())).encode())
+    return digest.hexdigest()[:16]
+
+
+def program_binary_path(key, cache_dir=PROGRAM_CACHE_DIR):
+    return os.path.join(cache_dir, '{}.bin'.format(key))
+
+
+def load_program_binary(key, cache_dir=PROGRAM_CACHE_DIR):
+    """
+    Creates a program from the stored binary for this key.
+    :return: the linked program, or None if there is no entry or the driver rejected it
+    """
+    path = program_binary_path(key, cache_dir)
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'rb') as file:
+        data = file.read()
+    if len(data) <= HEADER.size:
+        return None
+    binary_format, = HEADER.unpack_from(data)
+    binary = np.frombuffer(data, np.uint8, offset=HEADER.size)
+
+    program = glCreateProgram()
+    glProgramBinary(program, binary_format, binary, binary.shape[0])
+    if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+        print('(W) The driver rejected the program binary {}, compiling from source'.format(path))
+        glDeleteProgram(program)
+        os.remove(path)
+        return None
+
+    return program
+
+
+def save_program_binary(key, program, cache_dir=PROGRAM_CACHE_DIR):
+    """
+    Stores the binary of a linked program. The program should be linked with the
+    GL_PROGRAM_BINARY_RETRIEVABLE_HINT parameter set.
+    """
+    size = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+    if size <= 0:
+        return
+
+    length = np.zeros(1, np.int32)
+    binary_format = np.zeros(1, np.uint32)
+    binary = np.empty(size, np.uint8)
+    glGetProgramBinary(program, size, length, binary_format, binary)
+
+    path = program_binary_path(key, cache_dir)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, 'wb') as file:
+            file.write(HEADER.pack(int(binary_format[0])))
+            file.write(binary[:length[0]].tobytes())
+        os.replace(tmp_path, path)
+    except OSError as error:
+        print('(W) Could not write the program binary {}: {}'.format(path, error))
@@ -0,0 +1,192 @@
+import os
+
+import numpy as np
+from OpenGL.GL import *
+
+from cubeMap import CubeMap
+from environmentMapping import UPDATE_STATIC, EnvironmentMappingTexture, EnvironmentShader
+
+'''
+Reflection probes baked offline. The environment cube map of a probe sees the static part of the scene, which never
+changes, so rendering it live costs frames for nothing: the baking tool renders the six faces once at each probe
+position, builds their mip levels by averaging blocks of 2x2 pixels, and stores all levels as RGB bytes in a
+compressed .npz file. At startup the scene loads the file as a mipmapped CubeMap, and the models reflecting it cost no
+rendering; live maps (see environmentMapping.py) are only needed for dynamic content. Bake the probes of the street
+with (this opens the OpenGL window of the scene, so it needs a display):
+python reflectionProbes.py
+
+The blurrier levels stand in for rough reflections: the EnvironmentShader samples the map with a level of detail bias
+growing with the roughness of the material of each model. They are box filtered, not convolved with a specular lobe,
+which is enough for the blurred look of the street.
+'''
+
+# default directory where the baked probes are stored
+PROBE_DIR = 'probes'
+
+# increase this when the stored arrays change, to reject older files
+PROBE_VERSION = 1
+
+# the probes of the street, by name: the position they are rendered from
+STREET_PROBES = {
+    'peugeot': [-1., -3.6, -2.],
+}
+
+
+def probe_path(name, probe_dir=PROBE_DIR):
+    return os.path.join(probe_dir, '{}.npz'.format(name))
+
+
+def downsample(faces):
+    """
+    Averages the blocks of 2x2 pixels of the faces.
+    :param faces: the (6, N, N, 3) uint8 array of the faces, N must be even
+    :return: the (6, N/2, N/2, 3) uint8 array of the next mip level
+    """
+    blocks = faces.reshape(6, faces.shape[1] // 2, 2, faces.shape[2] // 2, 2, 3).astype(np.float32)
+    return np.round(blocks.mean(axis=(2, 4))).astype(np.uint8)
+
+
+def mip_levels(faces):
+    """
+    Builds the mip levels of the faces, down to 1x1 pixel.
+    :param faces: the (6, N, N, 3) uint8 array of the faces, N must be a power of two
+    :return: the list of levels, starting with the faces
+    """
+    levels = [faces]
+    while levels[-1].shape[1] > 1:
+        levels.append(downsample(levels[-1]))
+    return levels
+
+
+def save_probe(path, position, levels):
+    """
+    Writes the levels of a probe, to a temporary file first so that an interrupted write never leaves a partial file.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = '{}.tmp{}.npz'.format(path, os.getpid())
+    np.savez_compressed(tmp_path, version=PROBE_VERSION, position=np.array(position, 'f'),
+                        **{'level{}'.format(i): level for i, level in enumerate(levels)})
+    os.replace(tmp_path, path)
+
+
+def load_probe_levels(path):
+    """
+    Reads the levels of a probe saved by save_probe().
+    :return: the position of the probe and the list of levels, or None if the file is missing or of another version
+    """
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as data:
+        if int(data['version']) != PROBE_VERSION:
+            print('(W) Warning: the reflection probe {} was baked by another version, bake it again'.format(path))
+            return None
+        count = len([key for key in data.files if key.startswith('level')])
+        return data['position'], [data['level{}'.format(i)] for i in range(count)]
+
+
+class ReflectionProbe(CubeMap):
+    """
+    Cube map loaded from a baked probe, with all its mip levels. It can be given to an EnvironmentShader in place of an
+    EnvironmentMappingTexture, and is never rendered again.
+    """
+
+    def __init__(self, position, levels):
+        """
+        :param position: the position the probe was rendered from
+        :param levels: the list of (6, N, N, 3) uint8 arrays of the faces at each mip level, see mip_levels()
+        """
+        CubeMap.__init__(self, format=GL_RGB)
+        self.position = np.array(position, 'f')
+        self.width = self.height = levels[0].shape[1]
+        self.levels = len(levels)
+
+        self.bind()
+
+        # the rows of the small levels are not aligned on 4 bytes
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        for level, faces in enumerate(levels):
+            for layer, data in enumerate(faces):
+                glTexImage2D(GL_TEXTURE_CUBE_MAP_POSITIVE_X + layer, level, self.format, data.shape[1], data.shape[0],
+                             0, self.format, self.type, np.ascontiguousarray(data))
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+
+        glTexParameteri(self.target, GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+        self.unbind()
+
+    def update(self, scene):
+        """
+        Baked probes do not change, this only counts them in the statistics of the frame.
+        """
+        scene.stats['environment map baked'] += 1
+
+
+def load_probe(name, probe_dir=PROBE_DIR):
+    """
+    Loads a baked probe as a cube map.
+    :return: the ReflectionProbe, or None if the probe was not baked
+    """
+    path = probe_path(name, probe_dir)
+    stored = load_probe_levels(path)
+    if stored is None:
+        print('(W) No baked reflection probe {}, run python reflectionProbes.py to bake it'.format(path))
+        return None
+    print('Loading reflection probe: {}'.format(path))
+    return ReflectionProbe(*stored)
+
+
+def read_faces(cube_map):
+    """
+    Reads back the six faces of a rendered cube map.
+    :return: the (6, N, N, 3) uint8 array of the faces, in layer order
+    """
+    cube_map.bind()
+    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+    faces = [np.frombuffer(glGetTexImage(GL_TEXTURE_CUBE_MAP_POSITIVE_X + layer, 0, GL_RGB, GL_UNSIGNED_BYTE),
+                           np.uint8).reshape(cube_map.height, cube_map.width, 3) for layer in range(6)]
+    glPixelStorei(GL_PACK_ALIGNMENT, 4)
+    cube_map.unbind()
+    return np.stack(faces)
+
+
+def bake_probe(scene, position, size):
+    """
+    Renders the static models of the scene seen from a probe position, except the reflective ones.
+    :param size: the size of the faces in pixels, a power of two
+    :return: the list of mip levels of the faces
+    """
+    cube_map = EnvironmentMappingTexture(width=size, height=size, position=position, policy=UPDATE_STATIC)
+    models = [model for model in scene.models if model.static and not isinstance(model.shader, EnvironmentShader)]
+    cube_map.render_faces(scene, models, list(cube_map.fbos.keys()))
+    return mip_levels(read_faces(cube_map))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Bake the reflection probes of the street scene.')
+    parser.add_argument('probes', nargs='*', default=sorted(STREET_PROBES.keys()),
+                        help='the probes to bake, among {}'.format(', '.join(sorted(STREET_PROBES.keys()))))
+    parser.add_argument('--size', type=int, default=256, help='the size of the faces, a power of two')
+    parser.add_argument('--probe-dir', default=PROBE_DIR)
+    args = parser.parse_args()
+
+    for name in args.probes:
+        if name not in STREET_PROBES:
+            parser.error('unknown probe {}'.format(name))
+    if args.size < 1 or args.size & (args.size - 1) != 0:
+        parser.error('the size of the faces must be a power of two')
+
+    from main import Street
+
+    # the live environment map of the scene is not drawn in the probes
+    scene = Street(baked_probes=False)
+
+    # a first frame computes the transforms of the models and renders the shadow map
+    scene.draw()
+
+    for name in args.probes:
+        levels = bake_probe(scene, STREET_PROBES[name], args.size)
+        path = probe_path(name, args.probe_dir)
+        save_probe(path, STREET_PROBES[name], levels)
+        print('{} -> {} ({} levels, {:.0f}kB)'.format(name, path, len(levels), os.path.getsize(path) / 1024))
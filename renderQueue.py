@@ -0,0 +1,198 @@
+import numpy as np
+
+from occlusionCulling import OcclusionCulling
+
+'''
+State-sorted drawing of the models of a rendering pass. Drawing the models in the order they were added to the scene
+switches program, textures and materials back and forth between consecutive draws; the queue instead gives each model
+a 64 bits key packing, from the most to the least significant bits:
+
+    pass (2) | program (10) | texture set (12) | material (8) | depth (16)
+
+and draws the models by increasing key, so that the models sharing a program are drawn together, then within them the
+models sharing textures, then a material. Opaque models are drawn front to back last, which helps the early depth test.
+Transparent models are drawn after the opaque ones, back to front, so that blending is correct: their key is the pass
+followed by the depth.
+
+Before sorting, the models outside the frustum of the pass are culled (see spatialIndex.py), so that each pass (main
+view, shadow map, each face of the environment map) only draws the models its camera sees.
+
+The main pass can also skip the groups of models hidden behind others at the last frame, with hardware occlusion
+queries (see occlusionCulling.py).
+
+The layered passes draw each model once in the six faces of a cube map, with the LAYERED permutation of its shader
+(see layeredRendering.py).
+
+Models with the ordered attribute set (the skybox, the debug texture quad) are not sorted or culled: they are drawn
+before the others, in the order they were given.
+'''
+
+# rendering passes, the first part of the key
+PASS_OPAQUE = 0
+PASS_TRANSPARENT = 1
+
+# number of bits of each part of the key
+PROGRAM_BITS = 10
+TEXTURES_BITS = 12
+MATERIAL_BITS = 8
+DEPTH_BITS = 16
+
+MATERIAL_SHIFT = DEPTH_BITS
+TEXTURES_SHIFT = MATERIAL_SHIFT + MATERIAL_BITS
+PROGRAM_SHIFT = TEXTURES_SHIFT + TEXTURES_BITS
+PASS_SHIFT = PROGRAM_SHIFT + PROGRAM_BITS
+
+
+def quantize_depths(depths):
+    """
+    Maps the depths of the models to integers using all the depth bits, keeping their order.
+    """
+    if len(depths) == 0:
+        return np.zeros(0, np.int64)
+    near, far = depths.min(), depths.max()
+    scale = ((1 << DEPTH_BITS) - 1) / max(far - near, 1e-6)
+    return ((depths - near) * scale).astype(np.int64)
+
+
+def sort_keys(passes, programs, textures, materials, depths):
+    """
+    Packs the sorting key of each model.
+    :param passes, programs, textures, materials: (N,) integer arrays, each value must fit in its number of bits
+    :param depths: (N,) array of the distances of the models to the camera
+    :return: the (N,) int64 keys
+    """
+    depths = quantize_depths(depths)
+    state = (programs << PROGRAM_SHIFT) | (textures << TEXTURES_SHIFT) | (materials << MATERIAL_SHIFT) | depths
+    back_to_front = ((1 << DEPTH_BITS) - 1 - depths) << PROGRAM_SHIFT
+    return (passes << PASS_SHIFT) | np.where(passes == PASS_TRANSPARENT, back_to_front, state)
+
+
+def state_changes(order, *states):
+    """
+    Counts the changes of state when drawing the models in the given order.
+    :param order: the indices of the models in drawing order
+    :param states: (N,) arrays of the state of each model (program, textures, material)
+    """
+    return sum(int(np.count_nonzero(state[order][1:] != state[order][:-1])) + (len(order) > 0) for state in states)
+
+
+class RenderQueue:
+    """
+    Sorts and draws the models of each pass. The programs and texture sets are numbered in the order they are first
+    seen, so that their numbers fit in the key.
+    """
+
+    def __init__(self, scene):
+        self.scene = scene
+
+        # number of each program and texture set
+        self.programs = {}
+        self.texture_sets = {}
+
+        # if False, the models are drawn in the order given, to compare
+        self.enabled = True
+
+        # if False, the models outside the frustum are drawn too
+        self.culling = True
+
+        # occlusion culling of the main pass
+        self.occlusion = OcclusionCulling(scene)
+
+    def number(self, numbers, value, bits):
+        if value not in numbers:
+            if len(numbers) == 1 << bits:
+                print('(W) Warning in RenderQueue: more than {} different values, sorting is approximate'.format(
+                    1 << bits))
+            numbers[value] = len(numbers) % (1 << bits)
+        return numbers[value]
+
+    def depths(self, models, layered=False):
+        """
+        Returns the distance along the view direction of the bounding sphere centres, computed for each pass since the
+        camera changes between passes. Layered passes look in all directions from the probe, their depth is the
+        distance to it.
+        """
+        V = self.scene.camera.V
+        centers = np.array([self.scene.transforms.get(model)[2] for model in models])
+        if layered:
+            # the view matrix of the layered passes translates the probe to the origin
+            return np.linalg.norm(centers + V[:3, 3], axis=1)
+        return -(centers @ V[2, :3] + V[2, 3])
+
+    def cull(self, models, name):
+        """
+        Keeps the models in the frustum of the current projection and camera. Models without transforms in the stage of
+        this frame are kept.
+        :param name: the name of the pass, for the statistics
+        """
+        transforms = self.scene.transforms
+        visible = transforms.visible(np.matmul(self.scene.P, self.scene.camera.V))
+        rows = [transforms.index.get(id(model)) for model in models]
+        kept = [model for model, row in zip(models, rows) if row is None or visible[row]]
+
+        self.scene.stats['{} visible'.format(name)] += len(kept)
+        self.scene.stats['{} culled'.format(name)] += len(models) - len(kept)
+        return kept
+
+    def draw(self, models, name='main', depth_only=False, layered=False):
+        """
+        Draws the visible models in the frustum, and not hidden in the main pass, sorted by state and depth.
+        :param name: the name of the pass, for the statistics
+        :param depth_only: whether the pass only writes depth, then the models are drawn with their depth shader
+        :param layered: whether the pass renders a layered cube map, then the models are drawn with their layered shader
+        """
+        ordered = [model for model in models if model.visible and model.ordered]
+        models = [model for model in models if model.visible and not model.ordered]
+
+        for model in ordered:
+            if layered:
+                model.draw_layered()
+            else:
+                model.draw()
+
+        if self.culling:
+            models = self.cull(models, name)
+
+        occlusion = name == 'main' and self.occlusion.enabled
+        if occlusion:
+            models = self.occlusion.cull(models)
+
+        if len(models) > 0:
+            self.draw_sorted(models, depth_only, layered)
+
+        # the boxes of the groups are tested against the depth of the models just drawn, for the next frame
+        if occlusion:
+            self.occlusion.issue_queries()
+
+    def draw_sorted(self, models, depth_only=False, layered=False):
+        """
+        Draws the models sorted by state and depth. The number of state changes in the order given and in the sorted
+        order are added to the statistics of the frame. In depth-only passes, the models share the program and have no
+        textures or materials, so they are only sorted front to back.
+        """
+        if depth_only:
+            depths = self.depths(models)
+            for i in np.argsort(depths, kind='stable') if self.enabled else range(len(models)):
+                models[i].draw_depth()
+            return
+        passes = np.array([PASS_TRANSPARENT if model.mesh.material.alpha < 1. else PASS_OPAQUE for model in models])
+        programs = np.array([self.number(self.programs, model.shader.program, PROGRAM_BITS) for model in models])
+        textures = np.array([self.number(self.texture_sets, tuple(int(texture.textureid) for texture in
+                                                                   model.mesh.textures), TEXTURES_BITS)
+                             for model in models])
+        materials = np.array([model.mesh.material.index or 0 for model in models]) % (1 << MATERIAL_BITS)
+
+        keys = sort_keys(passes, programs, textures, materials, self.depths(models, layered))
+        order = np.argsort(keys, kind='stable')
+
+        unsorted = np.arange(len(models))
+        self.scene.stats['state changes unsorted'] += state_changes(unsorted, programs, textures, materials)
+        self.scene.stats['state changes sorted'] += state_changes(order, programs, textures, materials)
+
+        if not self.enabled:
+            order = unsorted
+        for i in order:
+            if layered:
+                models[i].draw_layered()
+            else:
+                models[i].draw()
@@ -1,3 +1,5 @@
+from collections import Counter
+
 # pygame is used to create a window with the operating system on which to draw.
 import pygame
 
@@ -10,6 +12,18 @@ from lightSource import LightSource
 # import the shader class
 from shaders import *
 
+# import the asset registry class
+from assetRegistry import AssetRegistry
+
+# import the tracked OpenGL state
+from glState import gl_state
+
+# import the per-frame transform computation
+from transformStage import TransformStage
+
+# import the state-sorted drawing of the models
+from renderQueue import RenderQueue
+
 
 class Scene:
     """
@@ -71,6 +85,29 @@ class Scene:
         # This class will maintain a list of models to draw in the scene
         self.models = []
 
+        # meshes and GPU buffers shared between the models of the scene
+        self.assets = AssetRegistry()
+
+        # world and normal matrices of the models, computed once per frame
+        self.transforms = TransformStage()
+
+        # rendering statistics of the current and last frames
+        self.stats = Counter()
+        self.last_stats = Counter()
+
+        # divides the screen size at which meshes switch to a lower level of detail, higher values keep more detail
+        self.lod_bias = 1.0
+
+        # the (P, V) matrices of the main view of the frame, from which the levels of detail of all passes are chosen
+        self.lod_view = None
+
+        # the (position, projection scale) of the probe during the environment map passes, which choose the levels of
+        # detail from the distance to the probe instead
+        self.lod_probe = None
+
+        # draws the models of each pass sorted by program, textures, material and depth
+        self.queue = RenderQueue(self)
+
     def add_models_list(self, models_list):
         """
         This method adds a model to the list of models.
@@ -92,10 +129,13 @@ class Scene:
 
             # ensure that the camera view matrix is up to date
             self.camera.update()
+            self.lod_view = (self.P.copy(), self.camera.V.copy())
+
+            # compute the transforms of all models at once
+            self.transforms.update(self.models)
 
-        # then loop over all models in the list and draw them
-        for model in self.models:
-            model.draw()
+        # then draw all models in the list, sorted to limit state changes
+        self.queue.draw(self.models)
 
         # once done drawing, display the scene
         # use double buffering to avoid artefacts:
@@ -112,6 +152,29 @@ class Scene:
         if event.key == pygame.K_q:
             self.running = False
 
+        elif event.key == pygame.K_i:
+            print('Last frame: ' + ', '.join('{} {}'.format(k, v) for k, v in sorted(self.last_stats.items())))
+
+        elif event.key == pygame.K_o:
+            self.queue.enabled = not self.queue.enabled
+            print('Render queue sorting: {}'.format('on' if self.queue.enabled else 'off'))
+
+        elif event.key == pygame.K_c:
+            self.queue.culling = not self.queue.culling
+            print('Frustum culling: {}'.format('on' if self.queue.culling else 'off'))
+
+        elif event.key == pygame.K_x:
+            self.queue.occlusion.enabled = not self.queue.occlusion.enabled
+            print('Occlusion culling: {}'.format('on' if self.queue.occlusion.enabled else 'off'))
+
+        elif event.key == pygame.K_EQUALS:
+            self.lod_bias *= 2
+            print('LOD bias: {}'.format(self.lod_bias))
+
+        elif event.key == pygame.K_MINUS:
+            self.lod_bias /= 2
+            print('LOD bias: {}'.format(self.lod_bias))
+
     def pygameEvents(self):
         """
         Method to handle PyGame events for user interaction.
@@ -176,3 +239,8 @@ class Scene:
 
             # otherwise, continue drawing
             self.draw()
+
+            # keep the statistics of the frame just drawn, with the numbers of issued and skipped GL calls
+            self.stats.update(gl_state.take_stats())
+            self.last_stats = self.stats
+            self.stats = Counter()
@@ -1,7 +1,19 @@
+import copy
+import functools
+import re
+import time
+
 # imports all openGL functions
 from OpenGL.GL import *
 from OpenGL.GL import shaders
+from frameUniforms import bind_frame_block, frame_uniforms
+from glState import gl_state
+from materialTable import bind_material_block, material_table
 from matutils import *
+from layeredRendering import layered_geometry_shader, renamed_outputs
+from transformStage import normal_matrices
+from programBinaryCache import load_program_binary, program_binaries_supported, program_binary_key, \
+    save_program_binary
 # numpy to store data in arrays
 import numpy as np
 
@@ -41,6 +53,8 @@ class Uniform:
         """
         if M is not None:
             self.value = M
+        if not gl_state.uniform_changed(self.location, self.value):
+            return
         if self.value.shape[0] == 4 and self.value.shape[1] == 4:
             glUniformMatrix4fv(self.location, number, transpose, self.value)
         elif self.value.shape[0] == 3 and self.value.shape[1] == 3:
@@ -67,25 +81,29 @@ class Uniform:
     def bind_int(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1i(self.location, self.value)
+        if gl_state.uniform_changed(self.location, self.value):
+            glUniform1i(self.location, self.value)
 
     def bind_float(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1f(self.location, self.value)
+        if gl_state.uniform_changed(self.location, self.value):
+            glUniform1f(self.location, self.value)
 
     def bind_vector(self, value=None):
         if value is not None:
             self.value = value
-        if value.shape[0] == 2:
-            glUniform2fv(self.location, 1, value)
-        elif value.shape[0] == 3:
-            glUniform3fv(self.location, 1, value)
-        elif value.shape[0] == 4:
-            glUniform4fv(self.location, 1, value)
+        if not gl_state.uniform_changed(self.location, self.value):
+            return
+        if self.value.shape[0] == 2:
+            glUniform2fv(self.location, 1, self.value)
+        elif self.value.shape[0] == 3:
+            glUniform3fv(self.location, 1, self.value)
+        elif self.value.shape[0] == 4:
+            glUniform4fv(self.location, 1, self.value)
         else:
             print('(E) Error in Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found {}'.format(
-                value.shape[0]))
+                self.value.shape[0]))
 
     def set(self, value):
         """
@@ -94,6 +112,109 @@ class Uniform:
         self.value = value
 
 
+@functools.lru_cache(maxsize=None)
+def read_source(file_name):
+    """
+    Reads a GLSL source file, once for all the shader objects using it.
+    """
+    print('Load shader from file: {}'.format(file_name))
+    with open(file_name, 'r') as file:
+        return file.read()
+
+
+# the flags selecting a permutation of a shader program, each one is a #define in both GLSL sources:
+# TEXTURED: the mesh has a texture, sampled in the fragment shader
+# SHADOWED: the fragment shader reads the shadow map
+# INSTANCED: the vertex shader reads the model matrix of each instance from the instance_M and instance_MiT attributes
+# LAYERED: a geometry shader draws each triangle in the six faces of a layered cube map (see layeredRendering.py)
+SHADER_FLAGS = ['TEXTURED', 'SHADOWED', 'INSTANCED', 'LAYERED']
+
+
+def add_defines(source, defines):
+    """
+    Inserts a #define line for each flag after the #version directive, which must stay first. A #line directive
+    follows them so that the compiler errors still refer to the lines of the file.
+    :param defines: the names of the flags to define
+    """
+    if len(defines) == 0:
+        return source
+
+    lines = source.split('\n')
+    version = next((i for i, line in enumerate(lines) if re.match(r'\s*#\s*version', line)), -1)
+    inserted = ['#define {}'.format(flag) for flag in sorted(defines)] + ['#line {}'.format(version + 2)]
+    return '\n'.join(lines[:version + 1] + inserted + lines[version + 1:])
+
+
+class ProgramCache:
+    """
+    Linked GLSL programs shared between shader objects. A program only depends on its GLSL sources and on the
+    locations its attributes are bound to, so all shader objects with the same name, sources and attribute layout use
+    one program; the shader objects keep their own per-model state (uniform values, textures to bind). Each
+    permutation of a shader (see SHADER_FLAGS) has different sources, hence its own program.
+    """
+
+    def __init__(self):
+        # program and uniform locations, indexed by (name, sources, attribute layout)
+        self.programs = {}
+
+        # whether the driver supports program binaries, checked when the first program is created
+        self.binaries = None
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.compiled = 0
+        self.loaded = 0
+        self.time = 0.
+
+    def key(self, shader, attributes):
+        """
+        Returns the key identifying the program of a shader object compiled with the given attribute locations.
+        """
+        return (shader.name,) + shader.sources() + (tuple(sorted(attributes.items())),)
+
+    def get(self, key):
+        """
+        Returns the (program, uniform locations) pair stored for this key, or None if it was not compiled yet.
+        """
+        if key not in self.programs:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.programs[key]
+
+    def add(self, key, program):
+        """
+        Stores a linked program, its uniform locations are filled in as shader objects link them.
+        :return: the (program, uniform locations) pair
+        """
+        # the id may belong to a deleted program, whose uniform values are not valid anymore
+        gl_state.forget_program(program)
+        self.programs[key] = (program, {})
+        return self.programs[key]
+
+    def binaries_supported(self):
+        if self.binaries is None:
+            self.binaries = program_binaries_supported()
+            if not self.binaries:
+                print('(W) The driver does not support program binaries, shaders are compiled at each start')
+        return self.binaries
+
+    def report(self):
+        """
+        Prints how the programs were created, and the time spent: a cold start compiles all programs from source, a
+        warm start loads them from the binary cache.
+        """
+        print('Shader programs: {} compiled from source, {} loaded from binaries, {} reused'.format(
+            self.compiled, self.loaded, self.hits))
+        print('Shader programs: {} start in {:.1f}ms'.format(
+            'warm' if self.compiled == 0 else 'cold', 1000 * self.time))
+
+
+# the programs shared by all shader objects
+program_cache = ProgramCache()
+
+
 class BaseShaderProgram:
     """
     This is the base class for loading and compiling the GLSL shaders.
@@ -109,8 +230,10 @@ class BaseShaderProgram:
         self.name = name
         print('Creating shader program: {}'.format(name))
 
-        if name is not None:
+        # by default, load the shaders from the directory named after the program
+        if name is not None and vertex_shader is None:
             vertex_shader = 'shaders/{}/vertex_shader.glsl'.format(name)
+        if name is not None and fragment_shader is None:
             fragment_shader = 'shaders/{}/fragment_shader.glsl'.format(name)
 
         # load the vertex shader GLSL code
@@ -127,9 +250,7 @@ class BaseShaderProgram:
                 }
             '''
         else:
-            print('Load vertex shader from file: {}'.format(vertex_shader))
-            with open(vertex_shader, 'r') as file:
-                self.vertex_shader_source = file.read()
+            self.vertex_shader_source = read_source(vertex_shader)
 
         # load the fragment shader GLSL code
         if fragment_shader is None:
@@ -140,9 +261,10 @@ class BaseShaderProgram:
                 }
             '''
         else:
-            print('Load fragment shader from file: {}'.format(fragment_shader))
-            with open(fragment_shader, 'r') as file:
-                self.fragment_shader_source = file.read()
+            self.fragment_shader_source = read_source(fragment_shader)
+
+        # the flags of the permutation of the program to compile, see SHADER_FLAGS
+        self.defines = frozenset()
 
         # storing uniforms in a dictionary.
         self.uniforms = {
@@ -152,32 +274,130 @@ class BaseShaderProgram:
     def add_uniform(self, name):
         self.uniforms[name] = Uniform(name)
 
+    def define(self, *flags):
+        """
+        Adds flags to the permutation of the program, call this before compiling it.
+        :param flags: names from SHADER_FLAGS
+        """
+        for flag in flags:
+            if flag not in SHADER_FLAGS:
+                print('(W) Warning: unknown shader flag {} for {}'.format(flag, self.name))
+        self.defines = self.defines.union(flags)
+
+    def permutation(self, *flags):
+        """
+        Returns a copy of this shader object with more flags, to compile another permutation of the program next to
+        this one. The copy has its own uniforms, and shares the other attributes (textures, maps) with this one.
+        :param flags: names from SHADER_FLAGS
+        """
+        shader = copy.copy(self)
+        shader.uniforms = {name: Uniform(name, uniform.value) for name, uniform in self.uniforms.items()}
+        shader.define(*flags)
+        return shader
+
+    def sources(self):
+        """
+        Returns the vertex, fragment and geometry shader sources of the permutation selected by the flags. The geometry
+        shader is None, except for the LAYERED permutation where the outputs of the vertex shader are renamed to be
+        the inputs of the geometry shader.
+        """
+        vertex_defines = self.defines
+        geometry_shader_source = None
+        if 'LAYERED' in self.defines:
+            vertex_defines = self.defines.union(renamed_outputs(self.vertex_shader_source))
+            geometry_shader_source = layered_geometry_shader(self.vertex_shader_source)
+        return add_defines(self.vertex_shader_source, vertex_defines), add_defines(self.fragment_shader_source,
+                                                                                   self.defines), \
+            geometry_shader_source
+
+    def label(self):
+        """
+        Returns the name of the program followed by its flags, for the messages.
+        """
+        return '+'.join([str(self.name)] + sorted(self.defines))
+
     def compile(self, attributes):
         """
-        Call this function to compile the GLSL codes for both shaders.
+        Call this function to compile the GLSL codes for both shaders. If a program was already linked for the same
+        sources and attribute layout, it is reused instead.
         :return:
         """
-        print('Compiling GLSL shaders [{}]...'.format(self.name))
+        key = program_cache.key(self, attributes)
+        cached = program_cache.get(key)
+        if cached is None:
+            cached = program_cache.add(key, self.create_program(attributes))
+        else:
+            print('Reusing GLSL program [{}]'.format(self.label()))
+
+        self.program, locations = cached
+        bind_frame_block(self.program)
+        bind_material_block(self.program)
+
+        # tell OpenGL to use this shader program for rendering
+        gl_state.use_program(self.program)
+
+        # link all uniforms, looking up each location only once per program
+        for name, uniform in self.uniforms.items():
+            if name not in locations:
+                uniform.link(self.program)
+                locations[name] = uniform.location
+            uniform.location = locations[name]
+
+    def create_program(self, attributes):
+        """
+        Loads the program from the binary cache if possible, otherwise compiles it and stores its binary.
+        :return: the linked program
+        """
+        start = time.perf_counter()
+        binary_key = None
+
+        if program_cache.binaries_supported():
+            vertex_shader_source, fragment_shader_source, geometry_shader_source = self.sources()
+            binary_key = program_binary_key(vertex_shader_source, fragment_shader_source, attributes,
+                                            geometry_shader_source)
+            program = load_program_binary(binary_key)
+            if program is not None:
+                print('Loaded GLSL program [{}] from binary'.format(self.label()))
+                program_cache.loaded += 1
+                program_cache.time += time.perf_counter() - start
+                return program
+
+        program = self.link(attributes, retrievable=binary_key is not None)
+        if binary_key is not None:
+            save_program_binary(binary_key, program)
+
+        program_cache.compiled += 1
+        program_cache.time += time.perf_counter() - start
+        return program
+
+    def link(self, attributes, retrievable=False):
+        """
+        Compiles the GLSL codes of the shaders and links them in a new program.
+        :param retrievable: whether the program binary will be read back after linking
+        :return: the program
+        """
+        print('Compiling GLSL shaders [{}]...'.format(self.label()))
+        vertex_shader_source, fragment_shader_source, geometry_shader_source = self.sources()
         try:
             self.program = glCreateProgram()
-            glAttachShader(self.program, shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER))
-            glAttachShader(self.program, shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
+            glAttachShader(self.program, shaders.compileShader(vertex_shader_source, shaders.GL_VERTEX_SHADER))
+            glAttachShader(self.program, shaders.compileShader(fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
+            if geometry_shader_source is not None:
+                glAttachShader(self.program, shaders.compileShader(geometry_shader_source, GL_GEOMETRY_SHADER))
 
         except RuntimeError as error:
-            print('(E) An error occured while compiling {} shader:\n {}\n... forwarding exception...'.format(self.name,
-                                                                                                             error)),
+            print('(E) An error occured while compiling {} shader:\n {}\n... forwarding exception...'.format(
+                self.label(), error)),
             raise error
 
         self.bindAttributes(attributes)
 
-        glLinkProgram(self.program)
+        if retrievable:
+            glProgramParameteri(self.program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
 
-        # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        glLinkProgram(self.program)
 
-        # link all uniforms
-        for uniform in self.uniforms:
-            self.uniforms[uniform].link(self.program)
+        return self.program
 
     def bindAttributes(self, attributes):
         # bind all shader attributes to the correct locations in the VAO
@@ -185,13 +405,15 @@ class BaseShaderProgram:
             glBindAttribLocation(self.program, location, name)
             print('Binding attribute {} to location {}'.format(name, location))
 
-    def bind(self, model, M):
+    def bind(self, model, M, MiT=None):
         """
         Call this function to enable this GLSL Program
+        :param M: the model matrix
+        :param MiT: [optional] the inverse-transpose of the model matrix, for shaders transforming normals
         """
 
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        gl_state.use_program(self.program)
 
         P = model.scene.P
         V = model.scene.camera.V
@@ -205,86 +427,51 @@ class PhongShader(BaseShaderProgram):
     This is the base class for loading and compiling the GLSL shaders.
     """
 
-    def __init__(self, name='phong'):
+    def __init__(self, name='phong', vertex_shader=None, fragment_shader=None):
         """
         Initialises the shaders
         :param vertex_shader: the name of the file containing the vertex shader GLSL code
         :param fragment_shader: the name of the file containing the fragment shader GLSL code
         """
 
-        BaseShaderProgram.__init__(self, name=name)
+        BaseShaderProgram.__init__(self, name=name, vertex_shader=vertex_shader, fragment_shader=fragment_shader)
 
-        # storing uniforms in a dictionary.
+        # storing uniforms in a dictionary, the camera and light are in the FrameData block (see frameUniforms.py)
         self.uniforms = {
-            'PVM': Uniform('PVM'),  # project view model matrix
-            'VM': Uniform('VM'),  # view model matrix (necessary for light computations)
-            'VMiT': Uniform('VMiT'),  # inverse-transpose of the view model matrix (for normal transformation)
-            'mode': Uniform('mode', 0),
-            # rendering mode (only for illustration, in general want one shader program per mode)
-            'alpha': Uniform('alpha', 1.0),
-            # rendering mode (only for illustration, in general want one shader program per mode)
-            'Ka': Uniform('Ka'),  # ambient component
-            'Kd': Uniform('Kd'),  # diffuse component
-            'Ks': Uniform('Ks'),  # specular component
-            'Ns': Uniform('Ns'),  # specular highlights
-            'light': Uniform('light', np.array([0., 0., 0.], 'f')),
-            'Ia': Uniform('Ia'),  # ambient illumination
-            'Id': Uniform('Id'),  # diffuse illumination
-            'Is': Uniform('Is'),  # specular illumination
-            'has_texture': Uniform('has_texture'),
+            'M': Uniform('M'),  # model matrix
+            'MiT': Uniform('MiT'),  # inverse-transpose of the model matrix (for normal transformation)
+            'material_index': Uniform('material_index'),  # index of the material in the MaterialTable block
             'textureObject': Uniform('textureObject')
 
         }
 
-    def bind(self, model, M):
+    def bind(self, model, M, MiT=None):
         """
         Call this function to enable this GLSL Program (you can have multiple GLSL programs used during rendering!)
+        :param M: the model matrix
+        :param MiT: [optional] the inverse-transpose of the model matrix, computed from M if not given
         """
 
-        P = model.scene.P
-        V = model.scene.camera.V
-
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
-
-        # set the PVM matrix uniform
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
-
-        # set the PVM matrix uniform
-        self.uniforms['VM'].bind(np.matmul(V, M))
-
-        # set the PVM matrix uniform
-        self.uniforms['VMiT'].bind(np.linalg.inv(np.matmul(V, M))[:3, :3].transpose())
+        gl_state.use_program(self.program)
 
-        # bind the mode to the program
-        self.uniforms['mode'].bind(model.scene.mode)
+        # upload the camera and light data if they changed since the last model
+        self.bind_frame_uniforms(model)
 
-        self.uniforms['alpha'].bind(model.mesh.material.alpha)
+        # set the model matrix uniforms
+        self.uniforms['M'].bind(M)
+        self.uniforms['MiT'].bind(MiT if MiT is not None else normal_matrices(M[np.newaxis])[0])
 
         if len(model.mesh.textures) > 0:
             # bind the texture(s)
             self.uniforms['textureObject'].bind(0)
-            self.uniforms['has_texture'].bind(1)
-        else:
-            self.uniforms['has_texture'].bind(0)
-
-        # bind material properties
-        self.bind_material_uniforms(model.mesh.material)
-
-        # bind the light properties
-        self.bind_light_uniforms(model.scene.light, V)
 
-    def bind_light_uniforms(self, light, V):
-        self.uniforms['light'].bind_vector(unhomog(np.dot(V, homog(light.position))))
-        self.uniforms['Ia'].bind_vector(np.array(light.Ia, 'f'))
-        self.uniforms['Id'].bind_vector(np.array(light.Id, 'f'))
-        self.uniforms['Is'].bind_vector(np.array(light.Is, 'f'))
+        # the material properties are in the material table, only its index changes between models
+        material_table.upload()
+        self.uniforms['material_index'].bind(material_table.index(model.mesh.material))
 
-    def bind_material_uniforms(self, material):
-        self.uniforms['Ka'].bind_vector(np.array(material.Ka, 'f'))
-        self.uniforms['Kd'].bind_vector(np.array(material.Kd, 'f'))
-        self.uniforms['Ks'].bind_vector(np.array(material.Ks, 'f'))
-        self.uniforms['Ns'].bind_float(material.Ns)
+    def bind_frame_uniforms(self, model):
+        frame_uniforms.update(model.scene)
 
     def add_uniform(self, name):
         if name in self.uniforms:
@@ -292,9 +479,39 @@ class PhongShader(BaseShaderProgram):
         self.uniforms[name] = Uniform(name)
 
     def unbind(self):
-        glUseProgram(0)
+        gl_state.use_program(0)
 
 
 class FlatShader(PhongShader):
     def __init__(self):
         PhongShader.__init__(self, name='flat')
+
+
+
+class DepthShader(BaseShaderProgram):
+    """
+    Position-only program for the depth passes (shadow map): no lighting, no textures, no colour output.
+    """
+
+    # the only attributes read by the depth program
+    ATTRIBUTES = ['position', 'instance_M']
+
+    def __init__(self):
+        BaseShaderProgram.__init__(self, name='depth')
+
+        self.uniforms = {
+            'M': Uniform('M'),  # model matrix
+        }
+
+    def compile(self, attributes):
+        """
+        Compiles the program with the locations of the position and instance attributes only, so that all the models
+        with the same layout for these share the program.
+        """
+        BaseShaderProgram.compile(self, {name: location for name, location in attributes.items()
+                                         if name in self.ATTRIBUTES})
+
+    def bind(self, model, M, MiT=None):
+        gl_state.use_program(self.program)
+        frame_uniforms.update(model.scene)
+        self.uniforms['M'].bind(M)
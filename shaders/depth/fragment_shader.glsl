@@ -0,0 +1,5 @@
+#version 130		// required to use OpenGL core standard
+
+// the depth passes have no colour output, the depth is written by the fixed pipeline
+void main() {
+}
@@ -0,0 +1,34 @@
+#version 130		// required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
+
+// position-only program for the depth passes (shadow map): only the depth of the vertices is computed
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the position attribute contains the vertex position
+#ifdef INSTANCED
+in mat4 instance_M;     // the model matrix of the instance, one per instance (takes 4 attribute locations)
+#endif
+
+//=== uniforms
+uniform mat4 M;     // the model matrix, of the whole group of instances with INSTANCED
+
+// per-frame data shared by all programs, see frameUniforms.py
+layout(std140) uniform FrameData {
+    mat4 P;                     // projection matrix
+    mat4 V;                     // view matrix
+    mat4 shadow_map_matrix;     // from view coordinates to shadow map coordinates
+    vec4 light;                 // light position in view coordinates
+    vec4 Ia;                    // ambient light intensity
+    vec4 Id;                    // diffuse light intensity
+    vec4 Is;                    // specular light intensity
+    int mode;                   // the rendering mode
+};
+
+
+void main() {
+#ifdef INSTANCED
+    gl_Position = P*V*M*instance_M*vec4(position, 1.0f);
+#else
+    gl_Position = P*V*M*vec4(position, 1.0f);
+#endif
+}
@@ -1,4 +1,5 @@
 #version 130
+#extension GL_ARB_uniform_buffer_object : require
 
 in vec3 normal_view_space;
 in vec3 position_view_space;
@@ -6,17 +7,26 @@ in vec3 fragment_texCoord;
 out vec4 final_color;
 
 uniform samplerCube sampler_cube;
-uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
-uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
-uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
-uniform mat3 VT;
+uniform float lod_bias;         // added to the mip level, the blurrier levels of baked probes give rough reflections
+// per-frame data shared by all programs, see frameUniforms.py
+layout(std140) uniform FrameData {
+    mat4 P;                     // projection matrix
+    mat4 V;                     // view matrix
+    mat4 shadow_map_matrix;     // from view coordinates to shadow map coordinates
+    vec4 light;                 // light position in view coordinates
+    vec4 Ia;                    // ambient light intensity
+    vec4 Id;                    // diffuse light intensity
+    vec4 Is;                    // specular light intensity
+    int mode;                   // the rendering mode
+};
 
 void main(void)
 {
 	vec3 normal_view_space_normalized = normalize(normal_view_space);
 	vec3 reflected = reflect(normalize(-position_view_space), normal_view_space_normalized);
 
-	final_color = texture(sampler_cube, normalize(VT*reflected));
+	// the transpose of the view rotation takes the reflected direction back to world coordinates
+	final_color = texture(sampler_cube, normalize(transpose(mat3(V))*reflected), lod_bias);
 	//final_color = texture(sampler_cube, normalize(reflected));
 
 
@@ -1,4 +1,5 @@
 #version 130
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== in attributes are read from the vertex array, one row per instance of the shader
 in vec3 position;	// the position attribute contains the vertex position
@@ -10,23 +11,34 @@ out vec3 normal_view_space;     // the normal of the vertex in view coordinates
 out vec3 fragment_texCoord;
 
 
-uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
-uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
-uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
-uniform int mode;	// the rendering mode (better to code different shaders!)
+uniform mat4 M;     // the model matrix
+uniform mat3 MiT;   // the inverse-transpose of the model matrix, used for normals
+
+// per-frame data shared by all programs, see frameUniforms.py
+layout(std140) uniform FrameData {
+    mat4 P;                     // projection matrix
+    mat4 V;                     // view matrix
+    mat4 shadow_map_matrix;     // from view coordinates to shadow map coordinates
+    vec4 light;                 // light position in view coordinates
+    vec4 Ia;                    // ambient light intensity
+    vec4 Id;                    // diffuse light intensity
+    vec4 Is;                    // specular light intensity
+    int mode;                   // the rendering mode
+};
 
 void main(void)
 {
-    // first, transform the position using PVM matrix.
+    // first, transform the position to view coordinates, then with the projection matrix.
     // gl_Position is a standard output of the
     // vertex shader.
-    gl_Position = PVM * vec4(position, 1.0f);
+    position_view_space = vec3( V * M * vec4(position, 1.0f) );
+    gl_Position = P * vec4(position_view_space, 1.0f);
 
     // calculate vectors used for shading calculations
     // those will be interpolate before being sent to the
     // fragment shader.
-    position_view_space = vec3( VM * vec4(position, 1.0f) );
-    normal_view_space = normalize(VMiT*normal);
+    // the view matrix is a rotation and translation, so it transforms normals as well
+    normal_view_space = normalize(mat3(V)*MiT*normal);
 	//fragment_texCoord = normalize(-VMiT*position);
 
 	//fragment_texCoord = reflect(-normalize(position), normal);
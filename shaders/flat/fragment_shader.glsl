@@ -1,4 +1,5 @@
 # version 130 // required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
 in vec3 fragment_color;        // the fragment colour
@@ -9,30 +10,60 @@ in vec2 fragment_texCoord;
 out vec4 final_color;
 
 // === uniform here the texture object to sample from
-uniform int mode;	// the rendering mode (better to code different shaders!)
-
-uniform int has_texture;
-
 // texture samplers
+#ifdef TEXTURED
 uniform sampler2D textureObject; // first texture object
+#endif
+
+// materials of all models, see materialTable.py
+struct MaterialData {
+    vec4 Ka;                    // ambient reflection
+    vec4 Kd;                    // diffuse reflection
+    vec4 Ks;                    // specular reflection
+    vec4 parameters;            // specular exponent, alpha
+};
+
+layout(std140) uniform MaterialTable {
+    MaterialData materials[256];
+};
+
+uniform int material_index;     // the material of the model in the table
+
+// material of the model, read from the table by load_material()
+vec3 Ka;
+vec3 Kd;
+vec3 Ks;
+float Ns;
+float alpha;
+
+void load_material() {
+    MaterialData material = materials[material_index];
+    Ka = material.Ka.rgb;
+    Kd = material.Kd.rgb;
+    Ks = material.Ks.rgb;
+    Ns = material.parameters.x;
+    alpha = material.parameters.y;
+}
 
-// material uniforms
-uniform vec3 Ka;
-uniform vec3 Kd;
-uniform vec3 Ks;
-uniform float Ns;
-
-// light source
-uniform vec3 light;
-uniform vec3 Ia;
-uniform vec3 Id;
-uniform vec3 Is;
+// per-frame data shared by all programs, see frameUniforms.py
+layout(std140) uniform FrameData {
+    mat4 P;                     // projection matrix
+    mat4 V;                     // view matrix
+    mat4 shadow_map_matrix;     // from view coordinates to shadow map coordinates
+    vec4 light;                 // light position in view coordinates
+    vec4 Ia;                    // ambient light intensity
+    vec4 Id;                    // diffuse light intensity
+    vec4 Is;                    // specular light intensity
+    int mode;                   // the rendering mode
+};
 
 ///=== main shader code
 void main() {
+      load_material();
+
       // calculate vectors used for shading calculations
       vec3 camera_direction = -normalize(position_view_space);
-      vec3 light_direction = normalize(light-position_view_space);
+      vec3 light_direction = normalize(light.xyz-position_view_space);
 
       // Calculate the normal to the fragment using position of its neighbours
       vec3 xTangent = dFdx( position_view_space );
@@ -40,21 +71,21 @@ void main() {
       vec3 normal_view_space = normalize( cross( xTangent, yTangent ) );
 
       // calculate light components
-      vec4 ambient = vec4(Ia*Ka,1.0f);
-      vec4 diffuse = vec4(Id*Kd*max(0.0f,dot(light_direction, normal_view_space)),1.0f);
-      vec4 specular = vec4(Is*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), 1.0f);
+      vec4 ambient = vec4(Ia.rgb*Ka,1.0f);
+      vec4 diffuse = vec4(Id.rgb*Kd*max(0.0f,dot(light_direction, normal_view_space)),1.0f);
+      vec4 specular = vec4(Is.rgb*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), 1.0f);
 
       // calculate the attenuation function
       // in this formula, dist should be the distance between the surface and the light
-      float dist = length(light - position_view_space);
+      float dist = length(light.xyz - position_view_space);
       float attenuation =  min(1.0/(dist*dist*0.005) + 1.0/(dist*0.05), 1.0);
 
       // sample from the first texture
 
       vec4 texval = vec4(1.0f);
-      if(has_texture == 1){
-          texval = texture2D(textureObject, fragment_texCoord);
-      }
+#ifdef TEXTURED
+      texval = texture2D(textureObject, fragment_texCoord);
+#endif
 
       // combine the shading components
       // do not apply the texture to the specular component.
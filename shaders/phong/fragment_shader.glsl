@@ -1,4 +1,5 @@
 # version 130 // required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
 in vec3 fragment_color;        // the fragment colour
@@ -10,46 +11,77 @@ in vec2 fragment_texCoord;
 out vec4 final_color;
 
 //=== uniforms
-uniform int mode;	// the rendering mode (better to code different shaders!)
-uniform int has_texture;
+#ifdef TEXTURED
 uniform sampler2D textureObject; // texture object
+#endif
 
-// material uniforms
-uniform vec3 Ka;    // ambient reflection properties of the material
-uniform vec3 Kd;    // diffuse reflection propoerties of the material
-uniform vec3 Ks;    // specular properties of the material
-uniform float Ns;   // specular exponent
+// materials of all models, see materialTable.py
+struct MaterialData {
+    vec4 Ka;                    // ambient reflection
+    vec4 Kd;                    // diffuse reflection
+    vec4 Ks;                    // specular reflection
+    vec4 parameters;            // specular exponent, alpha
+};
 
-// light source
-uniform vec3 light; // light position in view space
-uniform vec3 Ia;    // ambient light properties
-uniform vec3 Id;    // diffuse properties of the light source
-uniform vec3 Is;    // specular properties of the light source
+layout(std140) uniform MaterialTable {
+    MaterialData materials[256];
+};
 
-uniform float alpha = 1.0f;
+uniform int material_index;     // the material of the model in the table
+
+// material of the model, read from the table by load_material()
+vec3 Ka;
+vec3 Kd;
+vec3 Ks;
+float Ns;
+float alpha;
+
+void load_material() {
+    MaterialData material = materials[material_index];
+    Ka = material.Ka.rgb;
+    Kd = material.Kd.rgb;
+    Ks = material.Ks.rgb;
+    Ns = material.parameters.x;
+    alpha = material.parameters.y;
+}
+
+// per-frame data shared by all programs, see frameUniforms.py
+layout(std140) uniform FrameData {
+    mat4 P;                     // projection matrix
+    mat4 V;                     // view matrix
+    mat4 shadow_map_matrix;     // from view coordinates to shadow map coordinates
+    vec4 light;                 // light position in view coordinates
+    vec4 Ia;                    // ambient light intensity
+    vec4 Id;                    // diffuse light intensity
+    vec4 Is;                    // specular light intensity
+    int mode;                   // the rendering mode
+};
 
 ///=== main shader code
 void main() {
+    load_material();
+
     // calculate vectors used for shading calculations
     vec3 camera_direction = -normalize(position_view_space);
-    vec3 light_direction = normalize(light-position_view_space);
+    vec3 light_direction = normalize(light.xyz-position_view_space);
 
     // calculate light components
-    vec4 ambient = vec4(Ia*Ka,alpha);
-    vec4 diffuse = vec4(Id*Kd*max(0.0f,dot(light_direction, normal_view_space)), alpha);
-    vec4 specular = vec4(Is*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), alpha);
+    vec4 ambient = vec4(Ia.rgb*Ka,alpha);
+    vec4 diffuse = vec4(Id.rgb*Kd*max(0.0f,dot(light_direction, normal_view_space)), alpha);
+    vec4 specular = vec4(Is.rgb*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), alpha);
 
     // calculate the attenuation function
     // in this formula, dist should be the distance between the surface and the light
-    float dist = length(light - position_view_space);
+    float dist = length(light.xyz - position_view_space);
     float attenuation =  min(1.0/(dist*dist*0.005) + 1.0/(dist*0.05), 1.0);
 
     // sample from the texture map
     // the texture2D function just samples from the texture object at coordinates set by fragment_texCoord
     // using interpolation/extrapolation as set in the OpenGL program
     vec4 texval = vec4(1.0f);
-    if(has_texture == 1)
-        texval = texture2D(textureObject, fragment_texCoord);
+#ifdef TEXTURED
+    texval = texture2D(textureObject, fragment_texCoord);
+#endif
 
     // 5. combine the shading components
     final_color = texval*ambient + attenuation*(texval*diffuse + specular);
@@ -1,4 +1,5 @@
 # version 130 // required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
 in vec3 fragment_color;        // the fragment colour
@@ -10,29 +11,55 @@ in vec2 fragment_texCoord;
 out vec4 final_color;
 
 //=== uniforms
-uniform int mode;	// the rendering mode (better to code different shaders!)
-uniform int has_texture;
+#ifdef TEXTURED
 uniform sampler2D textureObject; // texture object
+#endif
+#ifdef SHADOWED
 uniform sampler2DShadow shadow_map;
+#endif
 //uniform sampler2D old_map;
 
-// shadow map matrix
-// this shadow map matrix times the fragment shader position allows looking up the depth in the shadow map texture
-uniform mat4 shadow_map_matrix;
-
-// material uniforms
-uniform vec3 Ka;    // ambient reflection properties of the material
-uniform vec3 Kd;    // diffuse reflection propoerties of the material
-uniform vec3 Ks;    // specular properties of the material
-uniform float Ns;   // specular exponent
-
-// light source
-uniform vec3 light; // light position in view space
-uniform vec3 Ia;    // ambient light properties
-uniform vec3 Id;    // diffuse properties of the light source
-uniform vec3 Is;    // specular properties of the light source
+// materials of all models, see materialTable.py
+struct MaterialData {
+    vec4 Ka;                    // ambient reflection
+    vec4 Kd;                    // diffuse reflection
+    vec4 Ks;                    // specular reflection
+    vec4 parameters;            // specular exponent, alpha
+};
+
+layout(std140) uniform MaterialTable {
+    MaterialData materials[256];
+};
+
+uniform int material_index;     // the material of the model in the table
+
+// material of the model, read from the table by load_material()
+vec3 Ka;
+vec3 Kd;
+vec3 Ks;
+float Ns;
+float alpha;
+
+void load_material() {
+    MaterialData material = materials[material_index];
+    Ka = material.Ka.rgb;
+    Kd = material.Kd.rgb;
+    Ks = material.Ks.rgb;
+    Ns = material.parameters.x;
+    alpha = material.parameters.y;
+}
 
-uniform float alpha = 1.0f;
+// per-frame data shared by all programs, see frameUniforms.py
+layout(std140) uniform FrameData {
+    mat4 P;                     // projection matrix
+    mat4 V;                     // view matrix
+    mat4 shadow_map_matrix;     // from view coordinates to shadow map coordinates
+    vec4 light;                 // light position in view coordinates
+    vec4 Ia;                    // ambient light intensity
+    vec4 Id;                    // diffuse light intensity
+    vec4 Is;                    // specular light intensity
+    int mode;                   // the rendering mode
+};
 
 
 vec4 phong(vec4 texval);
@@ -40,16 +67,16 @@ vec4 phong(vec4 texval);
 vec4 phong(vec4 texval) {
         // calculate vectors used for shading calculations
     vec3 camera_direction = -normalize(position_view_space);
-    vec3 light_direction = normalize(light-position_view_space);
+    vec3 light_direction = normalize(light.xyz-position_view_space);
 
     // now we calculate light components
-    vec4 ambient = vec4(Ia*Ka,alpha);
-    vec4 diffuse = vec4(Id*Kd*max(0.0f,dot(light_direction, normal_view_space)), alpha);
-    vec4 specular = vec4(Is*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), alpha);
+    vec4 ambient = vec4(Ia.rgb*Ka,alpha);
+    vec4 diffuse = vec4(Id.rgb*Kd*max(0.0f,dot(light_direction, normal_view_space)), alpha);
+    vec4 specular = vec4(Is.rgb*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), alpha);
 
     // calculate the attenuation function
     // in this formula, dist should be the distance between the surface and the light
-    float dist = length(light - position_view_space);
+    float dist = length(light.xyz - position_view_space);
     float attenuation =  min(1.0/(dist*dist*0.005) + 1.0/(dist*0.05), 1.0);
 
     // combine the shading components
@@ -58,13 +85,15 @@ vec4 phong(vec4 texval) {
 
 ///=== main shader code
 void main() {
+    load_material();
 
     // sample from the texture map
     // the texture2D function just samples from the texture object at coordinates set by fragment_texCoord
     // using interpolation/extrapolation as set in the OpenGL program
     vec4 texval = vec4(1.0f);
-    if(has_texture == 1)
-        texval = texture2D(textureObject, fragment_texCoord);
+#ifdef TEXTURED
+    texval = texture2D(textureObject, fragment_texCoord);
+#endif
 
     final_color = vec4(0.0f);
 
@@ -72,6 +101,7 @@ void main() {
 
     final_color = phong(texval);
 
+#ifdef SHADOWED
     vec4 p = shadow_map_matrix*vec4(position_view_space, 1);
 
     //float zlight = texture(old_map, p.xy/p.w).r;
@@ -108,7 +138,7 @@ void main() {
 		float val = texture(shadow_map, p.xyz);
         //if (val < 0.5f)
 		//	final_color.xyz = Ka*Ia*texval.xyz; //
-        final_color.xyz = (1.0-val)*Ka*Ia*texval.xyz + val*final_color.xyz;
+        final_color.xyz = (1.0-val)*Ka*Ia.rgb*texval.xyz + val*final_color.xyz;
 
         //if (p.z > 0.9)
          //   final_color.xyz = Ka*Ia*texval.xyz;
@@ -117,6 +147,7 @@ void main() {
         //final_color = vec4(texture(old_map, p.xy).r, 0.0f, 0.0f, 1.0f);
         //final_color = vec4(-p.z, 0.0f, 0.0f, 1.0f);
 	}
+#endif
     //*/
 
     //final_color.xyz = Ka*Ia*texval.xyz; //
@@ -1,9 +1,14 @@
 #version 130		// required to use OpenGL core standard
+#extension GL_ARB_uniform_buffer_object : require
 
 //=== in attributes are read from the vertex array, one row per instance of the shader
 in vec3 position;	// the position attribute contains the vertex position
 in vec3 normal;		// store the vertex normal
 in vec2 texCoord;
+#ifdef INSTANCED
+in mat4 instance_M;     // the model matrix of the instance, one per instance (takes 4 attribute locations)
+in mat3 instance_MiT;   // the inverse-transpose of the instance model matrix, for normals
+#endif
 
 //=== out attributes are interpolated on the face, and passed on to the fragment shader
 out vec3 position_view_space;   // the position of the vertex in view coordinates
@@ -11,23 +16,42 @@ out vec3 normal_view_space;     // the normal of the vertex in view coordinates
 out vec2 fragment_texCoord;
 
 //=== uniforms
-uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
-uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
-uniform mat3 VMiT;  // The inverse-transpose of the view model matrix, used for normals
-uniform int mode;	// the rendering mode (better to code different shaders!)
+uniform mat4 M;     // the model matrix, of the whole group of instances with INSTANCED
+uniform mat3 MiT;   // the inverse-transpose of the model matrix, used for normals
+
+// per-frame data shared by all programs, see frameUniforms.py
+layout(std140) uniform FrameData {
+    mat4 P;                     // projection matrix
+    mat4 V;                     // view matrix
+    mat4 shadow_map_matrix;     // from view coordinates to shadow map coordinates
+    vec4 light;                 // light position in view coordinates
+    vec4 Ia;                    // ambient light intensity
+    vec4 Id;                    // diffuse light intensity
+    vec4 Is;                    // specular light intensity
+    int mode;                   // the rendering mode
+};
 
 
 void main() {
-    // 1. transform the position using PVM matrix.
+    // 1. transform the position to view coordinates, then with the projection matrix.
     // note that gl_Position is a standard output of the
     // vertex shader.
-    gl_Position = PVM * vec4(position, 1.0f);
+#ifdef INSTANCED
+    position_view_space = vec3(V*M*instance_M*vec4(position,1.0f));
+#else
+    position_view_space = vec3(V*M*vec4(position,1.0f));
+#endif
+    gl_Position = P * vec4(position_view_space, 1.0f);
 
     // calculate vectors used for shading calculations
     // those will be interpolate before being sent to the
     // fragment shader.
-    position_view_space = vec3(VM*vec4(position,1.0f));
-    normal_view_space = normalize(VMiT*normal);
+    // the view matrix is a rotation and translation, so it transforms normals as well
+#ifdef INSTANCED
+    normal_view_space = normalize(mat3(V)*MiT*instance_MiT*normal);
+#else
+    normal_view_space = normalize(mat3(V)*MiT*normal);
+#endif
 
     // forward the texture coordinates.
     fragment_texCoord = texCoord;
@@ -12,6 +12,9 @@ uniform mat4 PVM;
 void main(void)
 {
 	gl_Position = PVM*vec4(position, 1);
+#ifndef LAYERED
+	// in layered passes, the geometry shader projects the position on each face
 	gl_Position.z = gl_Position.w*0.9999;
+#endif
 	fragment_texCoord = -position;
 }
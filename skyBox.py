@@ -9,7 +9,7 @@ class SkyBoxShader(BaseShaderProgram):
         BaseShaderProgram.__init__(self, name=name)
         self.add_uniform('sampler_cube')
 
-    def bind(self, model, M):
+    def bind(self, model, M, MiT=None):
         BaseShaderProgram.bind(self, model, M)
         P = model.scene.P  # get projection matrix from the scene
         V = model.scene.camera.V  # get view matrix from the camera
@@ -25,8 +25,11 @@ class SkyBox(DrawModelFromMesh):
                                    mesh=CubeMesh(texture=CubeMap(name='skybox'), inside=True),
                                    shader=SkyBoxShader(), name='skybox')
 
-    def draw(self):
+        # the skybox is drawn first, without writing depth
+        self.ordered = True
+
+    def draw(self, Mp=None, shader=None, textures=None):
         glDepthMask(GL_FALSE)
-        DrawModelFromMesh.draw(self)
+        DrawModelFromMesh.draw(self, Mp, shader, textures)
         glDepthMask(GL_TRUE)
 
@@ -0,0 +1,142 @@
+import numpy as np
+
+'''
+Frustum culling of the models of the scene. The world axis-aligned bounding boxes of the models are stored in a
+bounding volume hierarchy (BVH), rebuilt when models move. Each rendering pass extracts the six planes of its frustum
+from its projection and view matrices, and walks the hierarchy one level at a time, testing all the nodes of a level
+with a few vectorised numpy calls: the nodes outside the frustum are skipped with all their models, the nodes inside
+accept all their models without further tests, and only the nodes crossing a plane are opened.
+'''
+
+# classification of a box against the frustum
+OUTSIDE = 0
+INTERSECTING = 1
+INSIDE = 2
+
+# maximum number of boxes in a leaf of the hierarchy
+LEAF_SIZE = 4
+
+
+def transform_boxes(M, mins, maxs):
+    """
+    Returns the axis-aligned boxes containing the transformed boxes: the centre is transformed, and the half extents
+    are multiplied by the absolute value of the matrix.
+    :param M: the (N, 4, 4) matrices
+    :param mins: the (N, 3) minimum corners
+    :param maxs: the (N, 3) maximum corners
+    :return: the (N, 3) minimum and maximum corners of the transformed boxes
+    """
+    centers = (mins + maxs) / 2
+    extents = (maxs - mins) / 2
+    world_centers = np.einsum('nij,nj->ni', M[:, :3, :3], centers) + M[:, :3, 3]
+    world_extents = np.einsum('nij,nj->ni', np.abs(M[:, :3, :3]), extents)
+    return world_centers - world_extents, world_centers + world_extents
+
+
+def frustum_planes(PV):
+    """
+    Extracts the planes of the frustum from a projection-view matrix, as the rows (a, b, c, d) such that the points
+    inside verify a*x + b*y + c*z + d >= 0 for all planes.
+    """
+    planes = np.array([PV[3] + PV[0], PV[3] - PV[0], PV[3] + PV[1], PV[3] - PV[1], PV[3] + PV[2], PV[3] - PV[2]])
+    return planes / np.linalg.norm(planes[:, :3], axis=1)[:, np.newaxis]
+
+
+def classify_boxes(planes, mins, maxs):
+    """
+    Classifies boxes against the frustum.
+    :return: the (N,) array of OUTSIDE, INTERSECTING or INSIDE
+    """
+    normals = planes[np.newaxis, :, :3]
+    positive = normals > 0
+
+    # corner of each box farthest along the normal of each plane, and the opposite corner
+    far = np.where(positive, maxs[:, np.newaxis], mins[:, np.newaxis])
+    near = np.where(positive, mins[:, np.newaxis], maxs[:, np.newaxis])
+
+    outside = ((far * normals).sum(axis=2) + planes[:, 3] < 0).any(axis=1)
+    inside = ((near * normals).sum(axis=2) + planes[:, 3] >= 0).all(axis=1)
+    return np.where(outside, OUTSIDE, np.where(inside, INSIDE, INTERSECTING))
+
+
+class BVH:
+    """
+    Bounding volume hierarchy over boxes, stored in flat arrays. Node i covers the boxes order[start[i]:start[i] +
+    count[i]]; inner nodes have the two children first[i] and first[i] + 1, leaves have first[i] = -1.
+    """
+
+    def __init__(self, mins, maxs):
+        """
+        Builds the hierarchy top down, splitting the boxes of each node in two halves along the largest axis of their
+        centres.
+        :param mins: the (N, 3) minimum corners of the boxes
+        :param maxs: the (N, 3) maximum corners of the boxes
+        """
+        self.mins = mins
+        self.maxs = maxs
+        self.order = np.arange(mins.shape[0])
+
+        centers = (mins + maxs) / 2
+        node_min, node_max, start, count, first = [], [], [], [], []
+
+        def add_node(begin, end):
+            boxes = self.order[begin:end]
+            node_min.append(mins[boxes].min(axis=0))
+            node_max.append(maxs[boxes].max(axis=0))
+            start.append(begin)
+            count.append(end - begin)
+            first.append(-1)
+            return len(first) - 1
+
+        stack = [(add_node(0, mins.shape[0]), 0, mins.shape[0])] if mins.shape[0] > 0 else []
+        while len(stack) > 0:
+            node, begin, end = stack.pop()
+            if end - begin <= LEAF_SIZE:
+                continue
+
+            boxes = self.order[begin:end]
+            axis = np.argmax(centers[boxes].max(axis=0) - centers[boxes].min(axis=0))
+            self.order[begin:end] = boxes[np.argsort(centers[boxes, axis], kind='stable')]
+
+            middle = (begin + end) // 2
+            first[node] = add_node(begin, middle)
+            add_node(middle, end)
+            stack.append((first[node], begin, middle))
+            stack.append((first[node] + 1, middle, end))
+
+        self.node_min = np.array(node_min, 'f').reshape(-1, 3)
+        self.node_max = np.array(node_max, 'f').reshape(-1, 3)
+        self.start = np.array(start, int)
+        self.count = np.array(count, int)
+        self.first = np.array(first, int)
+
+        # leaf of each box, the leaves are the spatial groups tested for occlusion (see occlusionCulling.py)
+        self.leaf_of = np.zeros(mins.shape[0], int)
+        for leaf in np.flatnonzero(self.first < 0):
+            self.leaf_of[self.order[self.start[leaf]:self.start[leaf] + self.count[leaf]]] = leaf
+
+    def query(self, planes):
+        """
+        Finds the boxes in the frustum.
+        :param planes: the (6, 4) planes of the frustum, see frustum_planes()
+        :return: the (N,) boolean array of the visible boxes
+        """
+        visible = np.zeros(self.mins.shape[0], bool)
+        nodes = np.arange(min(1, len(self.first)))
+        while len(nodes) > 0:
+            classes = classify_boxes(planes, self.node_min[nodes], self.node_max[nodes])
+
+            for node in nodes[classes == INSIDE]:
+                visible[self.order[self.start[node]:self.start[node] + self.count[node]]] = True
+
+            crossing = nodes[classes == INTERSECTING]
+            leaves = crossing[self.first[crossing] < 0]
+            if len(leaves) > 0:
+                boxes = np.concatenate([self.order[self.start[leaf]:self.start[leaf] + self.count[leaf]]
+                                        for leaf in leaves])
+                visible[boxes] = classify_boxes(planes, self.mins[boxes], self.maxs[boxes]) != OUTSIDE
+
+            inner = crossing[self.first[crossing] >= 0]
+            nodes = np.concatenate([self.first[inner], self.first[inner] + 1])
+
+        return visible
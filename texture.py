@@ -1,5 +1,6 @@
 import pygame
 from OpenGL.GL import *
+from glState import gl_state
 import numpy as np
 
 
@@ -23,6 +24,32 @@ class ImageWrapper:
             return pygame.image.tostring(self.img, "RGB", 1)
 
 
+class DecodedImage:
+    """
+    Image decoded to a plain byte array, with the same interface as ImageWrapper. Unlike ImageWrapper it can be
+    pickled, so that images can be decoded in worker processes.
+    """
+
+    def __init__(self, name, format=GL_RGBA):
+        img = ImageWrapper(name)
+        self.name = name
+        self.format = format
+        self.size = (img.width(), img.height())
+        self.pixels = img.data(format)
+
+    def width(self):
+        return self.size[0]
+
+    def height(self):
+        return self.size[1]
+
+    def data(self, format=GL_RGB):
+        if format != self.format:
+            print('(E) Error in DecodedImage.data(): image {} was not decoded in the requested format'.format(
+                self.name))
+        return self.pixels
+
+
 class Texture:
     """
     Class to handle texture loading.
@@ -30,6 +57,11 @@ class Texture:
 
     def __init__(self, name, img=None, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE,
                  target=GL_TEXTURE_2D):
+        """
+        :param name: the name of the image file in the textures folder
+        :param img: [optional] a numpy array, or an image already decoded (ImageWrapper or DecodedImage), to use
+        instead of loading the file
+        """
         self.name = name
         self.format = format
         self.type = type
@@ -46,11 +78,14 @@ class Texture:
         if img is None:
             img = ImageWrapper(name)
 
-            # load the texture in the buffer
-            glTexImage2D(self.target, 0, format, img.width(), img.height(), 0, format, type, img.data(format))
-        else:
+        if isinstance(img, np.ndarray):
             # if a data array is provided use this
-            glTexImage2D(self.target, 0, format, img.shape[0], img.shape[1], 0, format, type, img)
+            self.width, self.height = img.shape[0], img.shape[1]
+            glTexImage2D(self.target, 0, format, self.width, self.height, 0, format, type, img)
+        else:
+            # load the (possibly already decoded) image in the buffer
+            self.width, self.height = img.width(), img.height()
+            glTexImage2D(self.target, 0, format, self.width, self.height, 0, format, type, img.data(format))
 
         # set what happens for texture coordinates outside [0,1]
         glTexParameteri(self.target, GL_TEXTURE_WRAP_S, wrap)
@@ -97,7 +132,7 @@ class Texture:
         self.unbind()
 
     def bind(self):
-        glBindTexture(self.target, self.textureid)
+        gl_state.bind_texture(self.target, self.textureid)
 
     def unbind(self):
-        glBindTexture(self.target, 0)
+        gl_state.bind_texture(self.target, 0)
@@ -0,0 +1,85 @@
+import os
+
+from OpenGL.GL import *
+
+from texture import Texture
+
+'''
+Textures shared between meshes. Several materials, in one OBJ file or in different ones, often use the same image (the
+building materials all use building2/Klinker1.jpg), and each mesh used to decode it and upload it to its own texture
+object. The manager keys the textures by the resolved path of the image and the parameters of the texture object, so
+that each image is decoded and uploaded once, and hands out the same Texture to all the meshes using it, counting
+them. Like the meshes of the AssetRegistry, the textures are kept for the lifetime of the application: nothing unloads
+models.
+'''
+
+# bytes per texel of the formats used for image textures
+FORMAT_SIZES = {
+    GL_RGBA: 4,
+    GL_RGB: 3,
+}
+
+
+def texture_path(name):
+    """
+    Returns the path identifying an image of the textures folder, the same for all the names of the file.
+    """
+    return os.path.normcase(os.path.realpath(os.path.join('textures', name)))
+
+
+class TextureManager:
+    """
+    Shares Texture objects by image and texture parameters, and counts the users of each one.
+    """
+
+    def __init__(self):
+        # texture and number of users, indexed by (path, wrap, sample, format, type, target)
+        self.textures = {}
+        self.users = {}
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.decoded_bytes_saved = 0
+        self.gpu_bytes_saved = 0
+
+    def get(self, name, img=None, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE,
+            target=GL_TEXTURE_2D):
+        """
+        Returns the texture of an image, creating it the first time it is requested with these parameters. The
+        parameters are those of Texture().
+        :param img: [optional] the image already decoded, only used if the texture does not exist yet
+        """
+        key = (texture_path(name), wrap, sample, format, type, target)
+
+        if key not in self.textures:
+            self.misses += 1
+            self.textures[key] = Texture(name, img=img, wrap=wrap, sample=sample, format=format, type=type,
+                                         target=target)
+            self.users[key] = 0
+
+        if self.users[key] > 0:
+            texture = self.textures[key]
+            size = texture.width * texture.height * FORMAT_SIZES.get(format, 4)
+            self.hits += 1
+            self.gpu_bytes_saved += size
+
+            # images are decoded once per path, here or in advance by AssetRegistry.preload()
+            self.decoded_bytes_saved += size
+            print('Reusing texture {}'.format(name))
+
+        self.users[key] += 1
+        return self.textures[key]
+
+    def report(self):
+        """
+        Prints the number of shared textures and the memory saved.
+        """
+        print('Textures: {} hit(s) / {} miss(es), {} texture(s) for {} user(s)'.format(
+            self.hits, self.misses, len(self.textures), sum(self.users.values())))
+        print('Textures: saved {:.1f} MB of decoded images and {:.1f} MB of GPU textures'.format(
+            self.decoded_bytes_saved / 2 ** 20, self.gpu_bytes_saved / 2 ** 20))
+
+
+# the image textures of the application
+texture_manager = TextureManager()
@@ -0,0 +1,133 @@
+import numpy as np
+
+from spatialIndex import BVH, frustum_planes, transform_boxes
+
+'''
+Per-frame computation of the model transforms. Instead of computing the world matrix, normal matrix and bounding
+sphere of each model separately when it is drawn (many small numpy calls), the matrices of all the models of the
+scene are stacked in (N, 4, 4) float32 arrays and transformed with a few vectorised calls once per frame. The
+inverses use the closed form of affine matrices rather than np.linalg.inv. The world bounding boxes are indexed in a
+bounding volume hierarchy for the frustum culling of each pass (see spatialIndex.py).
+'''
+
+
+def normal_matrices(M):
+    """
+    Returns the inverse-transpose of the 3x3 part of each matrix, using the adjugate: its columns are the cross
+    products of the columns of the matrix, divided by the determinant.
+    :param M: an (N, 4, 4) or (N, 3, 3) array of matrices
+    :return: the (N, 3, 3) array of normal matrices
+    """
+    a0, a1, a2 = M[:, :3, 0], M[:, :3, 1], M[:, :3, 2]
+    cofactors = np.stack([np.cross(a1, a2), np.cross(a2, a0), np.cross(a0, a1)], axis=2)
+    determinants = np.einsum('ni,ni->n', a0, cofactors[:, :, 0])
+    return cofactors / determinants[:, np.newaxis, np.newaxis]
+
+
+def affine_inverse(M):
+    """
+    Inverts affine matrices (last row 0, 0, 0, 1): the inverse of [R t] is [R^-1 -R^-1 t].
+    :param M: a (4, 4) matrix or an (N, 4, 4) array of matrices
+    """
+    single = M.ndim == 2
+    M = M.reshape(-1, 4, 4)
+    R_inv = normal_matrices(M).transpose(0, 2, 1)
+    inverse = np.zeros_like(M)
+    inverse[:, :3, :3] = R_inv
+    inverse[:, :3, 3] = -np.einsum('nij,nj->ni', R_inv, M[:, :3, 3])
+    inverse[:, 3, 3] = 1
+    return inverse[0] if single else inverse
+
+
+def bounding_spheres(M, centers, radii):
+    """
+    Transforms bounding spheres to world coordinates. The radius is scaled by the largest scale factor of the matrix,
+    so that the sphere still contains the mesh under non-uniform scaling.
+    :param M: the (N, 4, 4) model matrices
+    :param centers: the (N, 3) centres in model coordinates
+    :param radii: the (N,) radii in model coordinates
+    :return: the (N, 3) centres and (N,) radii in world coordinates
+    """
+    world_centers = np.einsum('nij,nj->ni', M[:, :3, :3], centers) + M[:, :3, 3]
+    scales = np.sqrt(np.einsum('nij,nij->nj', M[:, :3, :3], M[:, :3, :3]).max(axis=1))
+    return world_centers, radii * scales
+
+
+class TransformStage:
+    """
+    Holds the world matrices, normal matrices, world bounding spheres and boxes of the models of the scene for the
+    current frame.
+    """
+
+    def __init__(self):
+        # row of each model in the arrays, indexed by the model id
+        self.index = {}
+        self.models = []
+
+        # number of changes of the matrix of each model, indexed by the model id, so that cached results depending on
+        # the transforms (eg the shadow map) know when to update
+        self.versions = {}
+
+        self.M = np.zeros((0, 4, 4), 'f')
+        self.MiT = np.zeros((0, 3, 3), 'f')
+        self.centers = np.zeros((0, 3), 'f')
+        self.radii = np.zeros(0, 'f')
+        self.box_min = np.zeros((0, 3), 'f')
+        self.box_max = np.zeros((0, 3), 'f')
+
+        # hierarchy over the world boxes, rebuilt when they change
+        self.bvh = BVH(self.box_min, self.box_max)
+
+    def update(self, models):
+        """
+        Computes the transforms of all the models, call this once per frame before drawing.
+        """
+        previous_index, previous_M = self.index, self.M
+        self.models = list(models)
+        self.index = {id(model): i for i, model in enumerate(self.models)}
+        if len(self.models) == 0:
+            self.versions = {}
+            self.bvh = BVH(self.box_min[:0], self.box_max[:0])
+            return
+
+        self.M = np.array([model.M for model in self.models], 'f')
+
+        # the models new to the stage count as moved
+        rows = np.array([previous_index.get(id(model), -1) for model in self.models])
+        known = rows >= 0
+        unchanged = np.zeros(len(self.models), bool)
+        unchanged[known] = np.all(self.M[known] == previous_M[rows[known]], axis=(1, 2))
+        self.versions = {id(model): self.versions.get(id(model), 0) + (not same)
+                         for model, same in zip(self.models, unchanged)}
+        self.MiT = normal_matrices(self.M)
+        self.centers, self.radii = bounding_spheres(
+            self.M, np.array([model.mesh.center for model in self.models], 'f'),
+            np.array([model.mesh.radius for model in self.models], 'f'))
+
+        bounds = [model.bounds() for model in self.models]
+        box_min, box_max = transform_boxes(self.M, np.array([b[0] for b in bounds], 'f'),
+                                           np.array([b[1] for b in bounds], 'f'))
+        if not np.array_equal(box_min, self.bvh.mins) or not np.array_equal(box_max, self.bvh.maxs):
+            self.bvh = BVH(box_min, box_max)
+        self.box_min, self.box_max = box_min, box_max
+
+    def visible(self, PV):
+        """
+        Returns which models of the stage are in the frustum of a projection-view matrix.
+        :return: the boolean array, indexed like the models
+        """
+        return self.bvh.query(frustum_planes(PV))
+
+    def get(self, model, Mp=None):
+        """
+        Returns the world matrix, normal matrix, and world bounding sphere centre and radius of a model. Models drawn
+        with a parent matrix, or not in the stage, are computed on their own.
+        :param Mp: The model matrix of the parent object, for composite objects.
+        """
+        i = self.index.get(id(model))
+        if Mp is None and i is not None:
+            return self.M[i], self.MiT[i], self.centers[i], self.radii[i]
+
+        M = np.array(model.M if Mp is None else np.matmul(Mp, model.M), 'f')[np.newaxis]
+        centers, radii = bounding_spheres(M, np.array([model.mesh.center], 'f'), np.array([model.mesh.radius], 'f'))
+        return M[0], normal_matrices(M)[0], centers[0], radii[0]